@@ -1,10 +1,16 @@
+BATCH="BATCH" # Envelope of several commands
 CDX="CDX"
+CDX_DONE="CDX_DONE" # A CDX partition was fully enumerated
 CHECK="CHECK"
+CHECK_MANY="CHECK_MANY" # Check a batch of captures
 COMMIT="COMMIT"
 DISCARD="DISCARD"
 DONE="DONE"
+EOF="EOF" # No more commands will follow
 LOAD="LOAD" # Push URL to fetch
+LOAD_MANY="LOAD_MANY" # Push the URLs left after a CHECK_MANY, discard the others
 PARSE="PARSE" # Parse a page"
+RESUMED="RESUMED" # The frontier of the previous run was pushed back
 RETRY="RETRY" # Push URL to fetch
 STORE="STORE" # Store data in the db (deferred)
 UNLOCK="UNLOCK"
@@ -1,4 +1,5 @@
 import os
+import time
 
 DEBUG=os.getenv('DEBUG', '')
 
@@ -10,17 +11,68 @@ REQUESTS_TIMEOUT=(REQUESTS_CONNECT_TIMEOUT,REQUESTS_READ_TIMEOUT)
 REQUESTS_COOLDOWN=15
 MAX_SLEEP_TIME=120
 MAX_RETRY=5
+RETRY_DELAY=REQUESTS_COOLDOWN # before the first retry, doubled on each attempt up to MAX_SLEEP_TIME
+
+# Causes of a RETRY
+RETRY_STATUS='STATUS' # any other non-200 response
+RETRY_THROTTLED='THROTTLED' # 429 or 5xx
+RETRY_TIMEOUT='TIMEOUT'
+RETRY_CONNERR='CONNERR'
+
+# AIMD limit of the requests in flight, see utils/governor.py
+GOVERNOR_DECREASE=0.5
+GOVERNOR_LATENCY_FACTOR=2
 
 CACHE_MAX_SIZE=100 if DEBUG else 1000
+CACHE_MAX_AGE=10 if DEBUG else 60 # seconds before parser results are committed anyway
 
 QUEUE_LENGTH=1000
 
+# Commands sent to the controller in envelopes of BATCH_SIZE commands, or
+# after BATCH_MAX_AGE seconds
+BATCH_SIZE=100
+BATCH_MAX_AGE=0.05
+
+PAGE_COMPRESSION_LEVEL=1 # zlib level for pages sent from loaders to parsers
+PAGE_BYTES_BUDGET=64*1024*1024 # compressed page bytes between loaders and parsers
+
+# Keep the raw pages in a content-addressed store, see utils/packstore.py.
+# Empty to disable. The pages can be parsed again with `master.py --reparse`.
+PACK_STORE_DIR=os.getenv('PACK_STORE_DIR', '')
+PACK_SEGMENT_SIZE=1024*1024*1024
+
+# Point both endpoints to a local stand-in server for benchmarks
+WAYBACK_ENDPOINT=os.getenv('WAYBACK_ENDPOINT', 'https://web.archive.org')
+
 URL_PREFIX = 'http://stackoverflow.com/questions/'
-CDX_API_ENDPOINT="http://web.archive.org/cdx/search/cdx"
+CDX_API_ENDPOINT=os.getenv('CDX_API_ENDPOINT', 'http://web.archive.org/cdx/search/cdx')
 CDX_LIMIT=10000
 
+# The capture space is split into (from, to) timestamp ranges enumerated
+# concurrently, each with its own resume key
+CDX_FIRST_YEAR=2008
+CDX_PARTITIONS=[(str(year), str(year)) for year in range(CDX_FIRST_YEAR, time.gmtime().tm_year+1)]
+CHECK_BATCH_SIZE=500 # Captures per CHECK_MANY message
+
 DB_URI="test.db" if DEBUG else "questions.db"
+CDX_INDEX_URI="test-cdx.db" if DEBUG else "cdx.db"
 DB_TIMEOUT=7200
+DB_CHECKPOINT_INTERVAL=30 # seconds between WAL checkpoints
+
+# Check captures against an in-memory set of the stored sources instead of
+# querying the db worker for each of them
+KNOWN_SOURCES=True
+
+# Load at most one capture per question and sampling period: '' (every
+# capture), 'day' or 'week'. Periods already covered in `views` are skipped.
+SAMPLING_PERIOD=os.getenv('SAMPLING_PERIOD', '')
+
+# Parser results kept by CDX content digest, so a capture identical to a page
+# already parsed is stored without being downloaded again
+DIGEST_CACHE_SIZE=100000
+
+# 'soup' (BeautifulSoup) or 'lxml' (precompiled XPath, see workers/xpath.py)
+PARSER_ENGINE=os.getenv('PARSER_ENGINE', 'soup')
 
 PARSER_OK = 'OK'
 PARSER_ERROR = 'ERROR'
@@ -28,10 +80,32 @@ PARSER_SYS_ERROR = 'SYSERR'
 PARSER_DATA_NOT_FOUND_ERROR = 'DATA_NOT_FOUND'
 PARSER_IMPRECISE_ERROR = 'IMPRECISE'
 
+# Page kinds, see the URL rules in workers/cdx.py
+PAGE_QUESTION = 'question'
+PAGE_TAGGED = 'tagged'
 
-CDX_PROCESS_COUNT=2
+# Rows expected from a page of each kind until parse results are available.
+# The controller loads the captures with the best yield first.
+PAGE_YIELD = {
+    PAGE_QUESTION: 1,
+    PAGE_TAGGED: 15,
+}
+
+# Local mirror made by the `snapshots` script or by download.py, see
+# `master.py --local`
+ROOT_DIR=os.getenv('ROOT_DIR', 'web.archive.org')
+
+CDX_PROCESS_COUNT=4
 LOADER_PROCESS_COUNT=16
+LOADER_CONCURRENCY=8 # in-flight requests per loader process
 PARSER_PROCESS_COUNT=5
+FILES_PROCESS_COUNT=4 # local file readers
+
+# Captures handed over to the loaders at once, the others wait in the
+# controller to be scheduled by expected yield. The actual limit is adapted
+# between 1 and LOADER_INFLIGHT, starting from GOVERNOR_START.
+LOADER_INFLIGHT=2*LOADER_PROCESS_COUNT*LOADER_CONCURRENCY
+GOVERNOR_START=LOADER_PROCESS_COUNT
 
 #
 # Data Extraction
@@ -39,3 +113,4 @@ PARSER_PROCESS_COUNT=5
 EXTRACT_DIR='data'
 EXTRACT_DATA_FILE='question.csv'
 EXTRACT_MANIFEST='MANIFEST'
+EXTRACT_PROCESS_COUNT=os.cpu_count()
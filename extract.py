@@ -1,65 +1,164 @@
 import os
+import re
 import sys
 import csv
 import time
+import hashlib
 
-from collections import defaultdict
+from functools import partial
+from multiprocessing import Pool
 
 from utils.db import Db
+from utils import columnar
 from config.constants import *
 
-if __name__ == "__main__":
-    manifest=os.path.join(EXTRACT_DIR, EXTRACT_MANIFEST)
-    db = Db(DB_URI, timeout=DB_TIMEOUT)
+YEAR=10**10 # A year in a YYYYMMDDhhmmss integer timestamp
 
-    stats={
-        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
-        'by-year': defaultdict(lambda: dict(count=0, filename=None, file=None)),
-    }
+MANIFEST_ENTRY_FMT='{filename}: {count:10d} {sha256}\n'
+MANIFEST_ENTRY_RE=re.compile(r'^(?P<filename>[^:]+): +(?P<count>[0-9]+)(?: (?P<sha256>[0-9a-f]+))?$')
 
-    def writer():
-        def _writer(year):
-            entry = stats['by-year'][year]
-            entry['filename'] = filename = str(year)+'.csv'
+def checksum(filepath):
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            sha256.update(chunk)
 
-            filepath=os.path.join(EXTRACT_DIR, filename)
-            entry['file'] = file = open(filepath, 'wt')
-            output = csv.writer(file)
-                
-            def _write(row):
-                date, *tail = row
-                new_year = date[0:4]
-                
-                if new_year != year:
-                    file.close()
-                    return _writer(new_year)(row)
+    return sha256.hexdigest()
 
+def export(year, binary=False):
+    """ Write the rows captured during `year` to `EXTRACT_DIR/<year>.csv`,
+        and to the columnar `EXTRACT_DIR/<year>.col` file if `binary` is set
+
+        Each year is exported by its own process, from its own read-only
+        connection. Return the manifest entries of the files written.
+    """
+    db = Db(DB_URI, timeout=DB_TIMEOUT)
+    entry = dict(count=0, filename=str(year)+'.csv')
+    filepath=os.path.join(EXTRACT_DIR, entry['filename'])
+    columns = columnar.Writer() if binary else None
+
+    file = None
+    try:
+        # A consistent snapshot: the crawler keeps writing meanwhile
+        with db.snapshot():
+            for row in db.questions(year*YEAR, (year+1)*YEAR):
+                if file is None:
+                    file = open(filepath, 'wt')
+                    output = csv.writer(file)
 
                 entry['count'] +=1
                 output.writerow(row)
+                if columns is not None:
+                    columns.append(row)
+    finally:
+        if file is not None:
+            file.close()
+        db.close()
+
+    if file is None:
+        return []
+
+    entry['sha256'] = checksum(filepath)
+    entries = [entry]
+
+    if columns is not None:
+        entry = dict(count=len(columns), filename=str(year)+'.col')
+        filepath=os.path.join(EXTRACT_DIR, entry['filename'])
+        columns.write(filepath)
+        entry['sha256'] = checksum(filepath)
+        entries.append(entry)
+
+    return entries
+
+def load_manifest(manifest):
+    """ Return the per-file entries of an existing manifest
+    """
+    files = {}
+    try:
+        with open(manifest, "rt") as f:
+            for line in f:
+                m = MANIFEST_ENTRY_RE.match(line.rstrip('\n'))
+                if m:
+                    entry = m.groupdict()
+                    entry['count'] = int(entry['count'])
+                    files[entry['filename']] = entry
+    except FileNotFoundError:
+        pass
+
+    return files
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--incremental",
+            help="Only rewrite the years changed since the last export",
+            action='store_true')
+    parser.add_argument("--columnar",
+            help="Also write a memory-mappable columnar file per year",
+            action='store_true')
+
+    return parser.parse_args()
 
-                return _write
-            return _write
-        
-        def _first(row):
-            date, *tail = row
-            year = date[0:4]
+if __name__ == "__main__":
+    args = parse_args()
 
-            return _writer(year)(row)
-            
-        return _first;
+    manifest=os.path.join(EXTRACT_DIR, EXTRACT_MANIFEST)
+    db = Db(DB_URI, timeout=DB_TIMEOUT)
 
+    stats={
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'files': {},
+    }
 
-    db.forEachQuestion(writer())
+    # Everything written up to this batch will be in the export
+    watermark = db.batch()
+    since = db.getMetadata('export.batch')
+
+    if args.incremental and since is not None:
+        stats['files'] = load_manifest(manifest)
+        years = db.changedYears(int(since), watermark)
+        if args.columnar:
+            # Also the years exported before without their columnar file
+            years = sorted(set(years).union(
+                int(filename[:-len('.csv')]) for filename in stats['files']
+                if filename.endswith('.csv') and not os.path.exists(
+                    os.path.join(EXTRACT_DIR, filename[:-len('.csv')]+'.col')
+                )
+            ))
+    else:
+        first, last = db.dateRange()
+        years = range(first//YEAR, last//YEAR+1) if first is not None else ()
+
+    files = stats['files']
+    with Pool(EXTRACT_PROCESS_COUNT) as pool:
+        for year, entries in zip(years, pool.map(partial(export, binary=args.columnar), years, chunksize=1)):
+            # Drop the files of the previous export for that year
+            for filename in [filename for filename in files if filename.startswith(str(year)+'.')]:
+                del files[filename]
+                if filename.endswith('.col') and not args.columnar:
+                    try:
+                        os.unlink(os.path.join(EXTRACT_DIR, filename))
+                    except FileNotFoundError:
+                        pass
+
+            for entry in entries:
+                files[entry['filename']] = entry
 
     with open(manifest, "wt") as  f:
         f.write('{date}\n'.format(date=stats['date']))
         f.write('\n')
 
-        byyear = stats['by-year']
-        for year in sorted(byyear.keys()):
-            entry = stats['by-year'][year]
+        for filename in sorted(files.keys()):
+            entry = files[filename]
+            if not entry.get('sha256'):
+                entry['sha256'] = checksum(os.path.join(EXTRACT_DIR, filename))
+
+            f.write(MANIFEST_ENTRY_FMT.format(**entry))
 
-            entry['file'].close()
-            f.write('{filename}: {count:10d}\n'.format(year=year, **entry))
+    db.close()
 
+    # The only write: no schema upgrade nor crawler setup from here
+    db = Db(DB_URI, mode='rw', timeout=DB_TIMEOUT, upgrade=False)
+    db.setMetadata('export.batch', watermark)
+    db.close()
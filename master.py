@@ -1,15 +1,29 @@
 import sys
+import time
+import heapq
+import random
+from itertools import count
+from threading import Thread
+from queue import Empty
+from collections import OrderedDict
 from pathlib import Path
-from multiprocessing import Process, Queue, SimpleQueue, JoinableQueue, Lock, Semaphore
+from multiprocessing import Process, Queue, SimpleQueue, JoinableQueue, Lock, Semaphore, Manager
 from utils.pm import ProcessManager
 
-from utils import notify
+from utils import notify, ByteBudget
 from utils.db import Db
-from utils.worker import worker
+from utils import packstore
+from utils.known import KnownSources, Coverage
+from utils.scheduler import Scheduler
+from utils.governor import Governor
+from utils.worker import worker, report
+from utils.batcher import push
 from workers.db import db
 from workers.cdx import cdx
 from workers.loader  import loader
 from workers.parser  import parser
+from workers.reader import reader
+from workers.files import files, lister
 from config.constants import *
 from config.commands import *
 
@@ -49,106 +63,477 @@ class State:
 
         self.running = False
 
-def controller(ctrl, db_queue, cdx_queue, loader_queue, parser_queue, sem):
+def controller(ctrl, db_queue, cdx_queue, loader_queue, parser_queue, sem, budget, partitions=CDX_PARTITIONS, resume=False, readers=0, offline=False, reparse=False):
     pending = {}
+    retries = {} # attempts left to the captures resumed from the frontier
+    parsing = set()
+    parsed = set() # STORE received before the matching PARSE
+    digests = {} # digest of the captures being loaded
+    kinds = {} # page kind of the captures being loaded
+    scheduler = Scheduler(PAGE_YIELD)
+    loading = 0 # captures handed over to the loaders
+    governor = Governor(GOVERNOR_START, 1, LOADER_INFLIGHT)
+    if offline:
+        # Local files: nothing to adapt to, and no crawl state to save
+        governor = Governor(LOADER_INFLIGHT, LOADER_INFLIGHT, LOADER_INFLIGHT)
+    timers = [] # (time, seq, capture) heap of the retries to come
+    seq = count()
+    results = OrderedDict() # digest -> (status, items), least recently used first
     cache = []
+    cached = set() # paths of the results in the cache
+    deadline = None
+
+    # Crawl state changes saved with the next commit. A CDX position is only
+    # saved once the db worker answered the checks sent before it.
+    journal = dict(add={}, remove=set())
+    marks = [] # (checks sent, position)
+    checks = [0, 0] # sent, answered
     stats = {
        'ttl': [0]*MAX_RETRY,
        'check': 0,
+       'known': 0,
+       'sampled': 0,
+       'dedup': 0,
        'commit': 0,
        'store': 0,
+       'bytes': 0,
+       'cdx': {},
+       'queued': 0,
+       'delayed': 0,
+       'limit': int(governor),
+       'pages': 0, # compressed bytes waiting for or in the parsers
+       'depth': {},
+       'yield': {},
     }
 
     state = State()
 
-    def _check(path, url):
-        key = path
-        if key not in pending:
-            stats['check'] += 1
-            db_queue.put((CHECK, path, url))
-        else:
-            _discard(path, url)
+    # Nothing is checked when the pages come from the pack store
+    checked = not reparse
+
+    known = KnownSources()
+    if KNOWN_SOURCES and checked:
+        db = Db(DB_URI, timeout=DB_TIMEOUT)
+        known.load(db)
+        db.close()
+        notify('KNOWN', len(known))
+
+    coverage = None
+    if SAMPLING_PERIOD and checked:
+        coverage = Coverage(SAMPLING_PERIOD)
+        db = Db(DB_URI, timeout=DB_TIMEOUT)
+        coverage.load(db)
+        db.close()
+        notify('COVERED', len(coverage))
+
+    def _sample(path):
+        if coverage is None or coverage.claim(path):
+            return True
+
+        stats['sampled'] += 1
+        return False
+
+    def _check(path, url, kind, digest=None):
+        _check_many([(path, url, kind, digest)])
+
+    def _check_many(items):
+        unknown = {}
+        for item in items:
+            path, url, *_ = item
+            if path in pending or path in unknown or path in cached:
+                _discard(path, url)
+            elif not _sample(path):
+                _settle(path)
+                _discard(path, url)
+            elif KNOWN_SOURCES and path in known:
+                # Most likely stored already, but the db worker confirms it
+                # in case of a fingerprint collision
+                stats['known'] += 1
+                unknown[path] = item
+            elif KNOWN_SOURCES:
+                # Certainly not stored yet
+                stats['check'] += 1
+                _load(*item)
+            else:
+                unknown[path] = item
+
+        if unknown:
+            stats['check'] += len(unknown)
+            checks[0] += 1
+            state['checking'] = checks[0] - checks[1]
+            db_queue.put((CHECK_MANY, list(unknown.values())))
 
     def _discard(path, url):
         sem.release()
 
-    def _load(path, url):
-        _retry(path, url)
+    # Answers of the db worker to CHECK
+    def _checked_load(path, url, kind, digest=None):
+        _load(path, url, kind, digest)
+        _answered()
+
+    def _checked_discard(path, url):
+        _stored(path)
+        _answered()
+
+    def _load_many(items, discarded):
+        for item in items:
+            _load(*item)
+
+        for path in discarded:
+            _stored(path)
+        _answered()
+
+    def _answered():
+        # Last, so the run can't end before the captures to load are counted
+        checks[1] += 1
+        state['checking'] = checks[0] - checks[1]
+
+    def _stored(path):
+        # Stored by a previous run, without any view count for the slot or
+        # it would not have been claimed: another capture may cover it
+        if coverage is not None:
+            coverage.release(path)
+        _settle(path)
+        sem.release()
+
+    def _settle(path):
+        # A capture resumed from the frontier that will not be loaded
+        if retries.pop(path, None) is not None:
+            _untrack(path)
+
+    def _load(path, url, kind, digest=None):
+        if digest is None:
+            # A retry: the digest was saved by the first attempt
+            digest = digests.get(path)
+
+        if digest in results:
+            # Same content as a page already parsed
+            if pending.pop(path, None) is not None:
+                _untrack(path)
+            retries.pop(path, None)
+            kinds.pop(path, None)
+            digests.pop(path, None)
+            _dedup(path, digest)
+            return
 
-    def _retry(path, url):
         key = path
-        ttl = pending.get(key, MAX_RETRY)
+        if key in pending:
+            ttl = pending[key]
+        else:
+            ttl = retries.pop(key, MAX_RETRY)
         ttl -= 1
         stats['ttl'][ttl] += 1
 
+        if digest:
+            digests[key] = digest
+
         if ttl == 0:
-            state['inloader'] -= 1
-            del pending[key]
+            pending.pop(key, None)
+            _untrack(path)
+            digests.pop(key, None)
+            kinds.pop(key, None)
+            if coverage is not None:
+                coverage.release(path)
             sem.release()
         else:
             state['inloader'] += 1
             pending[key] = ttl
-            loader_queue.put((path,url))
+            kinds[key] = kind
+            _track(path, url, kind, digests.get(key), ttl)
+            scheduler.push(kind, (path,url,kind))
+
+    def _track(path, url, kind, digest, ttl):
+        if offline:
+            return
+
+        journal['remove'].discard(path)
+        journal['add'][path] = (path, url, kind, digest, ttl)
+        _arm()
+
+    def _untrack(path):
+        if offline:
+            return
+
+        journal['add'].pop(path, None)
+        journal['remove'].add(path)
+        _arm()
+
+    def _mark(partition, resumeKey):
+        marks.append((checks[0], (*partition, resumeKey, resumeKey is None)))
+        _arm()
+
+    def _arm():
+        # Crawl state changes are saved even if no result comes meanwhile
+        nonlocal deadline
+
+        if deadline is None:
+            deadline = time.time() + CACHE_MAX_AGE
+
+    def _retry(path, url, kind, cause=RETRY_STATUS):
+        nonlocal loading
+
+        scheduler.record(kind, 0)
+        if cause != RETRY_STATUS:
+            governor.decrease()
+
+        ttl = pending.get(path, MAX_RETRY)
+        if ttl > 1:
+            # Exponential backoff with jitter, so the captures failed together
+            # are not all retried together
+            delay = min(RETRY_DELAY * 2**(MAX_RETRY - ttl - 1), MAX_SLEEP_TIME)
+            delay = random.uniform(delay/2, delay)
+            heapq.heappush(timers, (time.time() + delay, next(seq), (path, url, kind)))
+            state['delayed'] = stats['delayed'] = len(timers)
+
+        # The failed attempt is no longer in the loader
+        loading -= 1
+        state['inloader'] -= 1
+
+        if ttl <= 1:
+            # Out of retries
+            _load(path, url, kind)
+
+    def _gauges():
+        stats['pages'] = int(budget)
+        stats['depth'] = dict(
+            ctrl=ctrl.qsize(),
+            loader=loader_queue.qsize(),
+            parser=parser_queue.qsize(),
+            db=db_queue.qsize(),
+        )
+
+    def _wakeup():
+        now = time.time()
+        if not timers or timers[0][0] > now:
+            return
+
+        while timers and timers[0][0] <= now:
+            when, n, capture = heapq.heappop(timers)
+            _load(*capture)
+
+        state['delayed'] = stats['delayed'] = len(timers)
 
-    def _done(path):
+    def _done(path, latency):
+        nonlocal loading
+
+        if latency is not None:
+            governor.ok(latency)
         key = path
         pending.pop(key, None)
+        # The PARSE of the page came first on the same channel: a STORE still
+        # waiting for it will not be matched
+        parsed.discard(path)
+        loading -= 1
         state['inloader'] -= 1
         sem.release()
 
+    def _feed():
+        nonlocal loading
+
+        limit = stats['limit'] = int(governor)
+        while loading < limit and scheduler:
+            loader_queue.put(scheduler.pop())
+            loading += 1
+
+        stats['queued'] = len(scheduler)
+
     def _unlock():
         pass
 
+    def _batch(commands):
+        # One bad command must not drop the others of the envelope
+        for cmd, *args in commands:
+            try:
+                CMDS[cmd](*args)
+            except Exception as err:
+                report(err, stats)
+
     def _run():
         # notify('DEBUG', sem.get_value(), len(pending), loader_queue.qsize(), parser_queue.qsize())
-        cmd, *args = ctrl.get()
-        # notify('DO', cmd, *[arg[:10] for arg in args])
-        CMDS[cmd](*args)
+        wakeup = [t for t in (deadline, timers and timers[0][0]) if t]
+        timeout = None
+        if wakeup:
+            timeout = max(0, min(wakeup) - time.time())
+
+        try:
+            cmd, *args = ctrl.get(timeout=timeout)
+        except Empty:
+            pass
+        else:
+            # notify('DO', cmd, *[arg[:10] for arg in args])
+            CMDS[cmd](*args)
+
+        _wakeup()
+        _feed()
+        _gauges()
+
+        if deadline is not None and time.time() >= deadline:
+            _commit()
 
         return not state.running
 
-    def _cdx(resumeKey):
-        if resumeKey is None:
+    def _cdx(partition, resumeKey):
+        if resumeKey is not None:
+            stats['cdx']["{}-{}".format(*partition)] += 1
+            _mark(partition, resumeKey)
+
+        notify('CDX', partition, resumeKey)
+        cdx_queue.put((partition, resumeKey))
+
+    def _cdx_done(partition):
+        notify('CDX', partition, 'done')
+        stats['cdx']["{}-{}".format(*partition)] = 'done'
+        _mark(partition, None)
+        state['cdx'] -= 1
+        if not state['cdx']:
             state.stop()
+
+    def _resumed():
+        notify('RESUMED')
+        state['resume'] = 0
+
+    def _eof():
+        state['readers'] -= 1
+        if not offline:
+            # Sent by the pack store reader after all its PARSE commands. In
+            # local mode, the files workers may still have some to send.
+            parsed.clear()
+
+    def _parse(path, size):
+        # The page itself was sent by the loader directly to the parsers,
+        # so its result may already have been stored
+        stats['bytes'] += size
+        if path in parsed:
+            parsed.remove(path)
         else:
-            notify('CDX', resumeKey)
-            cdx_queue.put(resumeKey)
+            parsing.add(path)
+            state['inparser'] = len(parsing)
 
-    def _parse(path, text):
-        state['inparser'] += 1
-        parser_queue.put((path, text))
+    def _parser_done(path):
+        if path in parsing:
+            parsing.remove(path)
+            state['inparser'] = len(parsing)
+        else:
+            parsed.add(path)
 
-    def _parser_done():
-        state['inparser'] -= 1
+    def _dedup(path, digest):
+        status, items = results[digest]
+        results.move_to_end(digest)
+        stats['dedup'] += 1
+
+        # Only the capture date differs
+        date = path[:14]
+        _cache(path, status, tuple(dict(item, date=date) for item in items))
+        sem.release()
 
     def _store(path, status,  items=()):
         notify('STORE', path)
+
+        if coverage is not None and status != PARSER_OK:
+            coverage.release(path)
+
+        kind = kinds.pop(path, None)
+        if kind is not None:
+            scheduler.record(kind, len(items))
+            stats['yield'][kind] = round(scheduler.expected(kind), 2)
+
+        digest = digests.pop(path, None)
+        if digest and status != PARSER_SYS_ERROR:
+            results[digest] = (status, items)
+            if len(results) > DIGEST_CACHE_SIZE:
+                results.popitem(last=False)
+
+        _cache(path, status, items)
+        _parser_done(path)
+
+    def _cache(path, status, items):
+        if checked:
+            known.add(path)
+        _arm()
         cache.append((path, status, items))
+        cached.add(path)
         stats['store'] += 1
 
         if len(cache) > CACHE_MAX_SIZE:
             _commit()
 
     def _commit():
-        db_queue.put((COMMIT, cache))
+        nonlocal deadline
+
+        positions = [position for sent, position in marks if sent <= checks[1]]
+        marks[:] = [mark for mark in marks if mark[0] > checks[1]]
+        frontier = dict(
+            add=list(journal['add'].values()),
+            remove=list(journal['remove']),
+            positions=positions,
+        )
+        journal['add'].clear()
+        journal['remove'].clear()
+
+        db_queue.put((COMMIT, cache[:], frontier))
         del cache[:]
+        cached.clear()
+        deadline = None
         stats['commit'] += 1
 
+    def _resume(frontier):
+        """ Push the captures left in the frontier, like a CDX worker
+        """
+        push(ctrl, sem, frontier)
+        ctrl.put((RESUMED,))
+
     CMDS = {
+        BATCH: _batch,
         CDX: _cdx,
+        CDX_DONE: _cdx_done,
         CHECK: _check,
-        DISCARD: _discard,
+        CHECK_MANY: _check_many,
+        DISCARD: _checked_discard,
         DONE: _done,
-        LOAD: _load,
+        EOF: _eof,
+        LOAD: _checked_load,
+        LOAD_MANY: _load_many,
         PARSE: _parse,
+        RESUMED: _resumed,
         RETRY: _retry,
         STORE: _store,
         UNLOCK: _unlock,
     }
 
-    cdx_queue.put(None)
+    # Processes pushing pages straight to the parsers, until EOF
+    state['readers'] = readers
+
+    positions = {}
+    if resume:
+        # Continue the CDX enumeration from the saved positions, and load
+        # again the captures that were not stored
+        db = Db(DB_URI, timeout=DB_TIMEOUT)
+        positions = db.positions()
+        frontier = []
+        for path, url, kind, digest, ttl in db.frontier():
+            retries[path] = ttl + 1 # the interrupted attempt does not count
+            frontier.append((path, url, kind, digest))
+        db.close()
+        notify('FRONTIER', len(frontier))
+
+        state['resume'] = 1
+        Thread(target=_resume, args=(frontier,), daemon=True).start()
+
+    for partition in partitions:
+        resumeKey, complete = positions.get(partition, (None, False))
+        if complete:
+            stats['cdx']["{}-{}".format(*partition)] = 'done'
+            continue
+
+        stats['cdx']["{}-{}".format(*partition)] = 0
+        state['cdx'] += 1
+        cdx_queue.put((partition, resumeKey))
+
+    if not state['cdx']:
+        state.stop()
     worker(_run, "controller", stats)
     _commit()
+    db_queue.put((EOF,))
 
 
 def stdin():
@@ -164,35 +549,84 @@ def parse_args():
     import argparse
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("--stdin", help="Read path from stdin",
+    parser.add_argument("--local", help="Ingest the local mirror in ROOT_DIR instead of the Wayback Machine",
+            action='store_true')
+    parser.add_argument("--stdin", help="Read path from stdin (implies --local)",
             dest='reader',
             default=glob, action='store_const', const=stdin)
+    parser.add_argument("--resume", help="Continue the crawl where the previous run stopped",
+            action='store_true')
+    parser.add_argument("--reparse", help="Parse again the pages of the store in PACK_STORE_DIR, offline",
+            action='store_true')
 
 
     args = parser.parse_args()
+    if args.reader is stdin:
+        args.local = True
+    if args.reparse and not PACK_STORE_DIR:
+        parser.error("--reparse needs the pack store in PACK_STORE_DIR")
+
     return args
 
 if __name__ == '__main__':
     args = parse_args()
 
+    # Create or upgrade the database before the workers open it
+    setup = Db(DB_URI, mode='rwc', timeout=DB_TIMEOUT)
+    if not (args.resume or args.reparse or args.local):
+        # A new crawl: its frontier and positions replace the old ones
+        setup.clearFrontier()
+    setup.close()
+
     loader_queue = Queue()
     parser_queue = Queue()
     cdx_queue = Queue()
     db_queue = Queue()
     ctrl = Queue()
     sem = Semaphore(QUEUE_LENGTH)
-
-    pm = ProcessManager(
-        Process(target=controller, args=(ctrl, db_queue, cdx_queue, loader_queue, parser_queue, sem)),
-        Process(target=db, args=(ctrl, db_queue)),
-        *[Process(target=cdx, args=(ctrl,cdx_queue, sem, URL_PREFIX)) for n in range(CDX_PROCESS_COUNT)],
-        *[Process(target=loader, args=(ctrl,loader_queue)) for n in range(LOADER_PROCESS_COUNT)],
-        *[Process(target=parser, args=(ctrl,parser_queue)) for n in range(PARSER_PROCESS_COUNT)],
-    )
+    budget = ByteBudget(PAGE_BYTES_BUDGET)
+
+    if args.reparse:
+        # Offline: the pages come from the store instead of the network
+        pm = ProcessManager(
+            Process(target=controller, args=(ctrl, db_queue, cdx_queue, loader_queue, parser_queue, sem, budget), kwargs=dict(partitions=(), readers=1, reparse=True)),
+            Process(target=db, args=(ctrl, db_queue)),
+            Process(target=reader, args=(ctrl,parser_queue,budget)),
+            *[Process(target=parser, args=(ctrl,parser_queue,budget)) for n in range(PARSER_PROCESS_COUNT)],
+        )
+    elif args.local:
+        # Offline: the pages come from local files listed by this process
+        pm = ProcessManager(
+            Process(target=controller, args=(ctrl, db_queue, cdx_queue, loader_queue, parser_queue, sem, budget), kwargs=dict(partitions=(), readers=1, offline=True)),
+            Process(target=db, args=(ctrl, db_queue)),
+            *[Process(target=files, args=(ctrl,loader_queue,parser_queue,budget)) for n in range(FILES_PROCESS_COUNT)],
+            *[Process(target=parser, args=(ctrl,parser_queue,budget)) for n in range(PARSER_PROCESS_COUNT)],
+        )
+    else:
+        # Bodies in the pack store, indexed once and shared by all the
+        # loaders so each new body is written by only one of them
+        digests = None
+        if PACK_STORE_DIR:
+            digests = Manager().dict(dict.fromkeys(packstore.index(PACK_STORE_DIR), True))
+        pm = ProcessManager(
+            Process(target=controller, args=(ctrl, db_queue, cdx_queue, loader_queue, parser_queue, sem, budget), kwargs=dict(resume=args.resume)),
+            Process(target=db, args=(ctrl, db_queue)),
+            *[Process(target=cdx, args=(ctrl,cdx_queue, sem, URL_PREFIX)) for n in range(CDX_PROCESS_COUNT)],
+            *[Process(target=loader, args=(ctrl,loader_queue,parser_queue,budget), kwargs=dict(digests=digests)) for n in range(LOADER_PROCESS_COUNT)],
+            *[Process(target=parser, args=(ctrl,parser_queue,budget)) for n in range(PARSER_PROCESS_COUNT)],
+        )
 
     try:
         pm.start()
+        if args.local and not args.reparse:
+            lister(ctrl, sem, args.reader())
 
         pm[0].join()
+        pm[1].join() # until the last commit is written
+        failed = pm.failed()
     finally:
         pm.terminate()
+
+    if failed:
+        notify('FAILED', *[worker.name for worker in failed])
+        sys.exit(1)
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import queue
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config.commands import BATCH
+
+def commands(q, count=None, timeout=5):
+    """ Get the commands put on the queue `q`, unpacking the BATCH envelopes
+
+        Wait for `count` commands, or return what is already there.
+    """
+    result = []
+    deadline = time.time() + timeout
+    while count is None or len(result) < count:
+        try:
+            cmd = q.get(timeout=max(0, deadline - time.time()) if count is not None else 0.2)
+        except queue.Empty:
+            if count is not None:
+                raise AssertionError("Got {} commands out of {}: {}".format(len(result), count, result))
+            break
+
+        if cmd[0] == BATCH:
+            result.extend(cmd[1])
+        else:
+            result.append(cmd)
+
+    return result
+
+@pytest.fixture
+def server():
+    """ Local HTTP server answering with `server.handler(request)`, a
+        (status, body) function
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, body = httpd.handler(self)
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.daemon_threads = True
+    httpd.handler = lambda request: (200, 'OK')
+    httpd.url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    yield httpd
+
+    httpd.shutdown()
+    httpd.server_close()
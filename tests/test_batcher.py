@@ -0,0 +1,62 @@
+import queue
+import threading
+
+from utils.batcher import Batcher, push
+from config.commands import *
+
+def test_full_envelope():
+    q = queue.Queue()
+    batcher = Batcher(q, size=3, age=60)
+    for n in range(4):
+        batcher.put((DONE, 'p{}'.format(n), None))
+
+    assert q.get(timeout=1) == (BATCH, [(DONE, 'p0', None), (DONE, 'p1', None), (DONE, 'p2', None)])
+    assert q.empty()
+
+    batcher.flush()
+    assert q.get(timeout=1) == (BATCH, [(DONE, 'p3', None)])
+
+def test_envelope_age():
+    q = queue.Queue()
+    batcher = Batcher(q, size=100, age=0.1)
+    batcher.put((DONE, 'p', None))
+
+    # Without any other command
+    assert q.get(timeout=2) == (BATCH, [(DONE, 'p', None)])
+
+def test_no_empty_envelope():
+    q = queue.Queue()
+    batcher = Batcher(q, size=100, age=60)
+    batcher.flush()
+
+    assert q.empty()
+
+def test_push():
+    q = queue.Queue()
+    sem = threading.Semaphore(10)
+    push(q, sem, range(5), size=2)
+
+    assert [q.get(timeout=1) for n in range(3)] == [
+        (CHECK_MANY, [0, 1]),
+        (CHECK_MANY, [2, 3]),
+        (CHECK_MANY, [4]),
+    ]
+    # One slot per capture
+    assert sem._value == 5
+
+def test_push_flushes_before_blocking():
+    q = queue.Queue()
+    sem = threading.Semaphore(2)
+    done = threading.Event()
+    def _push():
+        push(q, sem, range(3), size=10)
+        done.set()
+    threading.Thread(target=_push, daemon=True).start()
+
+    # The two captures admitted are not held while waiting for a slot
+    assert q.get(timeout=1) == (CHECK_MANY, [0, 1])
+    assert not done.wait(0.1)
+
+    sem.release()
+    assert done.wait(1)
+    assert q.get(timeout=1) == (CHECK_MANY, [2])
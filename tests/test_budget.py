@@ -0,0 +1,79 @@
+import time
+import queue
+import threading
+import multiprocessing
+
+from utils import ByteBudget, pack
+from workers.parser import parser
+from config.commands import *
+
+from conftest import commands
+
+def acquire_later(budget, size):
+    """ Acquire `size` bytes from a thread, return the event set once done
+    """
+    done = threading.Event()
+    def _acquire():
+        budget.acquire(size)
+        done.set()
+    threading.Thread(target=_acquire, daemon=True).start()
+
+    return done
+
+def test_acquire_blocks_until_released():
+    budget = ByteBudget(100)
+    budget.acquire(60)
+    assert int(budget) == 60
+
+    done = acquire_later(budget, 50)
+    assert not done.wait(0.2)
+
+    budget.release(60)
+    assert done.wait(5)
+    assert int(budget) == 50
+
+def test_oversized_page_goes_through_alone():
+    budget = ByteBudget(100)
+    budget.acquire(10)
+
+    done = acquire_later(budget, 500)
+    assert not done.wait(0.2)
+
+    budget.release(10)
+    assert done.wait(5)
+    assert int(budget) == 500
+
+def _hold(budget, size, delay):
+    budget.acquire(size)
+    time.sleep(delay)
+    budget.release(size)
+
+def test_shared_between_processes():
+    budget = ByteBudget(100)
+    process = multiprocessing.Process(target=_hold, args=(budget, 80, 0.5))
+    process.start()
+    try:
+        deadline = time.time() + 5
+        while not int(budget) and time.time() < deadline:
+            time.sleep(0.01)
+        assert int(budget) == 80
+
+        start = time.time()
+        budget.acquire(40)
+        assert time.time() - start > 0.2
+        assert int(budget) == 40
+    finally:
+        process.join(5)
+
+def test_parsers_release_the_page_bytes():
+    ctrl, pages = queue.Queue(), queue.Queue()
+    budget = ByteBudget(1 << 20)
+    threading.Thread(target=parser, args=(ctrl, pages, budget), daemon=True).start()
+
+    data = pack('<html></html>')
+    budget.acquire(len(data))
+    pages.put(('20100101000000/stackoverflow.com/questions/1', 'question', data))
+
+    (cmd,) = commands(ctrl, 1)
+    assert cmd[0] == STORE
+    assert int(budget) == 0
@@ -0,0 +1,172 @@
+import queue
+import threading
+import urllib.parse
+
+import pytest
+
+import workers.cdx
+from workers.cdx import cdx, classify
+from config.commands import *
+from config.constants import PAGE_QUESTION, PAGE_TAGGED
+
+from conftest import commands
+
+# CDX answers by (from, resumeKey): captures as (timestamp, original), and
+# the key of the next page
+PAGES = {
+    ('2010', ''): ([
+        ('20100101000000', 'http://stackoverflow.com/questions/1/a'),
+        ('20100102000000', 'http://stackoverflow.com/questions/ask'),
+    ], 'key 1'),
+    ('2010', 'key 1'): ([
+        ('20100103000000', 'http://stackoverflow.com/questions/2/b'),
+    ], None),
+    ('2011', ''): ([
+        ('20110101000000', 'http://stackoverflow.com/questions/tagged/python'),
+    ], None),
+}
+
+@pytest.fixture
+def api(server, tmp_path, monkeypatch):
+    requests = []
+    def handler(request):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(request.path).query))
+        requests.append(params)
+        captures, resumeKey = PAGES[(params['from'], params.get('resumeKey', ''))]
+        lines = ['{} {} 200 DIGEST{}'.format(timestamp, original, n) for n, (timestamp, original) in enumerate(captures)]
+        if resumeKey is not None:
+            lines += ['', urllib.parse.quote_plus(resumeKey)]
+        return (200, '\n'.join(lines) + '\n')
+
+    server.handler = handler
+    server.requests = requests
+    monkeypatch.setattr(workers.cdx, 'CDX_API_ENDPOINT', server.url + '/cdx')
+    monkeypatch.setattr(workers.cdx, 'CDX_INDEX_URI', str(tmp_path / 'cdx.db'))
+
+    return server
+
+def start():
+    ctrl, partitions = queue.Queue(), queue.Queue()
+    threading.Thread(
+        target=cdx, args=(ctrl, partitions, threading.Semaphore(100), 'stackoverflow.com/questions/'),
+        daemon=True
+    ).start()
+
+    return ctrl, partitions
+
+def until(ctrl, *kinds):
+    """ Get the commands up to the first of the given kinds, included
+    """
+    result = []
+    while not result or result[-1][0] not in kinds:
+        result.extend(commands(ctrl, 1))
+
+    return result
+
+def checked(cmds):
+    return [item[0] for cmd in cmds if cmd[0] == CHECK_MANY for item in cmd[1]]
+
+@pytest.mark.parametrize('original, expected', [
+    ('http://stackoverflow.com/questions/123', ('question', PAGE_QUESTION)),
+    ('http://stackoverflow.com/questions/123/some-title', ('question', PAGE_QUESTION)),
+    ('http://stackoverflow.com/questions/123?sort=votes', ('question', PAGE_QUESTION)),
+    ('http://stackoverflow.com/questions/tagged/python', ('tagged', PAGE_TAGGED)),
+    ('http://stackoverflow.com/questions/tagged/c%23?page=2', ('tagged', PAGE_TAGGED)),
+    ('http://stackoverflow.com/questions/ask', ('ask', None)),
+    ('http://stackoverflow.com/questions/ask?title=x', ('ask', None)),
+    ('http://stackoverflow.com/feeds/question/123', ('feed', None)),
+    ('http://stackoverflow.com/questions/tagged/python?type=rss', ('feed', None)),
+    ('http://stackoverflow.com/questions/tagged/', ('other', None)),
+    ('http://stackoverflow.com/questions?sort=newest', ('other', None)),
+    ('http://stackoverflow.com/questions/123abc', ('other', None)),
+])
+def test_classify(original, expected):
+    assert classify(original) == expected
+
+def test_skipped_captures_take_no_slot(api):
+    sem = threading.Semaphore(1)
+    ctrl, partitions = queue.Queue(), queue.Queue()
+    threading.Thread(
+        target=cdx, args=(ctrl, partitions, sem, 'stackoverflow.com/questions/'),
+        daemon=True
+    ).start()
+
+    # The ask page of the first page does not block the worker on the
+    # semaphore, and the question is pushed with its kind
+    partitions.put((('2010', '2010'), None))
+    cmds = until(ctrl, CDX, CDX_DONE)
+    assert [item[2] for cmd in cmds if cmd[0] == CHECK_MANY for item in cmd[1]] == [PAGE_QUESTION]
+    assert not sem.acquire(False)
+
+def test_partition_pages(api):
+    ctrl, partitions = start()
+
+    partitions.put((('2010', '2010'), None))
+    cmds = until(ctrl, CDX, CDX_DONE)
+    assert cmds[-1] == (CDX, ('2010', '2010'), 'key 1')
+    # The captures are pushed before the next key
+    assert checked(cmds) == ['20100101000000/stackoverflow.com/questions/1/a']
+
+    partitions.put((('2010', '2010'), 'key 1'))
+    cmds = until(ctrl, CDX, CDX_DONE)
+    assert cmds[-1] == (CDX_DONE, ('2010', '2010'))
+    assert checked(cmds) == ['20100103000000/stackoverflow.com/questions/2/b']
+
+    assert [(params['from'], params['to'], params.get('resumeKey')) for params in api.requests] == [
+        ('2010', '2010', None),
+        ('2010', '2010', 'key 1'),
+    ]
+
+def test_partitions_are_independent(api):
+    ctrl, partitions = start()
+
+    partitions.put((('2010', '2010'), None))
+    partitions.put((('2011', '2011'), None))
+    cmds = until(ctrl, CDX, CDX_DONE)
+    cmds += until(ctrl, CDX, CDX_DONE)
+
+    assert (CDX, ('2010', '2010'), 'key 1') in cmds
+    assert (CDX_DONE, ('2011', '2011')) in cmds
+    assert checked(cmds) == [
+        '20100101000000/stackoverflow.com/questions/1/a',
+        '20110101000000/stackoverflow.com/questions/tagged/python',
+    ]
+
+def test_failed_page_is_queued_again(api):
+    api.handler = lambda request: (503, 'Busy')
+    ctrl, partitions = start()
+
+    partitions.put((('2010', '2010'), 'key 1'))
+    cmds = until(ctrl, CDX, CDX_DONE)
+    assert cmds[-1] == (CDX, ('2010', '2010'), 'key 1')
+    assert not checked(cmds)
+
+def test_indexed_pages_are_replayed(api):
+    ctrl, partitions = start()
+    partitions.put((('2010', '2010'), None))
+    until(ctrl, CDX, CDX_DONE)
+
+    # A new worker, as in another run, replays the first page from the
+    # index and resumes at the saved key
+    ctrl, partitions = start()
+    partitions.put((('2010', '2010'), None))
+    cmds = until(ctrl, CDX, CDX_DONE)
+    assert cmds[-1] == (CDX, ('2010', '2010'), 'key 1')
+    assert checked(cmds) == ['20100101000000/stackoverflow.com/questions/1/a']
+    assert len(api.requests) == 1
+
+    # The digests are replayed too
+    (item,) = [item for cmd in cmds if cmd[0] == CHECK_MANY for item in cmd[1]]
+    assert item[3] == 'DIGEST0'
+
+def test_complete_partitions_are_not_fetched(api):
+    ctrl, partitions = start()
+    partitions.put((('2011', '2011'), None))
+    until(ctrl, CDX, CDX_DONE)
+
+    ctrl, partitions = start()
+    partitions.put((('2011', '2011'), None))
+    cmds = until(ctrl, CDX, CDX_DONE)
+    assert cmds[-1] == (CDX_DONE, ('2011', '2011'))
+    assert checked(cmds) == ['20110101000000/stackoverflow.com/questions/tagged/python']
+    assert len(api.requests) == 1
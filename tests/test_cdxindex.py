@@ -0,0 +1,66 @@
+import sqlite3
+
+from utils.cdxindex import CdxIndex, questionid
+
+def capture(timestamp, original, statuscode='200', digest=None):
+    return dict(timestamp=timestamp, original=original, statuscode=statuscode, digest=digest)
+
+def test_questionid():
+    assert questionid('http://stackoverflow.com/questions/123/title') == 123
+    assert questionid('http://stackoverflow.com/questions/tagged/python') == 0
+
+def test_position(tmp_path):
+    index = CdxIndex(str(tmp_path / 'cdx.db'))
+    assert index.position(('2010', '2010')) == (None, False)
+
+    index.add(('2010', '2010'), [], 'key 1')
+    assert index.position(('2010', '2010')) == ('key 1', False)
+
+    index.add(('2010', '2010'), [], None)
+    assert index.position(('2010', '2010')) == (None, True)
+    assert index.position(('2011', '2011')) == (None, False)
+
+def test_captures(tmp_path):
+    index = CdxIndex(str(tmp_path / 'cdx.db'))
+    index.add(('2010', '2010'), [
+        capture('20100301000000', 'http://stackoverflow.com/questions/2/b', digest='B'),
+        capture('20100101000000', 'http://stackoverflow.com/questions/1/a', digest='A'),
+    ], 'key 1')
+    index.add(('2011', '2011'), [
+        capture('20110101000000', 'http://stackoverflow.com/questions/1/a', '404'),
+    ], None)
+
+    # By timestamp within the partition
+    assert [item['timestamp'] for item in index.captures(('2010', '2010'))] == ['20100101000000', '20100301000000']
+    assert list(index.captures(('2010', '2010')))[0] == capture('20100101000000', 'http://stackoverflow.com/questions/1/a', digest='A')
+
+    # By question id across partitions
+    assert [(item['timestamp'], item['statuscode']) for item in index.question(1)] == [
+        ('20100101000000', '200'),
+        ('20110101000000', '404'),
+    ]
+
+def test_pages_fetched_again(tmp_path):
+    index = CdxIndex(str(tmp_path / 'cdx.db'))
+    items = [capture('20100101000000', 'http://stackoverflow.com/questions/1/a')]
+    index.add(('2010', '2010'), items, 'key 1')
+    index.add(('2010', '2010'), items, 'key 1')
+
+    assert len(list(index.captures(('2010', '2010')))) == 1
+
+def test_index_without_digests(tmp_path):
+    db = sqlite3.connect(str(tmp_path / 'cdx.db'))
+    db.executescript("""
+        CREATE TABLE captures (
+            question INT NOT NULL,
+            timestamp INT NOT NULL,
+            original TEXT NOT NULL,
+            statuscode TEXT NOT NULL,
+            PRIMARY KEY(question, timestamp, original)
+        ) WITHOUT ROWID;
+        INSERT INTO captures VALUES(1, 20100101000000, 'http://stackoverflow.com/questions/1/a', '200');
+    """)
+    db.close()
+
+    index = CdxIndex(str(tmp_path / 'cdx.db'))
+    assert index.question(1) == [capture('20100101000000', 'http://stackoverflow.com/questions/1/a')]
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from utils import columnar
+
+ROWS = [
+    ('20100101000000', 1, 10, 'algorithm', 'python'),
+    ('20100612000000', 2, 20, 'c++'),
+    ('20100701000000', 3, 0),
+    ('20101231235959', 4, 2**40, 'python', 'c#'),
+]
+
+def test_roundtrip(tmp_path):
+    writer = columnar.Writer()
+    for row in ROWS:
+        writer.append(row)
+    assert len(writer) == len(ROWS)
+    writer.write(str(tmp_path / '2010.col'))
+
+    reader = columnar.Reader(str(tmp_path / '2010.col'))
+    assert len(reader) == len(ROWS)
+    assert [reader.row(n) for n in range(len(reader))] == ROWS
+    assert list(reader['question']) == [1, 2, 3, 4]
+    assert sorted(reader.tags) == ['algorithm', 'c#', 'c++', 'python']
+
+def test_aligned_columns(tmp_path):
+    writer = columnar.Writer()
+    for row in ROWS:
+        writer.append(row)
+    writer.write(str(tmp_path / '2010.col'))
+
+    data = (tmp_path / '2010.col').read_bytes()
+    assert data.startswith(columnar.MAGIC)
+    start = len(columnar.MAGIC)
+    size = int.from_bytes(data[start:start+8], 'little')
+    header = json.loads(data[start+8:start+8+size])
+    assert header['rows'] == len(ROWS)
+    for name, column in header['columns'].items():
+        assert column['offset'] % columnar.ALIGN == 0, name
+
+def test_empty(tmp_path):
+    columnar.Writer().write(str(tmp_path / 'empty.col'))
+
+    reader = columnar.Reader(str(tmp_path / 'empty.col'))
+    assert len(reader) == 0
+    assert reader.tags == []
+
+def test_not_columnar(tmp_path):
+    (tmp_path / '2010.csv').write_bytes(b'20100101000000,1,10,python\n')
+    with pytest.raises(ValueError):
+        columnar.Reader(str(tmp_path / '2010.csv'))
@@ -0,0 +1,509 @@
+import time
+import queue
+import threading
+
+import pytest
+
+import master
+from utils import ByteBudget
+from utils.db import Db, fingerprint
+from config.commands import *
+from config.constants import PARSER_SYS_ERROR
+
+from conftest import commands
+
+class Controller:
+    """ Controller running in a thread, with plain queues for the workers
+
+        No CDX partition: the run ends after EOF once nothing is in flight.
+    """
+    def __init__(self, dbpath, **kwargs):
+        self.ctrl = queue.Queue()
+        self.db = queue.Queue()
+        self.cdx = queue.Queue()
+        self.loader = queue.Queue()
+        self.parser = queue.Queue()
+        self.sem = threading.Semaphore(1000)
+        self.budget = ByteBudget(1 << 20)
+
+        kwargs.setdefault('partitions', ())
+        kwargs.setdefault('readers', 1)
+        self.thread = threading.Thread(target=master.controller, args=(
+            self.ctrl, self.db, self.cdx, self.loader, self.parser, self.sem, self.budget,
+        ), kwargs=kwargs, daemon=True)
+        self.thread.start()
+
+    def put(self, *cmds):
+        for cmd in cmds:
+            self.ctrl.put(cmd)
+
+    def stop(self, timeout=5):
+        self.ctrl.put((EOF,))
+        self.thread.join(timeout)
+        assert not self.thread.is_alive(), "The controller did not stop"
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def commits(self):
+        """ Return the (entries, frontier) of the COMMITs sent to the db worker
+        """
+        return [tuple(cmd[1:]) for cmd in commands(self.db) if cmd[0] == COMMIT]
+
+    def committed(self):
+        """ Return the entries of the COMMIT sent to the db worker
+        """
+        entries = []
+        for cmd in commands(self.db):
+            if cmd[0] == COMMIT:
+                entries.extend(cmd[1])
+
+        return entries
+
+@pytest.fixture
+def dbpath(tmp_path, monkeypatch):
+    path = str(tmp_path / 'questions.db')
+    Db(path, mode='rwc')
+    monkeypatch.setattr(master, 'DB_URI', path)
+
+    return path
+
+@pytest.fixture
+def controller(dbpath):
+    return lambda **kwargs: Controller(dbpath, **kwargs)
+
+def errors(capsys):
+    return [line for line in capsys.readouterr().out.splitlines() if ' ERROR ' in line]
+
+def test_parse_then_store(controller, capsys):
+    c = controller()
+    c.put((PARSE, 'p', 10), (EOF,))
+    c.thread.join(0.5)
+    assert c.running() # the page is still in the parsers
+
+    c.put((STORE, 'p', 'OK', ()))
+    c.thread.join(5)
+    assert not c.running()
+    assert c.committed() == [('p', 'OK', ())]
+    assert not errors(capsys)
+
+def test_store_before_parse(controller, capsys):
+    # A parser can report before the loader's PARSE reaches the controller
+    c = controller()
+    c.put((STORE, 'p', 'OK', ()), (PARSE, 'p', 10))
+    c.stop()
+
+    assert c.committed() == [('p', 'OK', ())]
+    assert not errors(capsys)
+
+def test_store_before_parse_in_batches(controller, capsys):
+    c = controller()
+    c.put(
+        (BATCH, [(STORE, 'p1', 'OK', ()), (STORE, 'p2', 'OK', ())]),
+        (BATCH, [(PARSE, 'p1', 10), (PARSE, 'p2', 10), (PARSE, 'p3', 10)]),
+    )
+    c.put((EOF,))
+    c.thread.join(0.5)
+    assert c.running() # p3 is still in the parsers
+
+    c.put((STORE, 'p3', 'OK', ()))
+    c.thread.join(5)
+    assert not c.running()
+    assert sorted(path for path, *_ in c.committed()) == ['p1', 'p2', 'p3']
+    assert not errors(capsys)
+
+def test_retried_capture_releases_its_loader_slot(controller, monkeypatch, capsys):
+    monkeypatch.setattr(master, 'RETRY_DELAY', 0.01)
+    c = controller()
+    c.put((CHECK_MANY, [('p', 'url', 'question', None)]))
+    assert c.loader.get(timeout=5) == ('p', 'url', 'question')
+
+    c.put((RETRY, 'p', 'url', 'question', master.RETRY_STATUS))
+    assert c.loader.get(timeout=5) == ('p', 'url', 'question')
+
+    c.put((PARSE, 'p', 10), (DONE, 'p', 0.1), (STORE, 'p', 'OK', ()))
+    c.stop()
+
+    assert c.committed() == [('p', 'OK', ())]
+    assert not errors(capsys)
+
+def test_known_sources_are_confirmed_by_the_db(dbpath, controller, monkeypatch):
+    import utils.known
+
+    stored = '20100101000000/stackoverflow.com/questions/1'
+    Db(dbpath, mode='rw').write([(stored, 'OK', ())])
+
+    # Every path collides with the stored one
+    monkeypatch.setattr(utils.known, 'fingerprint', lambda path: fingerprint(stored))
+
+    c = controller()
+    c.put((CHECK_MANY, [
+        (stored, 'url1', 'question', None),
+        ('20100101000000/stackoverflow.com/questions/2', 'url2', 'question', None),
+    ]))
+
+    # Both are hits, none is loaded or discarded before the db answers
+    (cmd,) = commands(c.db, 1)
+    assert cmd[0] == CHECK_MANY
+    assert [item[0] for item in cmd[1]] == [stored, '20100101000000/stackoverflow.com/questions/2']
+    assert c.loader.empty()
+
+    c.put((LOAD_MANY, [('20100101000000/stackoverflow.com/questions/2', 'url2', 'question', None)], [stored]))
+    assert c.loader.get(timeout=5) == ('20100101000000/stackoverflow.com/questions/2', 'url2', 'question')
+
+    c.put(
+        (PARSE, '20100101000000/stackoverflow.com/questions/2', 10),
+        (DONE, '20100101000000/stackoverflow.com/questions/2', 0.1),
+        (STORE, '20100101000000/stackoverflow.com/questions/2', 'OK', ()),
+    )
+    c.stop()
+
+def test_unknown_sources_are_loaded_without_the_db(controller):
+    c = controller()
+    c.put((CHECK_MANY, [('20100101000000/stackoverflow.com/questions/2', 'url2', 'question', None)]))
+
+    assert c.loader.get(timeout=5) == ('20100101000000/stackoverflow.com/questions/2', 'url2', 'question')
+    assert c.db.empty()
+
+    c.put(
+        (PARSE, '20100101000000/stackoverflow.com/questions/2', 10),
+        (DONE, '20100101000000/stackoverflow.com/questions/2', 0.1),
+        (STORE, '20100101000000/stackoverflow.com/questions/2', 'OK', ()),
+    )
+    c.stop()
+
+def test_results_are_committed_after_a_delay(controller, monkeypatch):
+    monkeypatch.setattr(master, 'CACHE_MAX_AGE', 0.2)
+    c = controller()
+    c.put((PARSE, 'p', 10), (STORE, 'p', 'OK', ()))
+
+    # Before the end of the run
+    (cmd,) = commands(c.db, 1)
+    assert cmd[0] == COMMIT
+    assert cmd[1] == [('p', 'OK', ())]
+    c.stop()
+
+def test_results_are_committed_in_groups(controller, monkeypatch):
+    monkeypatch.setattr(master, 'CACHE_MAX_SIZE', 2)
+    c = controller()
+    for n in range(3):
+        c.put((PARSE, 'p{}'.format(n), 10), (STORE, 'p{}'.format(n), 'OK', ()))
+
+    (cmd,) = commands(c.db, 1)
+    assert [path for path, *_ in cmd[1]] == ['p0', 'p1', 'p2']
+    c.stop()
+
+def test_partitions(controller):
+    partitions = [('2010', '2010'), ('2011', '2011')]
+    c = controller(partitions=partitions, readers=0)
+
+    # Every partition is seeded at startup
+    assert sorted(c.cdx.get(timeout=5) for partition in partitions) == [
+        (('2010', '2010'), None),
+        (('2011', '2011'), None),
+    ]
+
+    c.put((CDX, ('2010', '2010'), 'key 1'))
+    assert c.cdx.get(timeout=5) == (('2010', '2010'), 'key 1')
+
+    c.put((CDX_DONE, ('2011', '2011')))
+    c.thread.join(0.5)
+    assert c.running() # 2010 is not done yet
+
+    c.put((CDX_DONE, ('2010', '2010')))
+    c.thread.join(5)
+    assert not c.running()
+
+def test_captures_with_a_parsed_digest_are_not_loaded(controller):
+    first = '20100101000000/stackoverflow.com/questions/1'
+    second = '20110101000000/stackoverflow.com/questions/1'
+    item = dict(id='1', date='20100101000000', viewcount=10, tags=['python'])
+
+    c = controller()
+    c.put((CHECK_MANY, [(first, 'url1', 'question', 'D')]))
+    assert c.loader.get(timeout=5) == (first, 'url1', 'question')
+    c.put((PARSE, first, 10), (DONE, first, 0.1), (STORE, first, 'OK', (item,)))
+
+    c.put((CHECK_MANY, [(second, 'url2', 'question', 'D')]))
+    c.stop()
+
+    assert c.loader.empty()
+    assert c.committed() == [
+        (first, 'OK', (item,)),
+        (second, 'OK', (dict(item, date='20110101000000'),)),
+    ]
+
+def test_system_errors_are_not_reused(controller):
+    first = '20100101000000/stackoverflow.com/questions/1'
+    second = '20110101000000/stackoverflow.com/questions/1'
+
+    c = controller()
+    c.put((CHECK_MANY, [(first, 'url1', 'question', 'D')]))
+    assert c.loader.get(timeout=5) == (first, 'url1', 'question')
+    c.put((PARSE, first, 10), (DONE, first, 0.1), (STORE, first, PARSER_SYS_ERROR))
+
+    c.put((CHECK_MANY, [(second, 'url2', 'question', 'D')]))
+    assert c.loader.get(timeout=5) == (second, 'url2', 'question')
+    c.put((PARSE, second, 10), (DONE, second, 0.1), (STORE, second, 'OK', ()))
+    c.stop()
+
+def test_digest_cache_is_bounded(controller, monkeypatch):
+    monkeypatch.setattr(master, 'DIGEST_CACHE_SIZE', 1)
+    paths = ['2010010{}000000/stackoverflow.com/questions/{}'.format(n, n) for n in range(3)]
+
+    c = controller()
+    for n, digest in enumerate('ABA'):
+        c.put((CHECK_MANY, [(paths[n], 'url', 'question', digest)]))
+        if n < 2:
+            assert c.loader.get(timeout=5) == (paths[n], 'url', 'question')
+            c.put((PARSE, paths[n], 10), (DONE, paths[n], 0.1), (STORE, paths[n], 'OK', ()))
+
+    # A was evicted by B: the third capture is loaded
+    assert c.loader.get(timeout=5) == (paths[2], 'url', 'question')
+    c.put((PARSE, paths[2], 10), (DONE, paths[2], 0.1), (STORE, paths[2], 'OK', ()))
+    c.stop()
+
+def test_sampling_slots_of_stored_captures_are_released(dbpath, controller, monkeypatch):
+    stored = '20100101000000/stackoverflow.com/questions/1'
+    other = '20100101120000/stackoverflow.com/questions/1'
+    # Stored without any view count
+    Db(dbpath, mode='rw').write([(stored, 'ERROR', ())])
+    monkeypatch.setattr(master, 'SAMPLING_PERIOD', 'day')
+
+    c = controller()
+    c.put((CHECK_MANY, [(stored, 'url1', 'question', None)]))
+    (cmd,) = commands(c.db, 1)
+    assert cmd[0] == CHECK_MANY
+    c.put((LOAD_MANY, [], [stored]))
+
+    # Another capture of the same day is loaded instead
+    c.put((CHECK_MANY, [(other, 'url2', 'question', None)]))
+    assert c.loader.get(timeout=5) == (other, 'url2', 'question')
+    c.put((PARSE, other, 10), (DONE, other, 0.1), (STORE, other, 'OK', ()))
+    c.stop()
+
+def test_sampling_slots_of_failed_captures_are_released(controller, monkeypatch):
+    failed = '20100101000000/stackoverflow.com/questions/1'
+    other = '20100101120000/stackoverflow.com/questions/1'
+    monkeypatch.setattr(master, 'SAMPLING_PERIOD', 'day')
+    monkeypatch.setattr(master, 'MAX_RETRY', 2)
+
+    c = controller()
+    c.put((CHECK_MANY, [(failed, 'url1', 'question', None), (other, 'url2', 'question', None)]))
+    assert c.loader.get(timeout=5) == (failed, 'url1', 'question')
+
+    # Out of retries
+    c.put((RETRY, failed, 'url1', 'question', master.RETRY_STATUS))
+    c.put((CHECK_MANY, [(other, 'url2', 'question', None)]))
+    assert c.loader.get(timeout=5) == (other, 'url2', 'question')
+    c.put((PARSE, other, 10), (DONE, other, 0.1), (STORE, other, 'OK', ()))
+    c.stop()
+
+    assert c.committed() == [(other, 'OK', ())]
+
+def test_loaders_get_a_bounded_number_of_captures(controller, monkeypatch):
+    monkeypatch.setattr(master, 'GOVERNOR_START', 2)
+    paths = ['2010010{}000000/stackoverflow.com/questions/{}'.format(n, n) for n in range(4)]
+
+    c = controller()
+    c.put((CHECK_MANY, [(path, 'url', 'question', None) for path in paths]))
+    assert [c.loader.get(timeout=5)[0] for n in range(2)] == paths[:2]
+    c.thread.join(0.2)
+    assert c.loader.empty()
+
+    # A slot is given back when a capture is done
+    c.put((PARSE, paths[0], 10), (DONE, paths[0], 0.1), (STORE, paths[0], 'OK', ()))
+    assert c.loader.get(timeout=5)[0] == paths[2]
+
+    for path in paths[1:3]:
+        c.put((PARSE, path, 10), (DONE, path, 0.1), (STORE, path, 'OK', ()))
+    assert c.loader.get(timeout=5)[0] == paths[3]
+    c.put((PARSE, paths[3], 10), (DONE, paths[3], 0.1), (STORE, paths[3], 'OK', ()))
+    c.stop()
+
+def test_retries_wait_in_the_controller(controller, monkeypatch):
+    monkeypatch.setattr(master, 'RETRY_DELAY', 0.4)
+    c = controller()
+    c.put((CHECK_MANY, [('p', 'url', 'question', None)]))
+    assert c.loader.get(timeout=5) == ('p', 'url', 'question')
+
+    # Jittered between half and all of the delay, without any other command
+    # to wake the controller up
+    start = time.time()
+    c.put((RETRY, 'p', 'url', 'question', master.RETRY_STATUS))
+    assert c.loader.get(timeout=5) == ('p', 'url', 'question')
+    first = time.time() - start
+    assert 0.2 <= first < 1
+
+    # Then twice as long
+    start = time.time()
+    c.put((RETRY, 'p', 'url', 'question', master.RETRY_STATUS))
+    assert c.loader.get(timeout=5) == ('p', 'url', 'question')
+    assert 0.4 <= time.time() - start < 1.5
+
+    c.put((PARSE, 'p', 10), (DONE, 'p', 0.1), (STORE, 'p', 'OK', ()))
+    c.stop()
+
+def test_retries_are_given_up(controller, monkeypatch):
+    monkeypatch.setattr(master, 'RETRY_DELAY', 0.01)
+    monkeypatch.setattr(master, 'MAX_RETRY', 3)
+    c = controller()
+    c.put((CHECK_MANY, [('p', 'url', 'question', None)]))
+    for n in range(2):
+        assert c.loader.get(timeout=5) == ('p', 'url', 'question')
+        c.put((RETRY, 'p', 'url', 'question', master.RETRY_STATUS))
+
+    c.stop()
+    assert c.loader.empty()
+    assert c.committed() == []
+
+def test_throttled_requests_lower_the_limit(controller, monkeypatch):
+    monkeypatch.setattr(master, 'RETRY_DELAY', 0.01)
+    monkeypatch.setattr(master, 'GOVERNOR_START', 4)
+    paths = ['2010010{}000000/stackoverflow.com/questions/{}'.format(n, n) for n in range(6)]
+
+    def done(*paths):
+        for path in paths:
+            c.put((PARSE, path, 10), (DONE, path, 0.1), (STORE, path, 'OK', ()))
+
+    c = controller()
+    c.put((CHECK_MANY, [(path, 'url', 'question', None) for path in paths]))
+    assert [c.loader.get(timeout=5)[0] for n in range(4)] == paths[:4]
+
+    # Halved to 2, while 2 captures are still in flight
+    c.put((RETRY, paths[0], 'url', 'question', master.RETRY_THROTTLED))
+    done(paths[1])
+    c.thread.join(0.2)
+    assert c.loader.empty()
+
+    # Then growing again with the healthy responses
+    done(paths[2], paths[3])
+    assert sorted(c.loader.get(timeout=5)[0] for n in range(3)) == [paths[0], paths[4], paths[5]]
+    done(paths[0], paths[4], paths[5])
+    c.stop()
+
+def test_bad_command_in_a_batch(controller, capsys):
+    c = controller()
+    c.put(
+        (PARSE, 'p1', 10), (PARSE, 'p2', 10),
+        (BATCH, [(STORE, 'p1', 'OK', ()), (DONE,), (STORE, 'p2', 'OK', ())]),
+    )
+    c.stop()
+
+    # The other commands of the envelope were run
+    assert sorted(path for path, *_ in c.committed()) == ['p1', 'p2']
+    assert errors(capsys)
+
+def frontier(dbpath, *captures, positions=()):
+    db = Db(dbpath, mode='rw')
+    db.write([], dict(add=list(captures), remove=[], positions=list(positions)))
+    db.close()
+
+def test_crawl_state_is_saved_without_results(controller, monkeypatch):
+    monkeypatch.setattr(master, 'CACHE_MAX_AGE', 0.2)
+    c = controller()
+    c.put((CHECK_MANY, [('20100101000000/stackoverflow.com/questions/1', 'url', 'question', None)]))
+    assert c.loader.get(timeout=5)[0] == '20100101000000/stackoverflow.com/questions/1'
+
+    # Before the end of the run, and without any STORE
+    (cmd,) = commands(c.db, 1)
+    assert cmd[0] == COMMIT
+    assert cmd[1] == []
+    assert cmd[2]['add'] == [('20100101000000/stackoverflow.com/questions/1', 'url', 'question', None, master.MAX_RETRY-1)]
+
+    c.put(
+        (PARSE, '20100101000000/stackoverflow.com/questions/1', 10),
+        (DONE, '20100101000000/stackoverflow.com/questions/1', 0.1),
+        (STORE, '20100101000000/stackoverflow.com/questions/1', 'OK', ()),
+    )
+    c.stop()
+
+def test_resumed_captures_keep_their_attempts(dbpath, controller, monkeypatch):
+    monkeypatch.setattr(master, 'RETRY_DELAY', 0.01)
+    path = '20100101000000/stackoverflow.com/questions/1'
+    frontier(dbpath, (path, 'url', 'question', None, 1))
+
+    c = controller(resume=True)
+    assert c.loader.get(timeout=5) == (path, 'url', 'question')
+
+    # The interrupted attempt does not count: this was the last one
+    c.put((RETRY, path, 'url', 'question', master.RETRY_STATUS))
+    c.stop()
+
+    assert c.loader.empty()
+    removed = [path for entries, frontier in c.commits() for path in frontier['remove']]
+    assert removed == [path]
+
+def test_resumed_captures_already_stored_leave_the_frontier(dbpath, controller):
+    stored = '20100101000000/stackoverflow.com/questions/1'
+    Db(dbpath, mode='rw').write([(stored, 'OK', ())])
+    frontier(dbpath, (stored, 'url', 'question', None, 3))
+
+    c = controller(resume=True)
+    (cmd,) = commands(c.db, 1)
+    assert cmd == (CHECK_MANY, [(stored, 'url', 'question', None)])
+    c.put((LOAD_MANY, [], [stored]))
+    c.stop()
+
+    removed = [path for entries, frontier in c.commits() for path in frontier['remove']]
+    assert removed == [stored]
+
+def test_eof_waits_for_the_checks(dbpath, controller):
+    stored = '20100101000000/stackoverflow.com/questions/1'
+    Db(dbpath, mode='rw').write([(stored, 'OK', ())])
+
+    c = controller(offline=True)
+    c.put((CHECK_MANY, [(stored, 'file1', 'question', None)]), (EOF,))
+    (cmd,) = commands(c.db, 1)
+    assert cmd[0] == CHECK_MANY
+    c.thread.join(0.2)
+    assert c.running()
+
+    # Collision: the db tells it is not stored
+    c.put((LOAD_MANY, [(stored, 'file1', 'question', None)], []))
+    assert c.loader.get(timeout=5) == (stored, 'file1', 'question')
+    c.put((PARSE, stored, 10), (DONE, stored, None), (STORE, stored, 'OK', ()))
+    c.thread.join(5)
+    assert not c.running()
+
+def test_retried_captures_with_a_parsed_digest(controller, monkeypatch):
+    monkeypatch.setattr(master, 'RETRY_DELAY', 0.4)
+    first = '20100101000000/stackoverflow.com/questions/1'
+    second = '20110101000000/stackoverflow.com/questions/1'
+    item = dict(id='1', date='20110101000000', viewcount=10, tags=['python'])
+
+    c = controller()
+    c.put((CHECK_MANY, [(first, 'url1', 'question', 'D')]))
+    assert c.loader.get(timeout=5) == (first, 'url1', 'question')
+    c.put((RETRY, first, 'url1', 'question', master.RETRY_STATUS))
+
+    # Same content parsed while the first capture waits for its retry
+    c.put((CHECK_MANY, [(second, 'url2', 'question', 'D')]))
+    assert c.loader.get(timeout=5) == (second, 'url2', 'question')
+    c.put((PARSE, second, 10), (DONE, second, 0.1), (STORE, second, 'OK', (item,)))
+    time.sleep(0.5)
+    c.stop()
+
+    assert c.loader.empty()
+    commits = c.commits()
+    assert [entry for entries, frontier in commits for entry in entries] == [
+        (second, 'OK', (item,)),
+        (first, 'OK', (dict(item, date='20100101000000'),)),
+    ]
+    # No longer in flight
+    added = {}
+    for entries, frontier in commits:
+        added.update((capture[0], capture) for capture in frontier['add'])
+        for path in frontier['remove']:
+            added.pop(path, None)
+    assert first not in added
+
+def test_reparse_loads_no_known_sources(dbpath, controller, capsys):
+    Db(dbpath, mode='rw').write([('20100101000000/stackoverflow.com/questions/1', 'OK', ())])
+
+    c = controller(reparse=True)
+    c.put((PARSE, 'p', 10), (STORE, 'p', 'OK', ()))
+    c.stop()
+
+    assert ' KNOWN ' not in capsys.readouterr().out
+    assert c.committed() == [('p', 'OK', ())]
@@ -0,0 +1,173 @@
+import queue
+import sqlite3
+import threading
+
+import pytest
+
+import utils.db
+import workers.db
+from utils.db import Db
+from config.commands import *
+
+def path(n, date='20100101000000'):
+    return '{}/stackoverflow.com/questions/{}'.format(date, n)
+
+@pytest.fixture
+def db(tmp_path):
+    return Db(str(tmp_path / 'questions.db'), mode='rwc')
+
+@pytest.fixture
+def db_worker(tmp_path, monkeypatch):
+    """ Run the db worker in a thread: return its (ctrl, queue)
+    """
+    dbpath = str(tmp_path / 'questions.db')
+    Db(dbpath, mode='rwc')
+    monkeypatch.setattr(workers.db, 'DB_URI', dbpath)
+
+    ctrl, q = queue.Queue(), queue.Queue()
+    thread = threading.Thread(target=workers.db.db, args=(ctrl, q), daemon=True)
+    thread.start()
+
+    yield ctrl, q
+
+    q.put((EOF,))
+    thread.join(5)
+    assert not thread.is_alive()
+
+def test_missing(db, monkeypatch):
+    monkeypatch.setattr(utils.db, 'DB_SELECT_CHUNK', 7)
+    db.write([(path(n), 'OK', ()) for n in range(0, 50, 2)])
+
+    paths = [path(n) for n in range(50)] + [path(1, '20110101000000')]
+    assert db.missing(paths) == [path(n) for n in range(1, 50, 2)] + [path(1, '20110101000000')]
+    assert db.missing([]) == []
+
+def test_exists(db):
+    db.write([(path(1), 'OK', ())])
+
+    assert db.exists(path(1))
+    assert not db.exists(path(2))
+
+def test_check_many(db_worker):
+    ctrl, q = db_worker
+    q.put((COMMIT, [(path(1), 'OK', ())], None))
+    q.put((CHECK_MANY, [
+        (path(1), 'url1', 'question', None),
+        (path(2), 'url2', 'question', 'DIGEST'),
+    ]))
+
+    assert ctrl.get(timeout=5) == (LOAD_MANY, [(path(2), 'url2', 'question', 'DIGEST')], [path(1)])
+
+def test_check(db_worker):
+    ctrl, q = db_worker
+    q.put((COMMIT, [(path(1), 'OK', ())], None))
+    q.put((CHECK, path(1), 'url1', 'question'))
+    q.put((CHECK, path(2), 'url2', 'question'))
+
+    assert ctrl.get(timeout=5) == (DISCARD, path(1), 'url1')
+    assert ctrl.get(timeout=5) == (LOAD, path(2), 'url2', 'question', None)
+
+def item(qid, date, viewcount, *tags):
+    return dict(id=qid, date=date, viewcount=viewcount, tags=list(tags))
+
+def test_write(db):
+    rows = db.write([
+        (path(1), 'OK', (item('1', '20100101000000', 10, 'python', 'lxml'),)),
+        ('20100101000000/stackoverflow.com/questions/tagged/python', 'OK', (
+            item('1', '20100101000000', 10, 'python', 'lxml'),
+            item('2', '20100101000000', 20, 'python'),
+        )),
+        (path(3), 'DATA_NOT_FOUND', ()),
+    ])
+
+    # 3 sources, 3 views (one ignored duplicate) and 5 tags
+    assert rows == 11
+    assert db.fcount() == 3
+    assert list(db.questions()) == [
+        ('20100101000000', 1, 10, 'lxml', 'python'),
+        ('20100101000000', 2, 20, 'python'),
+    ]
+
+def test_write_rollback(db):
+    entries = [
+        (path(1), 'OK', (item('1', '20100101000000', 10, 'python'),)),
+        (path(2), 'OK', (item('2', '20100101000000', 20, 'python'),)),
+    ]
+    frontier = dict(add=[(path(3),)], remove=[], positions=[]) # missing columns
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.write(entries, frontier)
+
+    # Nothing was written, and the entries are left for another attempt
+    assert len(entries) == 2
+    assert db.fcount() == 0
+    assert db.batch() == 0
+
+    db.write(entries)
+    assert entries == []
+    assert db.fcount() == 2
+    assert db.batch() == 1
+
+def test_wal_readers_do_not_block_the_writer(db, tmp_path):
+    db.write([(path(1), 'OK', ())])
+    assert db.cursor.execute("PRAGMA journal_mode").fetchone() == ('wal',)
+
+    reader = Db(str(tmp_path / 'questions.db'), timeout=0.1)
+    with reader.snapshot():
+        assert reader.fcount() == 1
+
+        # Would time out with a rollback journal while the read is open
+        db.write([(path(2), 'OK', ())])
+        assert reader.fcount() == 1 # still the same snapshot
+
+    assert reader.fcount() == 2
+
+def test_checkpoint(db):
+    db.ingest()
+    db.write([(path(1), 'OK', ())])
+
+    busy, log, checkpointed = db.checkpoint()
+    assert busy == 0
+    assert log == checkpointed
+
+def test_changed_years(db):
+    db.write([(path(1), 'OK', (item('1', '20100101000000', 10, 'python'),))])
+    db.write([(path(2, '20130101000000'), 'OK', (item('2', '20130101000000', 20, 'python'),))])
+    assert db.batch() == 2
+    assert db.changedYears(0, 2) == [2010, 2013]
+    assert db.changedYears(1, 2) == [2013]
+
+    # Same tags: only the year of the new capture changes
+    db.write([(path(1, '20140101000000'), 'OK', (item('1', '20140101000000', 12, 'python'),))])
+    assert db.changedYears(2, 3) == [2014]
+
+    # A new tag changes the rows of every year the question was captured
+    db.write([(path(1, '20150101000000'), 'OK', (item('1', '20150101000000', 15, 'python', 'rust'),))])
+    assert db.changedYears(3, 4) == [2010, 2014, 2015]
+
+    assert db.changedYears(4, 4) == []
+
+def test_no_per_row_batch(db):
+    for table in ('views', 'tags'):
+        columns = [column for cid, column, *_ in db.cursor.execute("PRAGMA table_info({})".format(table))]
+        assert 'batch' not in columns
+
+def test_clear_frontier(db):
+    db.write([], dict(
+        add=[(path(1), 'url1', 'question', None, 3)],
+        remove=[],
+        positions=[('2010', '2010', 'key', False)],
+    ))
+    assert list(db.frontier()) == [(path(1), 'url1', 'question', None, 3)]
+    assert db.positions() == {('2010', '2010'): ('key', False)}
+
+    db.clearFrontier()
+    assert list(db.frontier()) == []
+    assert db.positions() == {}
+
+def test_view_counts_are_updated(db):
+    db.write([(path(1), 'OK', (item('1', '20100101000000', 10, 'python'),))])
+    # Parsed again, e.g. with a fixed parser
+    db.write([(path(1), 'OK', (item('1', '20100101000000', 12, 'python'),))])
+
+    assert list(db.questions()) == [('20100101000000', 1, 12, 'python')]
+    assert db.changedYears(1, 2) == [2010]
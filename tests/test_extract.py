@@ -0,0 +1,168 @@
+import io
+import os
+import csv
+import sys
+import subprocess
+
+import pytest
+
+import extract
+from utils import columnar
+from utils.db import Db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def entry(qid, date, viewcount, *tags):
+    path = '{}/stackoverflow.com/questions/{}'.format(date, qid)
+    return (path, 'OK', (dict(id=str(qid), date=date, viewcount=viewcount, tags=list(tags)),))
+
+ENTRIES = [
+    entry(1, '20100101000000', 10, 'python', 'algorithm'),
+    entry(2, '20100612000000', 20, 'c++'),
+    entry(1, '20130101000000', 15, 'python', 'algorithm'),
+    entry(3, '20130301000000', 30, 'java', 'generics', 'c#'),
+]
+
+def expected_csv(year):
+    """ The per-year CSV file as written by the serial exporter
+    """
+    # Tags are kept per question, whatever the capture
+    tags = {}
+    for path, status, items in ENTRIES:
+        for item in items:
+            tags.setdefault(int(item['id']), set()).update(item['tags'])
+
+    rows = sorted(
+        (item['date'], int(item['id']), item['viewcount'], *sorted(tags[int(item['id'])]))
+        for path, status, items in ENTRIES for item in items
+        if item['date'].startswith(str(year))
+    )
+    f = io.StringIO(newline='')
+    output = csv.writer(f)
+    for row in rows:
+        output.writerow(row)
+
+    return f.getvalue().encode('utf-8')
+
+@pytest.fixture
+def crawl(tmp_path):
+    """ Working directory with a crawl database
+    """
+    db = Db(str(tmp_path / 'questions.db'), mode='rwc')
+    db.write(list(ENTRIES))
+    db.close()
+    os.mkdir(tmp_path / 'data')
+
+    return tmp_path
+
+def run(cwd, *args):
+    env = dict(os.environ, PYTHONPATH=ROOT, DEBUG='')
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'extract.py'), *args],
+        cwd=cwd, env=env, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+
+def manifest(cwd):
+    return extract.load_manifest(os.path.join(cwd, 'data', 'MANIFEST'))
+
+def read(cwd, filename):
+    with open(os.path.join(cwd, 'data', filename), 'rb') as f:
+        return f.read()
+
+def test_export_year(crawl, monkeypatch):
+    monkeypatch.setattr(extract, 'DB_URI', str(crawl / 'questions.db'))
+    monkeypatch.setattr(extract, 'EXTRACT_DIR', str(crawl / 'data'))
+
+    (entry,) = extract.export(2013)
+    assert entry['filename'] == '2013.csv'
+    assert entry['count'] == 2
+    assert read(crawl, '2013.csv') == expected_csv(2013)
+    assert entry['sha256'] == extract.checksum(str(crawl / 'data' / '2013.csv'))
+
+    # No file for a year without rows
+    assert extract.export(2011) == []
+    assert not os.path.exists(crawl / 'data' / '2011.csv')
+
+def test_export(crawl):
+    run(crawl)
+
+    files = manifest(crawl)
+    assert sorted(files) == ['2010.csv', '2013.csv']
+    for year in (2010, 2013):
+        data = read(crawl, '{}.csv'.format(year))
+        assert data == expected_csv(year)
+        assert files['{}.csv'.format(year)]['count'] == len(data.splitlines())
+
+def test_incremental(crawl):
+    run(crawl)
+    mtime = os.stat(crawl / 'data' / '2010.csv').st_mtime_ns
+
+    db = Db(str(crawl / 'questions.db'), mode='rw')
+    assert db.getMetadata('export.batch') == '1'
+    ENTRIES.append(entry(4, '20130401000000', 40, 'rust'))
+    try:
+        db.write([ENTRIES[-1]])
+        run(crawl, '--incremental')
+
+        # Only the changed year was written again
+        assert os.stat(crawl / 'data' / '2010.csv').st_mtime_ns == mtime
+        assert read(crawl, '2013.csv') == expected_csv(2013)
+        files = manifest(crawl)
+        assert sorted(files) == ['2010.csv', '2013.csv']
+        assert files['2013.csv']['count'] == 3
+        assert files['2010.csv']['sha256'] == extract.checksum(str(crawl / 'data' / '2010.csv'))
+        assert db.getMetadata('export.batch') == '2'
+    finally:
+        ENTRIES.pop()
+
+def test_export_leaves_the_crawl_setup_alone(crawl):
+    # As if the crawler never ran in WAL mode
+    db = Db(str(crawl / 'questions.db'), mode='rw')
+    assert db.cursor.execute("PRAGMA journal_mode=DELETE").fetchone() == ('delete',)
+    db.close()
+
+    run(crawl)
+
+    db = Db(str(crawl / 'questions.db'))
+    assert db.cursor.execute("PRAGMA journal_mode").fetchone() == ('delete',)
+    assert db.getMetadata('export.batch') == '1'
+
+def test_columnar(crawl):
+    run(crawl, '--columnar')
+
+    files = manifest(crawl)
+    assert sorted(files) == ['2010.col', '2010.csv', '2013.col', '2013.csv']
+    reader = columnar.Reader(str(crawl / 'data' / '2013.col'))
+    rows = [','.join(map(str, reader.row(n))) + '\r\n' for n in range(len(reader))]
+    assert ''.join(rows).encode('utf-8') == expected_csv(2013)
+    assert files['2013.col']['count'] == len(reader)
+
+def test_incremental_regenerates_missing_columnar_files(crawl):
+    run(crawl)
+    run(crawl, '--incremental', '--columnar')
+
+    # Nothing changed, but no year had its columnar file yet
+    assert sorted(manifest(crawl)) == ['2010.col', '2010.csv', '2013.col', '2013.csv']
+
+    os.unlink(crawl / 'data' / '2010.col')
+    run(crawl, '--incremental', '--columnar')
+    assert os.path.exists(crawl / 'data' / '2010.col')
+    assert manifest(crawl)['2010.col']['sha256'] == extract.checksum(str(crawl / 'data' / '2010.col'))
+
+def test_stale_columnar_file_already_removed(crawl):
+    run(crawl, '--columnar')
+    os.unlink(crawl / 'data' / '2013.col')
+
+    db = Db(str(crawl / 'questions.db'), mode='rw')
+    ENTRIES.append(entry(4, '20130401000000', 40, 'rust'))
+    try:
+        db.write([ENTRIES[-1]])
+        db.close()
+
+        # The columnar file of the changed year is dropped from the manifest
+        run(crawl, '--incremental')
+        assert sorted(manifest(crawl)) == ['2010.col', '2010.csv', '2013.csv']
+        assert read(crawl, '2013.csv') == expected_csv(2013)
+    finally:
+        ENTRIES.pop()
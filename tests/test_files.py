@@ -0,0 +1,87 @@
+import queue
+import threading
+
+import pytest
+
+from utils import ByteBudget, unpack
+from workers.cdx import capturetopath
+from workers.files import filetopath, lister, files
+from config.commands import *
+from config.constants import PAGE_QUESTION, PAGE_TAGGED
+
+from conftest import commands
+
+@pytest.mark.parametrize('timestamp, original', [
+    ('20100101000000', 'http://stackoverflow.com/questions/1/title'),
+    ('20100101000000', 'http://stackoverflow.com:80/questions/1/title'),
+    ('20100101000000', 'http://stackoverflow.com/questions/tagged/python?page=2'),
+    ('20100101000000id_', 'https://stackoverflow.com/questions/1'),
+])
+def test_same_path_as_the_cdx(tmp_path, timestamp, original):
+    # As saved by `download.py`, or mirrored by wget
+    filepath = tmp_path / 'snapshots' / timestamp / original.replace('://', ':/')
+    path, url = filetopath(filepath)
+    assert path == capturetopath(dict(timestamp=timestamp[:14], original=original))[0]
+
+def test_no_timestamp(tmp_path):
+    assert filetopath(tmp_path / 'stackoverflow.com' / 'questions' / '1') is None
+    assert filetopath(tmp_path / '20100101000000') is None
+
+def test_lister(tmp_path, monkeypatch):
+    import workers.files
+    monkeypatch.setattr(workers.files, 'push', lambda ctrl, sem, captures: ctrl.put(list(captures)))
+
+    root = tmp_path / '20100101000000' / 'stackoverflow.com' / 'questions'
+    filepaths = [root / '1', root / 'ask', root / 'tagged' / 'python']
+
+    ctrl = queue.Queue()
+    lister(ctrl, threading.Semaphore(10), filepaths)
+
+    assert ctrl.get(timeout=1) == [
+        ('20100101000000/stackoverflow.com/questions/1', str(root / '1'), PAGE_QUESTION),
+        ('20100101000000/stackoverflow.com/questions/tagged/python', str(root / 'tagged' / 'python'), PAGE_TAGGED),
+    ]
+    assert ctrl.get(timeout=1) == (EOF,)
+
+def test_files(tmp_path):
+    (tmp_path / 'page').write_text('page', encoding='utf-8')
+    ctrl, captures, pages = queue.Queue(), queue.Queue(), queue.Queue()
+    threading.Thread(target=files, args=(ctrl, captures, pages, ByteBudget(1 << 20)), daemon=True).start()
+
+    captures.put(('p1', str(tmp_path / 'page'), PAGE_QUESTION))
+    captures.put(('p2', str(tmp_path / 'missing'), PAGE_QUESTION))
+
+    cmds = commands(ctrl, 3)
+    assert [cmd[:2] for cmd in cmds] == [(PARSE, 'p1'), (DONE, 'p1'), (DONE, 'p2')]
+    path, kind, data = pages.get(timeout=1)
+    assert (path, kind, unpack(data)) == ('p1', PAGE_QUESTION, 'page')
+    assert pages.empty()
+
+@pytest.mark.parametrize('original', [
+    'http://stackoverflow.com/questions/1/',
+    'http://stackoverflow.com/questions/tagged/python/',
+])
+def test_index_suffix(tmp_path, original):
+    # `download.py` saves an URL ending with '/' under a '.index' name
+    filepath = tmp_path / '20100101000000' / (original[len('http://'):-1] + '.index')
+    path, url = filetopath(filepath)
+    assert path == capturetopath(dict(timestamp='20100101000000', original=original))[0]
+    assert url == original
+
+def test_lister_skips_symlinks(tmp_path, monkeypatch):
+    import workers.files
+    monkeypatch.setattr(workers.files, 'push', lambda ctrl, sem, captures: ctrl.put(list(captures)))
+
+    # A redirection saved by `download.py`
+    root = tmp_path / '20100101000000' / 'stackoverflow.com' / 'questions'
+    (root / '1').mkdir(parents=True)
+    (root / '1' / 'title').write_text('page', encoding='utf-8')
+    (root / '2').symlink_to('1/title')
+
+    ctrl = queue.Queue()
+    lister(ctrl, threading.Semaphore(10), [root / '1' / 'title', root / '2'])
+
+    assert ctrl.get(timeout=1) == [
+        ('20100101000000/stackoverflow.com/questions/1/title', str(root / '1' / 'title'), PAGE_QUESTION),
+    ]
+    assert ctrl.get(timeout=1) == (EOF,)
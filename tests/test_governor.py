@@ -0,0 +1,63 @@
+import pytest
+
+import utils.governor
+from utils.governor import Governor
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Settable time of the governor
+    """
+    class Clock:
+        now = 1000.0
+        def time(self):
+            return self.now
+
+    clock = Clock()
+    monkeypatch.setattr(utils.governor, 'time', clock)
+    return clock
+
+def test_additive_increase(clock):
+    governor = Governor(4, 1, 10)
+
+    # About one more request in flight per window of `limit` healthy
+    # responses
+    for n in range(4):
+        governor.ok(0.5)
+    assert int(governor) == 4
+    governor.ok(0.5)
+    assert int(governor) == 5
+
+    for n in range(1000):
+        governor.ok(0.5)
+    assert int(governor) == 10
+
+def test_multiplicative_decrease(clock):
+    governor = Governor(8, 2, 10)
+    governor.decrease()
+    assert int(governor) == 4
+
+    # At most once per round-trip
+    governor.ok(0.5)
+    clock.now += 0.1
+    governor.decrease()
+    assert int(governor) == 4
+
+    clock.now += 1
+    governor.decrease()
+    assert int(governor) == 2
+
+    clock.now += 1
+    governor.decrease()
+    assert int(governor) == 2
+
+def test_latency_rise(clock):
+    governor = Governor(8, 1, 10)
+    for n in range(100):
+        governor.ok(0.1)
+    limit = governor.limit
+
+    # The recent latency moves faster than the long-run one
+    for n in range(20):
+        clock.now += 10
+        governor.ok(2)
+    assert governor.limit < limit / 2
@@ -0,0 +1,66 @@
+from utils.db import Db
+from utils.known import KnownSources, Coverage
+
+def write(db, *paths):
+    db.write([(path, 'OK', ()) for path in paths])
+
+def test_known_sources(tmp_path):
+    db = Db(str(tmp_path / 'questions.db'), mode='rwc')
+    write(db, '20100101000000/stackoverflow.com/questions/1', '20110101000000/stackoverflow.com/questions/2')
+
+    known = KnownSources()
+    known.load(db)
+
+    assert len(known) == 2
+    assert '20100101000000/stackoverflow.com/questions/1' in known
+    assert '20110101000000/stackoverflow.com/questions/2' in known
+    assert '20120101000000/stackoverflow.com/questions/3' not in known
+
+    known.add('20120101000000/stackoverflow.com/questions/3')
+    assert '20120101000000/stackoverflow.com/questions/3' in known
+    assert len(known) == 3
+
+    # Reloading drops the sources added since, which are in the db by then
+    known.load(db)
+    assert '20120101000000/stackoverflow.com/questions/3' not in known
+
+def views(db, *captures):
+    db.write([
+        ('{}/stackoverflow.com/questions/{}'.format(date, qid), 'OK', (dict(id=str(qid), date=date, viewcount=1, tags=['python']),))
+        for qid, date in captures
+    ])
+
+def test_coverage_slots_match_the_db(tmp_path):
+    db = Db(str(tmp_path / 'questions.db'), mode='rwc')
+    captures = [
+        (1, '20100101000000'), (1, '20100101235959'), (1, '20100102000000'),
+        (2, '20080915120000'), (2, '20120229000000'), (3, '20191231000000'),
+    ]
+    views(db, *captures)
+
+    for period in ('day', 'week'):
+        coverage = Coverage(period)
+        coverage.load(db)
+
+        slots = sorted(set(coverage.slot(qid, date) for qid, date in captures))
+        assert list(coverage.snapshot) == slots
+        assert coverage.snapshot.typecode == 'q'
+
+def test_coverage(tmp_path):
+    db = Db(str(tmp_path / 'questions.db'), mode='rwc')
+    views(db, (1, '20100101000000'))
+
+    coverage = Coverage('day')
+    coverage.load(db)
+
+    # Covered by the db
+    assert not coverage.claim('20100101120000/stackoverflow.com/questions/1')
+    # Covered by a capture of this run
+    assert coverage.claim('20100102000000/stackoverflow.com/questions/1')
+    assert not coverage.claim('20100102120000/stackoverflow.com/questions/1')
+    # Not about a single question
+    assert coverage.claim('20100102000000/stackoverflow.com/questions/tagged/python')
+    assert coverage.claim('20100102000000/stackoverflow.com/questions/tagged/python')
+
+    coverage.release('20100102000000/stackoverflow.com/questions/1')
+    assert coverage.claim('20100102120000/stackoverflow.com/questions/1')
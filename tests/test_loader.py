@@ -0,0 +1,100 @@
+import time
+import hashlib
+import queue
+import threading
+
+from utils import ByteBudget, unpack
+from workers.loader import session, loader
+from config.commands import *
+from config.constants import RETRY_THROTTLED
+
+from conftest import commands
+
+def start(concurrency):
+    ctrl, captures, pages = queue.Queue(), queue.Queue(), queue.Queue()
+    budget = ByteBudget(1 << 20)
+    threading.Thread(
+        target=loader, args=(ctrl, captures, pages, budget), kwargs=dict(concurrency=concurrency),
+        daemon=True
+    ).start()
+
+    return ctrl, captures, pages
+
+def test_session_pool():
+    http = session(4)
+    adapter = http.get_adapter('http://example.com/')
+
+    assert adapter._pool_maxsize == 4
+    assert adapter._pool_block
+
+def test_concurrent_requests(server):
+    def handler(request):
+        time.sleep(0.4)
+        return (200, 'page ' + request.path)
+    server.handler = handler
+
+    ctrl, captures, pages = start(concurrency=4)
+    start_time = time.time()
+    for n in range(4):
+        captures.put(('{}/p{}'.format(n, n), '{}/p{}'.format(server.url, n), 'question'))
+
+    done = [cmd for cmd in commands(ctrl, 8) if cmd[0] == DONE]
+    elapsed = time.time() - start_time
+
+    # The four requests ran at the same time, not one after the other
+    assert len(done) == 4
+    assert elapsed < 1.2
+
+    bodies = sorted(unpack(pages.get(timeout=1)[2]) for n in range(4))
+    assert bodies == ['page /p{}'.format(n) for n in range(4)]
+
+def test_failed_request_is_handed_back(server):
+    server.handler = lambda request: (404, 'Not found')
+
+    ctrl, captures, pages = start(concurrency=2)
+    captures.put(('p', server.url + '/p', 'question'))
+
+    (cmd,) = commands(ctrl, 1)
+    assert cmd[:4] == (RETRY, 'p', server.url + '/p', 'question')
+    assert pages.empty()
+
+def test_throttled_request(server):
+    server.handler = lambda request: (503, 'Busy')
+
+    ctrl, captures, pages = start(concurrency=1)
+    captures.put(('p', server.url + '/p', 'question'))
+
+    (cmd,) = commands(ctrl, 1)
+    assert cmd == (RETRY, 'p', server.url + '/p', 'question', RETRY_THROTTLED)
+
+def test_latency_is_reported(server):
+    def handler(request):
+        time.sleep(0.2)
+        return (200, 'page')
+    server.handler = handler
+
+    ctrl, captures, pages = start(concurrency=1)
+    captures.put(('p', server.url + '/p', 'question'))
+
+    (done,) = [cmd for cmd in commands(ctrl, 2) if cmd[0] == DONE]
+    assert done[1] == 'p'
+    assert 0.2 <= done[2] < 1
+
+def test_pages_are_kept_in_the_store(server, tmp_path, monkeypatch):
+    import workers.loader
+    from utils.packstore import pages as stored, index
+
+    server.handler = lambda request: (200, 'page')
+    monkeypatch.setattr(workers.loader, 'PACK_STORE_DIR', str(tmp_path))
+
+    ctrl, captures, pages = start(concurrency=1)
+    captures.put(('20100101000000/p', server.url + '/p', 'question'))
+    captures.put(('20110101000000/p', server.url + '/p', 'question'))
+    commands(ctrl, 4)
+
+    # Keyed by the raw body
+    assert list(index(str(tmp_path))) == [hashlib.sha1(b'page').digest()]
+    assert [(path, unpack(data)) for path, kind, data in stored(str(tmp_path))] == [
+        ('20100101000000/p', 'page'),
+        ('20110101000000/p', 'page'),
+    ]
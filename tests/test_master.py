@@ -0,0 +1,114 @@
+import os
+import sys
+import subprocess
+import multiprocessing
+
+import pytest
+
+from utils.db import Db
+from utils.pm import ProcessManager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# Captures of the fake archive: (timestamp, original, fixture)
+CAPTURES = [
+    ('20100215000000', 'http://stackoverflow.com/questions/55555/sort-a-list', '2009'),
+    ('20140101000000', 'http://stackoverflow.com/questions/tagged/python', 'tagged'),
+    ('20140102000000', 'http://stackoverflow.com/questions/ask', None),
+]
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name + '.html'), encoding='utf-8') as f:
+        return f.read()
+
+@pytest.fixture
+def archive(server):
+    """ CDX server and Wayback Machine in one
+    """
+    pages = {
+        '/web/{}/{}'.format(timestamp, original): name
+        for timestamp, original, name in CAPTURES
+    }
+    def handler(request):
+        if request.path.startswith('/cdx'):
+            if 'from=2010' not in request.path and 'from=2014' not in request.path:
+                return (200, '')
+            year = '2010' if 'from=2010' in request.path else '2014'
+            return (200, ''.join(
+                '{} {} 200 DIGEST{}\n'.format(timestamp, original, n)
+                for n, (timestamp, original, name) in enumerate(CAPTURES)
+                if timestamp.startswith(year)
+            ))
+
+        name = pages.get(request.path)
+        if name is None:
+            return (404, 'Not found')
+        return (200, fixture(name))
+
+    server.handler = handler
+    return server
+
+def run(cwd, *args, **env):
+    env = dict(os.environ, PYTHONPATH=ROOT, DEBUG='', **env)
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'master.py'), *args],
+        cwd=cwd, env=env, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stdout[-2000:] + result.stderr[-2000:]
+
+def stored(cwd):
+    db = Db(str(cwd / 'questions.db'))
+    try:
+        return (db.fcount(), sorted(db.questions()))
+    finally:
+        db.close()
+
+def test_crawl_and_reparse(archive, tmp_path):
+    env = dict(
+        CDX_API_ENDPOINT=archive.url + '/cdx',
+        WAYBACK_ENDPOINT=archive.url,
+        PACK_STORE_DIR=str(tmp_path / 'pack'),
+    )
+    run(tmp_path, **env)
+
+    count, rows = stored(tmp_path)
+    # The ask page is not loaded
+    assert count == 2
+    assert ('20100215000000', 55555, 567, 'list', 'sorting') in rows
+    assert len(rows) == 3
+
+    # Offline, from the pack store
+    db = Db(str(tmp_path / 'questions.db'), mode='rw')
+    db.cursor.execute("DELETE FROM views")
+    db.close()
+    run(tmp_path, '--reparse', **env)
+    assert stored(tmp_path) == (count, rows)
+
+def test_local(tmp_path):
+    root = tmp_path / 'web.archive.org'
+    filepaths = []
+    for timestamp, original, name in CAPTURES:
+        filepath = root / timestamp / original.replace('http://', '')
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        filepath.write_text(fixture(name) if name else '', encoding='utf-8')
+        filepaths.append(filepath)
+
+    run(tmp_path, '--local')
+    count, rows = stored(tmp_path)
+    assert count == 2
+    assert len(rows) == 3
+
+def _fail():
+    raise SystemExit(3)
+
+def test_failed_workers():
+    pm = ProcessManager(
+        multiprocessing.Process(target=_fail),
+        multiprocessing.Process(target=int),
+    )
+    pm.start()
+    for worker in pm.workers:
+        worker.join(5)
+
+    assert pm.failed() == [pm[0]]
@@ -0,0 +1,115 @@
+import sqlite3
+
+import pytest
+
+from utils.db import Db, sourcekey
+
+# Schema and data of a version 3 database, as written before the compact
+# version 4 schema
+V3_SCHEMA = """
+    CREATE TABLE sources (
+        path TEXT PRIMARY KEY,
+        status TEXT NOT NULL
+    );
+    CREATE TABLE tags (
+        question INT NOT NULL,
+        tag TEXT NOT NULL,
+        PRIMARY KEY(question, tag)
+    );
+    CREATE TABLE views (
+        question INT NOT NULL,
+        viewcount INT NOT NULL,
+        date TEXT NOT NULL,
+        PRIMARY KEY(date, question)
+    );
+    CREATE INDEX views_question_idx ON views(question);
+    CREATE TABLE meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    INSERT INTO meta(key,value) VALUES ('version','3');
+"""
+V3_SOURCES = (
+    ('20100101000000/stackoverflow.com/questions/1', 'OK'),
+    ('20100101000000/stackoverflow.com/questions/tagged/python', 'OK'),
+    ('20130101000000/stackoverflow.com/questions/2', 'DATA_NOT_FOUND'),
+    ('20130101000000/stackoverflow.com/questions/3', 'OK'),
+)
+V3_VIEWS = (
+    ('1', 10, '20100101000000'),
+    ('2', 20, '20100101000000'),
+    ('1', 15, '20130101000000'),
+    ('3', 30, '20130101000000'),
+    ('4', 40, '20130101000000'), # no tags: not exported
+)
+V3_TAGS = (
+    ('1', 'python'),
+    ('1', 'c++'),
+    ('1', 'algorithm'),
+    ('2', 'python'),
+    ('3', 'java'),
+)
+
+# Export query before version 4
+V3_EXPORT = """
+    SELECT date, question, viewcount, group_concat(tag, ',')
+    FROM views INNER JOIN tags USING (question)
+    GROUP BY date, question
+    ORDER BY date, question
+"""
+
+@pytest.fixture
+def v3(tmp_path):
+    dbpath = str(tmp_path / 'questions.db')
+    db = sqlite3.connect(dbpath)
+    db.executescript(V3_SCHEMA)
+    db.executemany("INSERT INTO sources(path, status) VALUES(?, ?)", V3_SOURCES)
+    db.executemany("INSERT INTO views(question, viewcount, date) VALUES(?, ?, ?)", V3_VIEWS)
+    db.executemany("INSERT INTO tags(question, tag) VALUES(?, ?)", V3_TAGS)
+    db.commit()
+
+    rows = [(*row[:3], *sorted(row[3].split(','))) for row in db.execute(V3_EXPORT)]
+    db.close()
+
+    return dbpath, rows
+
+def test_read_only_does_not_upgrade(v3):
+    dbpath, rows = v3
+    with pytest.raises(Exception):
+        Db(dbpath)
+
+def test_upgrade_from_version_3(v3):
+    dbpath, rows = v3
+    db = Db(dbpath, mode='rw')
+    assert db.db_version == 6
+
+    # Same export rows
+    assert list(db.questions()) == rows
+
+    # Sources are keyed by (date, fingerprint)
+    assert db.fcount() == len(V3_SOURCES)
+    for path, status in V3_SOURCES:
+        assert db.exists(path)
+    assert db.cursor.execute("SELECT date, hash FROM sources ORDER BY date, hash").fetchall() == sorted(
+        sourcekey(path) for path, status in V3_SOURCES
+    )
+
+    # Integer dates and interned tags
+    assert db.cursor.execute("SELECT DISTINCT typeof(date) FROM views").fetchall() == [('integer',)]
+    assert db.cursor.execute("SELECT name FROM tagnames ORDER BY id").fetchall() == [
+        ('algorithm',), ('c++',), ('java',), ('python',),
+    ]
+
+    # Nothing left over
+    tables = {name for (name,) in db.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert not [name for name in tables if name.endswith('_v4')]
+
+def test_upgraded_database_is_writable(v3):
+    dbpath, rows = v3
+    db = Db(dbpath, mode='rw')
+    db.write([('20140101000000/stackoverflow.com/questions/5', 'OK', (
+        dict(id='5', date='20140101000000', viewcount=50, tags=['python', 'rust']),
+    ))])
+
+    assert list(db.questions(20140101000000)) == [('20140101000000', 5, 50, 'python', 'rust')]
+    assert db.cursor.execute("SELECT name FROM tagnames ORDER BY id").fetchall()[-1] == ('rust',)
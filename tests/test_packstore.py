@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+import queue
+import hashlib
+import threading
+import subprocess
+import multiprocessing
+
+from utils import ByteBudget, pack, unpack
+from utils.packstore import PackWriter, pages, index, segments, records, BODY
+from workers.reader import reader
+from config.commands import *
+
+from conftest import commands
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def sha1(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+def add(store, path, text, kind='question'):
+    return store.add(path, kind, pack(text), sha1(text))
+
+def test_roundtrip(tmp_path):
+    store = PackWriter(str(tmp_path))
+    assert add(store, '20100101000000/stackoverflow.com/questions/1', 'page 1')
+    assert add(store, '20100101000000/stackoverflow.com/questions/tagged/python', 'page 2', 'tagged')
+
+    assert [(path, kind, unpack(data)) for path, kind, data in pages(str(tmp_path))] == [
+        ('20100101000000/stackoverflow.com/questions/1', 'question', 'page 1'),
+        ('20100101000000/stackoverflow.com/questions/tagged/python', 'tagged', 'page 2'),
+    ]
+
+def test_bodies_are_stored_once(tmp_path):
+    store = PackWriter(str(tmp_path))
+    assert add(store, '20100101000000/stackoverflow.com/questions/1', 'page')
+    assert not add(store, '20110101000000/stackoverflow.com/questions/1', 'page')
+    assert len(index(str(tmp_path))) == 1
+
+    # Also across writers
+    store = PackWriter(str(tmp_path))
+    assert not add(store, '20120101000000/stackoverflow.com/questions/1', 'page')
+    assert [path for path, kind, data in pages(str(tmp_path))] == [
+        '20100101000000/stackoverflow.com/questions/1',
+        '20110101000000/stackoverflow.com/questions/1',
+        '20120101000000/stackoverflow.com/questions/1',
+    ]
+
+def test_shared_index(tmp_path):
+    add(PackWriter(str(tmp_path)), '20100101000000/stackoverflow.com/questions/1', 'page')
+
+    digests = dict.fromkeys(index(str(tmp_path)), True)
+    first, second = PackWriter(str(tmp_path), digests=digests), PackWriter(str(tmp_path), digests=digests)
+    assert not add(first, '20110101000000/stackoverflow.com/questions/1', 'page')
+    assert not add(second, '20120101000000/stackoverflow.com/questions/1', 'page')
+
+def _add_shared(directory, digests, n):
+    add(PackWriter(directory, digests=digests), '2010010{}000000/stackoverflow.com/questions/1'.format(n), 'page')
+
+def test_shared_between_processes(tmp_path):
+    with multiprocessing.Manager() as manager:
+        digests = manager.dict()
+        processes = [
+            multiprocessing.Process(target=_add_shared, args=(str(tmp_path), digests, n))
+            for n in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(10)
+
+    bodies = 0
+    for filepath in segments(str(tmp_path)):
+        with open(filepath, 'rb') as f:
+            bodies += sum(1 for type, offset, length in records(f) if type == BODY)
+    assert bodies == 1
+    assert len(list(pages(str(tmp_path)))) == 4
+
+def test_body_in_a_later_segment(tmp_path):
+    # The second writer stores the body, the first one only refers to it
+    digests = {}
+    first, second = PackWriter(str(tmp_path), digests=digests), PackWriter(str(tmp_path), digests=digests)
+    add(first, '20100101000000/stackoverflow.com/questions/0', 'other')
+    time.sleep(0.01) # segments are named after the time they were opened
+    add(second, '20100101000000/stackoverflow.com/questions/1', 'page')
+    add(first, '20110101000000/stackoverflow.com/questions/1', 'page')
+    assert len(segments(str(tmp_path))) == 2
+
+    assert sorted((path, unpack(data)) for path, kind, data in pages(str(tmp_path))) == [
+        ('20100101000000/stackoverflow.com/questions/0', 'other'),
+        ('20100101000000/stackoverflow.com/questions/1', 'page'),
+        ('20110101000000/stackoverflow.com/questions/1', 'page'),
+    ]
+
+def test_truncated_segment(tmp_path):
+    store = PackWriter(str(tmp_path))
+    add(store, '20100101000000/stackoverflow.com/questions/1', 'page 1')
+    add(store, '20100101000000/stackoverflow.com/questions/2', 'page 2')
+    store.file.close()
+
+    (filepath,) = segments(str(tmp_path))
+    with open(filepath, 'r+b') as f:
+        f.truncate(os.path.getsize(filepath) - 1)
+
+    assert [path for path, kind, data in pages(str(tmp_path))] == ['20100101000000/stackoverflow.com/questions/1']
+
+def test_segment_size(tmp_path):
+    store = PackWriter(str(tmp_path), size=1)
+    add(store, '20100101000000/stackoverflow.com/questions/1', 'page 1')
+    time.sleep(0.01)
+    add(store, '20100101000000/stackoverflow.com/questions/2', 'page 2')
+
+    assert len(segments(str(tmp_path))) == 2
+
+def test_reader(tmp_path):
+    store = PackWriter(str(tmp_path))
+    add(store, '20100101000000/stackoverflow.com/questions/1', 'page 1')
+    add(store, '20100101000000/stackoverflow.com/questions/tagged/python', 'page 2', 'tagged')
+
+    ctrl, parsers = queue.Queue(), queue.Queue()
+    budget = ByteBudget(1 << 20)
+    threading.Thread(target=reader, args=(ctrl, parsers, budget, str(tmp_path)), daemon=True).start()
+
+    cmds = commands(ctrl, 3)
+    assert [cmd[:2] for cmd in cmds] == [
+        (PARSE, '20100101000000/stackoverflow.com/questions/1'),
+        (PARSE, '20100101000000/stackoverflow.com/questions/tagged/python'),
+        (EOF,),
+    ]
+    assert [parsers.get(timeout=1)[:2] for n in range(2)] == [
+        ('20100101000000/stackoverflow.com/questions/1', 'question'),
+        ('20100101000000/stackoverflow.com/questions/tagged/python', 'tagged'),
+    ]
+    assert int(budget) == sum(cmd[2] for cmd in cmds[:2])
+
+def test_reparse_needs_a_store(tmp_path):
+    env = dict(os.environ, PYTHONPATH=ROOT, DEBUG='', PACK_STORE_DIR='')
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'master.py'), '--reparse'],
+        cwd=tmp_path, env=env, capture_output=True, text=True
+    )
+    assert result.returncode == 2
+    assert 'PACK_STORE_DIR' in result.stderr
+    assert not os.listdir(tmp_path)
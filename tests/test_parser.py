@@ -0,0 +1,160 @@
+import os
+
+import pytest
+
+from workers.parser import visit, Layouts
+from workers.layouts import LAYOUTS
+from config.constants import *
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name + '.html'), encoding='utf-8') as f:
+        return f.read()
+
+# fixture: (date, id, viewcount, tags)
+QUESTIONS = {
+    '2019': ('20190601120000', '11111', 12345, ['html-parsing', 'python']),
+    '2019-alt': ('20200301000000', '22222', 9876, ['dom-events', 'javascript']),
+    '2015': ('20160512000000', '33333', 1234, ['c#', 'null']),
+    '2013': ('20131105000000', '44444', 4321, ['generics', 'java']),
+    '2009': ('20100215000000', '55555', 567, ['list', 'sorting']),
+    '2008': ('20081001000000', '66666', 89, ['regex']),
+    'beta': ('20080801000000', '77777', 42, ['editor', 'tools']),
+    'beta-alt': ('20080805000000', '88888', 17, ['ide']),
+}
+
+@pytest.mark.parametrize('engine', ('soup', 'lxml'))
+@pytest.mark.parametrize('name', QUESTIONS)
+def test_question_layout(name, engine):
+    date, qid, viewcount, tags = QUESTIONS[name]
+    path = date + '/stackoverflow.com/questions/' + qid
+
+    assert visit(fixture(name), path, PAGE_QUESTION, engine=engine) == (PARSER_OK, (dict(
+        date=date,
+        id=qid,
+        viewcount=viewcount,
+        tags=tags,
+    ),))
+
+@pytest.mark.parametrize('engine', ('soup', 'lxml'))
+def test_tagged(engine):
+    status, items = visit(fixture('tagged'), '20140101000000/stackoverflow.com/questions/tagged/python', PAGE_TAGGED, engine=engine)
+
+    assert status == PARSER_OK
+    assert items == [
+        dict(id='101', date='20140101000000', viewcount=1234, tags=['django', 'python']),
+        dict(id='102', date='20140101000000', viewcount=56, tags=['python']),
+    ]
+
+@pytest.mark.parametrize('name', [*QUESTIONS, 'tagged'])
+def test_engine_parity(name):
+    text = fixture(name)
+    kind = PAGE_TAGGED if name == 'tagged' else PAGE_QUESTION
+    path = '20100101000000/stackoverflow.com/questions/1'
+
+    assert visit(text, path, kind, engine='lxml') == visit(text, path, kind, engine='soup')
+
+@pytest.mark.parametrize('html', (
+    # Script and style text is not part of the soup `get_text` or `strings`
+    '<div class="viewcount"><b><script>var n = 5;</script>31</b></div>',
+    '<div class="viewcount"><b><style>b { width: 5px }</style>31</b></div>',
+    # ...but `find(string=...)` also searches scripts and comments
+    '<table id="qinfo"><tr><td><script>var s = "7 times";</script></td><td>31 times</td></tr></table>',
+    '<table id="qinfo"><tr><td><!-- 7 times --></td><td>31 times</td></tr></table>',
+))
+def test_engine_parity_text(html):
+    text = """<html><head>
+        <link rel="canonical" href="http://web.archive.org/web/20130101000000/http://stackoverflow.com/questions/1/q">
+        </head><body>{}<a rel="tag">tag</a></body></html>""".format(html)
+    path = '20130101000000/stackoverflow.com/questions/1'
+
+    soup = visit(text, path, PAGE_QUESTION, engine='soup')
+    assert soup[0] == PARSER_OK
+    assert visit(text, path, PAGE_QUESTION, engine='lxml') == soup
+
+def test_data_not_found():
+    text = '<html><body><p>Nothing here</p></body></html>'
+    path = '20130101000000/stackoverflow.com/questions/1'
+
+    for engine in ('soup', 'lxml'):
+        assert visit(text, path, PAGE_QUESTION, engine=engine) == (PARSER_DATA_NOT_FOUND_ERROR,)
+
+AMBIGUOUS = """<html><head>
+    <link rel="canonical" href="http://web.archive.org/web/{date}/http://stackoverflow.com/questions/1/q">
+    </head><body>
+    <div id="question-header"><div>viewed 111 times</div></div>
+    <table id="qinfo"><tr><td>222 times</td></tr></table>
+    <div id="sidebar"><p class="label-key">viewed</p><p>333 times</p></div>
+    <a rel="tag">tag</a>
+    </body></html>"""
+
+@pytest.mark.parametrize('engine', ('soup', 'lxml'))
+@pytest.mark.parametrize('date, viewcount', (
+    # The layout of the capture era wins over the other matching ones
+    ('20160101000000', 111),
+    ('20131105000000', 222),
+    ('20100101000000', 333),
+    # No era layout: the first matching one in the LAYOUTS order
+    ('20200101000000', 111),
+    ('20080101000000', 111),
+))
+def test_era_dispatch(date, viewcount, engine):
+    path = date + '/stackoverflow.com/questions/1'
+    status, (item,) = visit(AMBIGUOUS.format(date=date), path, PAGE_QUESTION, engine=engine)
+
+    assert item['viewcount'] == viewcount
+
+def test_layout_order():
+    layouts = Layouts()
+
+    assert layouts.order('20131105000000') == ('2013', '2019', '2019-alt', '2015', '2009', '2008', 'beta', 'beta-alt')
+    assert layouts.order('20080915000000')[0] == '2008'
+    assert layouts.order('20080914235959')[0] == 'beta'
+
+def test_fallbacks_by_hits():
+    layouts = Layouts()
+    layouts.counters['beta'][0] = 2
+    layouts.counters['2009'][0] = 5
+    layouts.counters['2019'][1] = 10 # misses don't count
+
+    assert layouts.order('20131105000000') == ('2013', '2009', 'beta', '2019', '2019-alt', '2015', '2008', 'beta-alt')
+    # The era layout comes first whatever its hits
+    assert layouts.order('20100101000000')[0] == '2009'
+    assert layouts.order('20080801000000') == ('beta', '2009', '2019', '2019-alt', '2015', '2013', '2008', 'beta-alt')
+
+@pytest.mark.parametrize('engine', ('soup', 'lxml'))
+def test_layout_counters(engine):
+    stats = {}
+    layouts = Layouts(stats)
+    for name in ('2015', '2013'):
+        date, qid, *_ = QUESTIONS[name]
+        visit(fixture(name), date + '/stackoverflow.com/questions/' + qid, PAGE_QUESTION, engine=engine, layouts=layouts)
+
+    assert stats['layout']['2015'] == [1, 0]
+    assert stats['layout']['2013'] == [1, 0]
+
+    # A 2019 page without the 2019 layout: tried then missed
+    date, qid, *_ = QUESTIONS['2019-alt']
+    visit(fixture('2019-alt'), date + '/stackoverflow.com/questions/' + qid, PAGE_QUESTION, engine=engine, layouts=layouts)
+    assert stats['layout']['2019'] == [0, 1]
+    assert stats['layout']['2019-alt'] == [1, 0]
+
+def test_finders():
+    from workers import parser, xpath
+
+    names = [name for name, since in LAYOUTS]
+    assert list(parser.FINDERS) == names
+    assert list(xpath.FINDERS) == names
+
+def test_kind():
+    # Without a kind, the page kind is guessed from the path
+    html = fixture('tagged')
+    path = '20140101000000/stackoverflow.com/questions/tagged/python'
+    assert visit(html, path) == visit(html, path, PAGE_TAGGED)
+
+    # The kind given wins over the path
+    date, qid, viewcount, tags = QUESTIONS['2013']
+    status, (item,) = visit(fixture('2013'), date + '/stackoverflow.com/questions/tagged/' + qid, PAGE_QUESTION)
+    assert status == PARSER_OK
+    assert item['viewcount'] == viewcount
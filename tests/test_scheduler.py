@@ -0,0 +1,57 @@
+from collections import Counter
+
+from utils.scheduler import Scheduler, MIN_YIELD
+
+def fill(scheduler, kind, count):
+    for n in range(count):
+        scheduler.push(kind, (kind, n))
+
+def test_fifo_per_kind():
+    scheduler = Scheduler(dict(question=1))
+    fill(scheduler, 'question', 3)
+
+    assert len(scheduler) == 3
+    assert [scheduler.pop() for n in range(3)] == [('question', 0), ('question', 1), ('question', 2)]
+    assert not scheduler
+
+def test_shares_follow_the_expected_yield():
+    scheduler = Scheduler(dict(question=1, tagged=4))
+    fill(scheduler, 'question', 100)
+    fill(scheduler, 'tagged', 100)
+
+    served = Counter(scheduler.pop()[0] for n in range(50))
+    assert served == dict(tagged=40, question=10)
+
+def test_no_starvation():
+    scheduler = Scheduler(dict(question=MIN_YIELD / 10, tagged=50))
+    fill(scheduler, 'question', 1)
+    fill(scheduler, 'tagged', 1000)
+
+    kinds = [scheduler.pop()[0] for n in range(1000)]
+    assert 'question' in kinds
+
+def test_running_mean():
+    scheduler = Scheduler(dict(question=1, tagged=50))
+    assert scheduler.expected('tagged') == 50
+
+    # Failed attempts count as zero rows
+    scheduler.record('tagged', 0)
+    assert scheduler.expected('tagged') == 25
+    scheduler.record('tagged', 10)
+    assert scheduler.expected('tagged') == 20
+
+    for n in range(10):
+        scheduler.record('question', 0)
+    assert scheduler.expected('question') == MIN_YIELD
+
+def test_idle_kind_does_not_catch_up():
+    scheduler = Scheduler(dict(question=1, tagged=1))
+    fill(scheduler, 'tagged', 100)
+    for n in range(50):
+        scheduler.pop()
+
+    # Question pages arriving late share equally from now on, instead of
+    # getting the 50 turns they missed first
+    fill(scheduler, 'question', 100)
+    served = Counter(scheduler.pop()[0] for n in range(20))
+    assert abs(served['question'] - served['tagged']) <= 2
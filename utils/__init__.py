@@ -1,6 +1,8 @@
 import sys
 import os
 import time
+import zlib
+import multiprocessing
 
 from config.constants import *
 
@@ -8,6 +10,40 @@ def notify(code, *args):
     print("{:6d} {:8s}".format(os.getpid(), code), *args)
     sys.stdout.flush()
 
+def pack(text):
+    """ Compress a page body before handing it over to another process
+    """
+    return zlib.compress(text.encode('utf-8'), PAGE_COMPRESSION_LEVEL)
+
+def unpack(data):
+    return zlib.decompress(data).decode('utf-8')
+
+class ByteBudget:
+    """ Bytes of page data in flight between processes
+
+        `acquire` blocks until the bytes fit in the budget. A page larger
+        than the whole budget still goes through when nothing else is in
+        flight.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.value = multiprocessing.Value('q', 0, lock=False)
+        self.cond = multiprocessing.Condition()
+
+    def acquire(self, size):
+        value = self.value
+        with self.cond:
+            self.cond.wait_for(lambda: not value.value or value.value + size <= self.limit)
+            value.value += size
+
+    def release(self, size):
+        with self.cond:
+            self.value.value -= size
+            self.cond.notify_all()
+
+    def __int__(self):
+        return self.value.value
+
 class Cooldown:
     def __init__(self):
         self.cooldown = 0
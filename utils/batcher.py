@@ -0,0 +1,65 @@
+import time
+from threading import Thread, Lock
+
+from config.constants import *
+from config.commands import *
+
+def push(ctrl, sem, captures, size=CHECK_BATCH_SIZE):
+    """ Send the captures to check to the controller in CHECK_MANY batches
+
+        Each capture takes a `sem` slot, given back by the controller. The
+        captures batched so far are sent before blocking on `sem`, so none
+        is held while waiting for the pipeline.
+    """
+    batch = []
+    def _flush():
+        if batch:
+            ctrl.put((CHECK_MANY, batch[:]))
+            del batch[:]
+
+    for capture in captures:
+        if not sem.acquire(False):
+            _flush()
+            sem.acquire()
+
+        batch.append(capture)
+        if len(batch) >= size:
+            _flush()
+    _flush()
+
+class Batcher:
+    """ Send commands to a queue in BATCH envelopes
+
+        Drop-in replacement for the `put` method of the queue. An envelope is
+        sent when it holds `size` commands, or after `age` seconds at most,
+        so a worker blocked on its input never holds commands back.
+    """
+    def __init__(self, queue, size=BATCH_SIZE, age=BATCH_MAX_AGE):
+        self.queue = queue
+        self.size = size
+        self.age = age
+        self.batch = []
+        self.lock = Lock()
+
+        Thread(target=self._timer, daemon=True).start()
+
+    def put(self, command):
+        with self.lock:
+            self.batch.append(command)
+            if len(self.batch) >= self.size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.batch:
+            # The queue pickles the envelope later, from its feeder thread
+            self.queue.put((BATCH, self.batch))
+            self.batch = []
+
+    def _timer(self):
+        while True:
+            time.sleep(self.age)
+            self.flush()
@@ -0,0 +1,114 @@
+import re
+import sqlite3
+
+CDX_INDEX_INIT="""
+    PRAGMA journal_mode=WAL;
+
+    CREATE TABLE IF NOT EXISTS captures (
+        question INT NOT NULL,
+        timestamp INT NOT NULL,
+        original TEXT NOT NULL,
+        statuscode TEXT NOT NULL,
+        digest TEXT,
+        PRIMARY KEY(question, timestamp, original)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS captures_timestamp_idx ON captures(timestamp);
+
+    CREATE TABLE IF NOT EXISTS partitions (
+        start TEXT NOT NULL,
+        end TEXT NOT NULL,
+        resumeKey TEXT,
+        complete INT NOT NULL DEFAULT 0,
+        PRIMARY KEY(start, end)
+    );
+"""
+CDX_INDEX_ADD_DIGEST="ALTER TABLE captures ADD COLUMN digest TEXT"
+CDX_INDEX_INSERT_CAPTURE="INSERT OR IGNORE INTO captures(question, timestamp, original, statuscode, digest) VALUES(?, ?, ?, ?, ?)"
+CDX_INDEX_UPDATE_PARTITION="INSERT OR REPLACE INTO partitions(start, end, resumeKey, complete) VALUES(?, ?, ?, ?)"
+CDX_INDEX_SELECT_PARTITION="SELECT resumeKey, complete FROM partitions WHERE start = ? AND end = ?"
+CDX_INDEX_SELECT_RANGE="""
+    SELECT timestamp, original, statuscode, digest FROM captures
+    WHERE timestamp BETWEEN ? AND ?
+    ORDER BY timestamp
+"""
+CDX_INDEX_SELECT_QUESTION="""
+    SELECT timestamp, original, statuscode, digest FROM captures
+    WHERE question = ?
+    ORDER BY timestamp
+"""
+
+QUESTION_ID_RE = re.compile('/questions/([0-9]+)')
+
+def questionid(original):
+    m = QUESTION_ID_RE.search(original)
+    return int(m.group(1)) if m else 0
+
+def _capture(row):
+    timestamp, original, statuscode, digest = row
+    return dict(timestamp='{:014d}'.format(timestamp), original=original, statuscode=statuscode, digest=digest)
+
+class CdxIndex:
+    """ Local copy of the CDX pages already fetched
+
+        Captures are sorted by question id and timestamp. For each
+        (from, to) partition, the index keeps the resume key of the next
+        page to fetch and whether the partition is complete.
+    """
+    def __init__(self, filepath, *, timeout=600):
+        db = sqlite3.connect(filepath, isolation_level=None, timeout=timeout)
+
+        self.cursor = cursor = db.cursor()
+        cursor.executescript(CDX_INDEX_INIT)
+
+        # Indexes created before the digest was requested
+        columns = [column for cid, column, *_ in cursor.execute("PRAGMA table_info(captures)")]
+        if 'digest' not in columns:
+            cursor.execute(CDX_INDEX_ADD_DIGEST)
+
+    def add(self, partition, items, resumeKey):
+        """ Store a CDX page and the key of the next one
+
+            A `None` resume key marks the partition as complete.
+        """
+        cursor = self.cursor
+
+        try:
+            cursor.execute("BEGIN IMMEDIATE TRANSACTION")
+            cursor.executemany(CDX_INDEX_INSERT_CAPTURE, (
+                (questionid(item['original']), int(item['timestamp']), item['original'], item.get('statuscode', ''), item.get('digest'))
+                for item in items
+            ))
+            cursor.execute(CDX_INDEX_UPDATE_PARTITION, (*partition, resumeKey, resumeKey is None))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+    def position(self, partition):
+        """ Return the (resumeKey, complete) state of a partition
+        """
+        cursor = self.cursor
+        cursor.execute(CDX_INDEX_SELECT_PARTITION, partition)
+        result = cursor.fetchall()
+        if not result:
+            return (None, False)
+
+        ((resumeKey, complete),) = result
+        return (resumeKey, bool(complete))
+
+    def captures(self, partition):
+        """ Iterate over the captures already indexed for a partition
+        """
+        start, end = partition
+        start = int(start.ljust(14, '0'))
+        end = int(end.ljust(14, '9'))
+
+        cursor = self.cursor.connection.cursor()
+        for row in cursor.execute(CDX_INDEX_SELECT_RANGE, (start, end)):
+            yield _capture(row)
+
+    def question(self, question):
+        """ Return all the captures of a question
+        """
+        cursor = self.cursor
+        return [_capture(row) for row in cursor.execute(CDX_INDEX_SELECT_QUESTION, (int(question),))]
@@ -0,0 +1,130 @@
+""" Memory-mappable columnar export format
+
+    A file starts with `MAGIC`, followed by the length of a JSON header as a
+    little-endian 64-bit integer, and by the header itself. The header gives
+    the number of rows, the byte order, and the type code (see `array`),
+    offset and length of each column. Columns are 8-byte aligned so they can
+    be mapped without any copy:
+
+    question, date, viewcount   one 64-bit integer per row
+    tag_offsets                 rows+1 offsets of each row's tags in tag_ids
+    tag_ids                     32-bit indices in the tag dictionary
+    dict_offsets, dict_data     tag names as UTF-8 bytes, with their offsets
+"""
+import sys
+import json
+import mmap
+from array import array
+
+MAGIC=b'SODCOL1\n'
+ALIGN=8
+
+class Writer:
+    def __init__(self):
+        self.question = array('q')
+        self.date = array('q')
+        self.viewcount = array('q')
+        self.tag_offsets = array('q', [0])
+        self.tag_ids = array('i')
+        self.tags = {}
+
+    def __len__(self):
+        return len(self.question)
+
+    def append(self, row):
+        date, question, viewcount, *tags = row
+
+        self.question.append(int(question))
+        self.date.append(int(date))
+        self.viewcount.append(int(viewcount))
+        for tag in tags:
+            self.tag_ids.append(self.tags.setdefault(tag, len(self.tags)))
+        self.tag_offsets.append(len(self.tag_ids))
+
+    def write(self, filepath):
+        names = [tag.encode('utf-8') for tag in self.tags]
+        dict_offsets = array('q', [0])
+        for name in names:
+            dict_offsets.append(dict_offsets[-1] + len(name))
+
+        columns = (
+            ('question', self.question),
+            ('date', self.date),
+            ('viewcount', self.viewcount),
+            ('tag_offsets', self.tag_offsets),
+            ('tag_ids', self.tag_ids),
+            ('dict_offsets', dict_offsets),
+            ('dict_data', array('B', b''.join(names))),
+        )
+
+        # The header size depends on the offsets and the other way around:
+        # reserve a fixed amount of room for it
+        header = dict(rows=len(self), byteorder=sys.byteorder, columns={})
+        offset = len(MAGIC) + 8 + 4096
+        for name, column in columns:
+            header['columns'][name] = dict(type=column.typecode, offset=offset, length=len(column))
+            offset += -(-len(column)*column.itemsize // ALIGN) * ALIGN
+
+        data = json.dumps(header).encode('utf-8')
+        if len(data) > 4096:
+            raise ValueError('Columnar header too large')
+
+        with open(filepath, 'wb') as f:
+            f.write(MAGIC)
+            f.write(len(data).to_bytes(8, 'little'))
+            f.write(data)
+            for name, column in columns:
+                f.seek(header['columns'][name]['offset'])
+                column.tofile(f)
+
+            f.truncate(offset)
+
+class Reader:
+    """ Map a columnar file: each column is a zero-copy `memoryview`
+    """
+    def __init__(self, filepath):
+        with open(filepath, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(self.map)
+        if view[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a columnar file: {}'.format(filepath))
+
+        start = len(MAGIC)
+        size = int.from_bytes(view[start:start+8], 'little')
+        header = json.loads(bytes(view[start+8:start+8+size]).decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('Unsupported byte order: {}'.format(header['byteorder']))
+
+        self.rows = header['rows']
+        self.columns = {}
+        for name, column in header['columns'].items():
+            itemsize = array(column['type']).itemsize
+            offset = column['offset']
+            self.columns[name] = view[offset:offset+column['length']*itemsize].cast(column['type'])
+
+        dict_offsets = self.columns['dict_offsets']
+        dict_data = self.columns['dict_data']
+        self.tags = [
+            bytes(dict_data[dict_offsets[n]:dict_offsets[n+1]]).decode('utf-8')
+            for n in range(len(dict_offsets)-1)
+        ]
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return self.rows
+
+    def row(self, n):
+        """ Rebuild the CSV row at index `n`
+        """
+        tag_offsets = self['tag_offsets']
+        tag_ids = self['tag_ids'][tag_offsets[n]:tag_offsets[n+1]]
+
+        return (
+            str(self['date'][n]),
+            self['question'][n],
+            self['viewcount'][n],
+            *[self.tags[tag] for tag in tag_ids],
+        )
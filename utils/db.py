@@ -1,6 +1,15 @@
 import sqlite3
+import hashlib
+from contextlib import contextmanager
 
 DB_DEFAULT_TIMEOUT=600
+
+# Readers in WAL mode see a snapshot and never block the writer. The WAL
+# file is truncated back to this size after being checkpointed.
+DB_WRITER_PRAGMAS="""
+    PRAGMA journal_mode=WAL;
+    PRAGMA journal_size_limit=67108864;
+"""
 DB_INIT="""
     CREATE TABLE IF NOT EXISTS sources (
         path TEXT PRIMARY KEY
@@ -25,34 +34,103 @@ DB_INIT="""
     );
     INSERT OR IGNORE INTO meta(key,value) VALUES ('version','0')
 """
-DB_SELECT_SOURCE="SELECT 1 FROM sources WHERE path = :path"
-DB_INSERT_SOURCE="INSERT OR REPLACE INTO sources(path, status) VALUES(:path, :status)"
-DB_INSERT_TAG="INSERT OR IGNORE INTO tags(question, tag) VALUES(:question, :tag)"
-DB_INSERT_VIEWCOUNT="INSERT OR IGNORE INTO views(question, date, viewcount) VALUES(:question, :date, :viewcount)"
+DB_SELECT_SOURCE="SELECT 1 FROM sources WHERE date = ? AND hash = ?"
+DB_SELECT_SOURCES="""
+    SELECT sources.date, sources.hash
+    FROM (VALUES {}) AS keys
+        INNER JOIN sources ON sources.date = keys.column1 AND sources.hash = keys.column2
+"""
+DB_SELECT_CHUNK=400
+DB_SELECT_TAGNAMES="SELECT name, id FROM tagnames WHERE name IN ({})"
+DB_INSERT_SOURCE="INSERT OR REPLACE INTO sources(date, hash, status) VALUES(?, ?, ?)"
+DB_INSERT_TAGNAME="INSERT OR IGNORE INTO tagnames(name) VALUES(?)"
+DB_INSERT_TAG="INSERT OR IGNORE INTO tags(question, tag) VALUES(?, ?)"
+# The last view count parsed wins, e.g. after `master.py --reparse`
+DB_INSERT_VIEWCOUNT="""
+    INSERT INTO views(question, date, viewcount) VALUES(?, ?, ?)
+    ON CONFLICT(date, question) DO UPDATE SET viewcount = excluded.viewcount
+"""
+DB_INSERT_CHANGE="INSERT OR IGNORE INTO changes(batch, year) VALUES(?, ?)"
+DB_SELECT_TAGS="SELECT question, tag FROM tags WHERE question IN ({})"
+DB_SELECT_YEARS="SELECT DISTINCT date / 10000000000 FROM views WHERE question IN ({})"
+DB_INSERT_FRONTIER="INSERT OR REPLACE INTO frontier(path, url, kind, digest, ttl) VALUES(?, ?, ?, ?, ?)"
+DB_DELETE_FRONTIER="DELETE FROM frontier WHERE path = ?"
+DB_INSERT_POSITION="INSERT OR REPLACE INTO positions(start, end, resumeKey, complete) VALUES(?, ?, ?, ?)"
+
+# Trade some durability on power loss for write throughput. Checkpoints
+# are left to a dedicated connection, see `Db.checkpoint`
+DB_INGEST_PRAGMAS="""
+    PRAGMA synchronous=NORMAL;
+    PRAGMA cache_size=-262144;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA wal_autocheckpoint=0;
+"""
 
 DB_COUNT_SOURCES="SELECT COUNT(*) FROM sources"
+DB_SELECT_SOURCE_FINGERPRINTS="SELECT hash FROM sources ORDER BY hash"
+# Same encoding as `utils.known.Coverage.slot`: the question id in the high
+# bits, and the proleptic Gregorian ordinal of the capture day divided by
+# the period in the low 20 bits
+DB_SELECT_VIEW_SLOTS="""
+    SELECT DISTINCT (question << 20) | (CAST(julianday(printf('%04d-%02d-%02d',
+            date / 10000000000, date / 100000000 % 100, date / 1000000 % 100
+        )) - 1721424.5 AS INT) / :days) AS slot
+    FROM views
+    ORDER BY slot
+"""
+
+def fingerprint(path):
+    """ Signed 64-bit hash of a source path
+    """
+    digest = hashlib.sha1(path.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+def pathdate(path):
+    """ Capture timestamp of a source path as an integer
+    """
+    date = path[:14]
+    return int(date) if date.isdigit() else 0
+
+YEAR=10**10 # A year in a YYYYMMDDhhmmss integer timestamp
+
+def sourcekey(path):
+    return (pathdate(path), fingerprint(path))
 
 
 class Db:
-    def __init__(self, filepath, *, timeout=None, mode="ro"):
+    def __init__(self, filepath, *, timeout=None, mode="ro", upgrade=True):
+        """ Open the database at `filepath`
+
+            A writable connection sets the database up for the crawler and
+            upgrades its schema, unless `upgrade` is False. Otherwise, the
+            schema must already be the current one.
+        """
         if timeout is None:
             timeout = DB_DEFAULT_TIMEOUT
 
         uri = "file:{filepath}?mode={mode}".format(filepath=filepath, mode=mode)
         db = sqlite3.connect(uri, uri=True, isolation_level=None, timeout=timeout)
+        db.create_function('fingerprint', 1, fingerprint)
+        db.create_function('pathdate', 1, pathdate)
+        self.db = db
+        self.tagids = {}
 
         self.cursor = cursor = db.cursor()
 
+        upgrade = upgrade and 'w' in mode
+        if upgrade:
+            cursor.executescript(DB_WRITER_PRAGMAS)
+
         if 'c' in mode:
             cursor.executescript(DB_INIT)
 
-        self.loadMetadata('w' in mode)
+        self.loadMetadata(upgrade)
 
     #
     # Metadata
     #
     def loadMetadata(self, upgrade):
-        CURR_DB_VERSION = 3
+        CURR_DB_VERSION = 6
 
         def updateToVersion1():
             cursor.executescript("""
@@ -93,11 +171,113 @@ class Db:
                 COMMIT;
             """)
 
+        def updateToVersion4():
+            # Integer dates, interned tags and sources keyed by
+            # (capture date, path fingerprint) instead of the full path
+            cursor.executescript("""
+                BEGIN DEFERRED TRANSACTION;
+                DROP TABLE IF EXISTS sources_v4;
+                CREATE TABLE sources_v4 (
+                    date INT NOT NULL,
+                    hash INT NOT NULL,
+                    status TEXT NOT NULL,
+                    PRIMARY KEY(date, hash)
+                ) WITHOUT ROWID;
+
+                INSERT OR REPLACE INTO sources_v4(date, hash, status)
+                    SELECT pathdate(path), fingerprint(path), status FROM sources;
+
+                DROP TABLE sources;
+                ALTER TABLE sources_v4 RENAME TO sources;
+
+                DROP TABLE IF EXISTS tagnames;
+                CREATE TABLE tagnames (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL UNIQUE
+                );
+
+                INSERT INTO tagnames(name)
+                    SELECT DISTINCT tag FROM tags ORDER BY tag;
+
+                DROP TABLE IF EXISTS tags_v4;
+                CREATE TABLE tags_v4 (
+                    question INT NOT NULL,
+                    tag INT NOT NULL,
+                    PRIMARY KEY(question, tag)
+                ) WITHOUT ROWID;
+
+                INSERT INTO tags_v4(question, tag)
+                    SELECT question, tagnames.id
+                        FROM tags INNER JOIN tagnames ON tags.tag = tagnames.name;
+
+                DROP TABLE tags;
+                ALTER TABLE tags_v4 RENAME TO tags;
+
+                DROP TABLE IF EXISTS views_v4;
+                CREATE TABLE views_v4 (
+                    date INT NOT NULL,
+                    question INT NOT NULL,
+                    viewcount INT NOT NULL,
+                    PRIMARY KEY(date, question)
+                ) WITHOUT ROWID;
+
+                INSERT INTO views_v4(date, question, viewcount)
+                    SELECT CAST(date AS INT), question, viewcount FROM views;
+
+                DROP TABLE views;
+                ALTER TABLE views_v4 RENAME TO views;
+                CREATE INDEX views_question_idx ON views(question);
+
+                UPDATE meta SET value=4 where KEY='version';
+                COMMIT;
+            """)
+            cursor.execute("VACUUM")
+
+        def updateToVersion5():
+            # Capture years whose export rows were changed by each Db.write
+            # batch, to find what changed since a given batch
+            cursor.executescript("""
+                BEGIN DEFERRED TRANSACTION;
+                CREATE TABLE changes (
+                    batch INT NOT NULL,
+                    year INT NOT NULL,
+                    PRIMARY KEY(batch, year)
+                ) WITHOUT ROWID;
+                INSERT OR REPLACE INTO meta(key, value) VALUES ('batch', '0');
+                UPDATE meta SET value=5 where KEY='version';
+                COMMIT;
+            """)
+
+        def updateToVersion6():
+            # Crawl state saved along with the results, see `master.py --resume`
+            cursor.executescript("""
+                BEGIN DEFERRED TRANSACTION;
+                CREATE TABLE frontier (
+                    path TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    kind TEXT,
+                    digest TEXT,
+                    ttl INT NOT NULL
+                ) WITHOUT ROWID;
+                CREATE TABLE positions (
+                    start TEXT NOT NULL,
+                    end TEXT NOT NULL,
+                    resumeKey TEXT,
+                    complete INT NOT NULL DEFAULT 0,
+                    PRIMARY KEY(start, end)
+                );
+                UPDATE meta SET value=6 where KEY='version';
+                COMMIT;
+            """)
+
         cursor = self.cursor
         updater = (
             updateToVersion1,
             updateToVersion2,
             updateToVersion3,
+            updateToVersion4,
+            updateToVersion5,
+            updateToVersion6,
         )
 
         while True:
@@ -132,10 +312,37 @@ class Db:
     #
     # API
     #
+    def close(self):
+        self.db.close()
+
+    @contextmanager
+    def snapshot(self):
+        """ Run all the queries of the block against the same snapshot
+        """
+        cursor = self.cursor
+
+        cursor.execute("BEGIN DEFERRED TRANSACTION")
+        try:
+            yield self
+        finally:
+            cursor.execute("COMMIT")
+
+    def checkpoint(self, mode="PASSIVE"):
+        """ Copy the WAL content back to the database
+
+            Return the (busy, log, checkpointed) frame counts reported
+            by SQLite.
+        """
+        cursor = self.cursor
+        cursor.execute("PRAGMA wal_checkpoint({})".format(mode))
+        ((busy, log, checkpointed),) = cursor.fetchall()
+
+        return (busy, log, checkpointed)
+
     def exists(self, path):
         cursor = self.cursor
 
-        cursor.execute(DB_SELECT_SOURCE, dict(path=path))
+        cursor.execute(DB_SELECT_SOURCE, sourcekey(path))
         result = cursor.fetchall()
 
         if not result:
@@ -143,37 +350,112 @@ class Db:
 
         return bool(result[0][0])
 
-    def write(self, entries):
+    def missing(self, paths):
+        """ Return the paths not already in the `sources` table
+        """
+        cursor = self.cursor
+        found = set()
+
+        keys = {path: sourcekey(path) for path in paths}
+        values = list(keys.values())
+        for n in range(0, len(values), DB_SELECT_CHUNK):
+            chunk = values[n:n+DB_SELECT_CHUNK]
+            query = DB_SELECT_SOURCES.format(",".join(["(?,?)"]*len(chunk)))
+            args = [value for key in chunk for value in key]
+            found.update(cursor.execute(query, args))
+
+        return [path for path, key in keys.items() if key not in found]
+
+    def selectIn(self, query, values):
+        """ Return the rows of `query` for all the `values`, which are bound
+            to its `IN ({})` clause by chunks
+        """
+        cursor = self.cursor
+        rows = []
+        for n in range(0, len(values), DB_SELECT_CHUNK):
+            chunk = values[n:n+DB_SELECT_CHUNK]
+            rows.extend(cursor.execute(query.format(",".join("?"*len(chunk))), chunk))
+
+        return rows
+
+    def tagIds(self, names):
+        """ Return the id of each tag name, interning the new ones
+        """
+        cursor = self.cursor
+        tagids = self.tagids
+
+        unknown = [name for name in set(names) if name not in tagids]
+        if unknown:
+            cursor.executemany(DB_INSERT_TAGNAME, ((name,) for name in unknown))
+            tagids.update(self.selectIn(DB_SELECT_TAGNAMES, unknown))
+
+        return tagids
+
+    def ingest(self):
+        """ Tune the connection for bulk writes
+        """
+        self.cursor.executescript(DB_INGEST_PRAGMAS)
+
+    def write(self, entries, frontier=None):
+        """ Write a batch of parser results in a single transaction
+
+            `frontier` holds the crawl state changes since the previous batch:
+            the captures to `add` to the frontier or to `remove` from it, and
+            the CDX `positions` reached. The captures written are removed
+            from the frontier.
+
+            Return the number of rows written.
+        """
         cursor = self.cursor
 
-        def _write(path, status, items):
-            cursor.execute(DB_INSERT_SOURCE, dict(path=path, status=status))
+        sources = []
+        views = []
+        tags = []
+        for path, status, items in entries:
+            sources.append((*sourcekey(path), status))
             for item in items:
-                cursor.execute(DB_INSERT_VIEWCOUNT, dict(
-                    question=item['id'],
-                    date=item['date'],
-                    viewcount=item['viewcount']
-                ))
-                for tag in item['tags']:
-                    cursor.execute(DB_INSERT_TAG, dict(
-                        question=item['id'],
-                        tag=tag
-                    ))
+                views.append((item['id'], int(item['date']), item['viewcount']))
+                tags.extend((item['id'], tag) for tag in item['tags'])
 
         try:
             cursor.execute("BEGIN DEFERRED TRANSACTION")
-            for entry in entries:
-                _write(*entry)
+            batch = self.batch() + 1
+            self.setMetadata('batch', batch)
+
+            tagids = self.tagIds(tag for question, tag in tags)
+            tags = [(int(question), tagids[tag]) for question, tag in tags]
+
+            # The export rows of a question change with its first capture of
+            # a year, or when it gets a new tag
+            questions = list({question for question, tag in tags})
+            new = set(tags).difference(self.selectIn(DB_SELECT_TAGS, questions))
+
+            cursor.executemany(DB_INSERT_SOURCE, sources)
+            cursor.executemany(DB_INSERT_VIEWCOUNT, views)
+            cursor.executemany(DB_INSERT_TAG, tags)
+
+            years = {date // YEAR for question, date, viewcount in views}
+            questions = list({question for question, tag in new})
+            years.update(year for (year,) in self.selectIn(DB_SELECT_YEARS, questions))
+            cursor.executemany(DB_INSERT_CHANGE, ((batch, year) for year in years))
+
+            if frontier:
+                cursor.executemany(DB_INSERT_FRONTIER, frontier['add'])
+                cursor.executemany(DB_DELETE_FRONTIER, ((path,) for path in frontier['remove']))
+                cursor.executemany(DB_INSERT_POSITION, frontier['positions'])
+            cursor.executemany(DB_DELETE_FRONTIER, ((path,) for path, status, items in entries))
             cursor.execute("COMMIT")
 
             del entries[:]
-            print("COMMIT")
 
         except Exception as e:
             cursor.execute("ROLLBACK")
+            self.tagids.clear()
             print("ROLLBACK")
             raise
 
+        return len(sources) + len(views) + len(tags)
+
     def fcount(self):
         cursor = self.cursor
         cursor.execute(DB_COUNT_SOURCES)
@@ -181,15 +463,99 @@ class Db:
 
         return count
 
-    def forEachQuestion(self, fct):
+    def sourceFingerprints(self):
+        """ Iterate over the fingerprints of all sources, in ascending order
+        """
+        cursor = self.cursor
+        for (fp,) in cursor.execute(DB_SELECT_SOURCE_FINGERPRINTS):
+            yield fp
+
+    def viewSlots(self, days):
+        """ Iterate over the distinct (question, period of `days` days) slots
+            of `views`, in ascending order
+        """
+        cursor = self.db.cursor()
+        for (slot,) in cursor.execute(DB_SELECT_VIEW_SLOTS, dict(days=days)):
+            yield slot
+
+    def frontier(self):
+        """ Iterate over the (path, url, kind, digest, ttl) captures left in
+            the frontier
+        """
+        cursor = self.db.cursor()
+        for row in cursor.execute("SELECT path, url, kind, digest, ttl FROM frontier"):
+            yield row
+
+    def positions(self):
+        """ Return the saved {(start, end): (resumeKey, complete)} CDX positions
+        """
+        cursor = self.cursor
+        return {
+            (start, end): (resumeKey, bool(complete))
+            for start, end, resumeKey, complete in cursor.execute("SELECT start, end, resumeKey, complete FROM positions")
+        }
+
+    def clearFrontier(self):
+        """ Forget the crawl state saved by a previous run
+        """
+        self.cursor.executescript("""
+            BEGIN DEFERRED TRANSACTION;
+            DELETE FROM frontier;
+            DELETE FROM positions;
+            COMMIT;
+        """)
+
+    def dateRange(self):
+        """ Return the (first, last) capture dates in `views`
+        """
+        cursor = self.cursor
+        cursor.execute("SELECT min(date), max(date) FROM views")
+        ((first, last),) = cursor.fetchall()
+
+        return (first, last)
+
+    def batch(self):
+        """ Number of the last batch written by `write`
+        """
+        return int(self.getMetadata('batch') or 0)
+
+    def changedYears(self, since, until):
+        """ Return the capture years whose export rows were changed by the
+            batches after `since` up to `until` (included)
+        """
         QUERY = """
-            SELECT date, question, viewcount, group_concat(tag, ',')
-            FROM views INNER JOIN tags USING (question)
+            SELECT DISTINCT year FROM changes
+                WHERE batch > :since AND batch <= :until
+                ORDER BY year
+        """
+        cursor = self.cursor
+        return [year for (year,) in cursor.execute(QUERY, locals())]
+
+    def questions(self, start=None, end=None):
+        """ Iterate over the (date, question, viewcount, *tags) rows captured
+            between `start` (included) and `end` (excluded)
+
+            Rows come in (date, question) order straight from the `views`
+            primary key, so no sort is needed.
+        """
+        QUERY = """
+            SELECT date, question, viewcount, group_concat(tagnames.name, ',')
+            FROM views
+                INNER JOIN tags USING (question)
+                INNER JOIN tagnames ON tagnames.id = tags.tag
+            WHERE date >= :start AND date < :end
             GROUP BY date, question
             ORDER BY date, question
         """
-        cursor = self.cursor
-        for row in cursor.execute(QUERY):
-            row = (*row[:3], *sorted(row[3].split(',')))
-            fct = fct(row)
+        if start is None:
+            start = 0
+        if end is None:
+            end = 10**14
 
+        cursor = self.db.cursor()
+        for row in cursor.execute(QUERY, dict(start=start, end=end)):
+            yield (str(row[0]), *row[1:3], *sorted(row[3].split(',')))
+
+    def forEachQuestion(self, fct):
+        for row in self.questions():
+            fct = fct(row)
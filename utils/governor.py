@@ -0,0 +1,46 @@
+import time
+
+from config.constants import *
+
+class Governor:
+    """ AIMD limit of the requests in flight to the Wayback Machine
+
+        The limit grows by one for each limit's worth of healthy responses,
+        and is cut by GOVERNOR_DECREASE on a throttled or failed request, or
+        when the recent latency rises above GOVERNOR_LATENCY_FACTOR times its
+        long-run average. Cuts are at most one per round-trip, since the
+        requests already in flight were sent under the previous limit.
+    """
+    def __init__(self, start, lower, upper):
+        self.limit = float(start)
+        self.lower = lower
+        self.upper = upper
+
+        self.latency = None # fast moving average
+        self.baseline = None # slow moving average
+        self.cut = 0
+
+    def ok(self, latency):
+        """ Account for a healthy response received after `latency` seconds
+        """
+        if self.latency is None:
+            self.latency = self.baseline = latency
+        else:
+            self.latency += (latency - self.latency) * 0.1
+            self.baseline += (latency - self.baseline) * 0.01
+
+        if self.latency > GOVERNOR_LATENCY_FACTOR * self.baseline:
+            self.decrease()
+        else:
+            self.limit = min(self.upper, self.limit + 1/self.limit)
+
+    def decrease(self):
+        now = time.time()
+        if now - self.cut < (self.latency or 0):
+            return
+
+        self.cut = now
+        self.limit = max(self.lower, self.limit * GOVERNOR_DECREASE)
+
+    def __int__(self):
+        return int(self.limit)
@@ -0,0 +1,100 @@
+import datetime
+from array import array
+from bisect import bisect_left
+
+from utils.db import fingerprint, pathdate
+from utils.cdxindex import questionid
+
+# Number of days in each sampling period
+PERIODS = {
+    'day': 1,
+    'week': 7,
+}
+
+class KnownSources:
+    """ Compact membership set of the paths already in the `sources` table
+
+        Paths are stored as 64-bit fingerprints: a sorted array for the
+        sources loaded at startup, and a set for the ones stored since.
+        False positives require a fingerprint collision.
+    """
+    def __init__(self):
+        self.snapshot = array('q')
+        self.added = set()
+
+    def load(self, db):
+        self.snapshot = array('q', db.sourceFingerprints())
+        self.added.clear()
+
+    def add(self, path):
+        self.added.add(fingerprint(path))
+
+    def __contains__(self, path):
+        fp = fingerprint(path)
+        if fp in self.added:
+            return True
+
+        snapshot = self.snapshot
+        i = bisect_left(snapshot, fp)
+        return i < len(snapshot) and snapshot[i] == fp
+
+    def __len__(self):
+        return len(self.snapshot) + len(self.added)
+
+class Coverage:
+    """ Sampling policy keeping at most one capture per question and period
+
+        A (question, period) slot is covered if `views` already has a row
+        for it or if a capture was claimed for it during this run. Slots are
+        encoded as 64-bit integers; the ones loaded at startup are kept in a
+        sorted array, like `KnownSources`.
+    """
+    def __init__(self, period):
+        self.days = PERIODS[period]
+        self.snapshot = array('q')
+        self.claimed = set()
+
+    def slot(self, question, date):
+        date = str(date)
+        day = datetime.date(int(date[0:4]), int(date[4:6]), int(date[6:8])).toordinal()
+        return (int(question) << 20) | (day // self.days)
+
+    def load(self, db):
+        self.snapshot = array('q', db.viewSlots(self.days))
+        self.claimed.clear()
+
+    def _slot(self, path):
+        question = questionid(path)
+        date = pathdate(path)
+        if not question or not date:
+            return None
+
+        return self.slot(question, date)
+
+    def claim(self, path):
+        """ Return True if the capture at `path` must be loaded
+
+            Pages that are not about a single question are always loaded.
+        """
+        slot = self._slot(path)
+        if slot is None:
+            return True
+
+        if slot in self.claimed:
+            return False
+
+        snapshot = self.snapshot
+        i = bisect_left(snapshot, slot)
+        if i < len(snapshot) and snapshot[i] == slot:
+            return False
+
+        self.claimed.add(slot)
+        return True
+
+    def release(self, path):
+        """ Give the slot back after a capture failed to load or parse
+        """
+        self.claimed.discard(self._slot(path))
+
+    def __len__(self):
+        return len(self.snapshot) + len(self.claimed)
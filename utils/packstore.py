@@ -0,0 +1,144 @@
+""" Content-addressed store of the raw pages
+
+    Pages are appended to segment files of about PACK_SEGMENT_SIZE bytes,
+    each one written by a single process. A segment is a sequence of
+    records made of a type byte, the length of the payload as a
+    little-endian 32-bit integer, and the payload:
+
+    BODY        SHA1 digest of the raw page as served, then the compressed
+                page (see `pack`)
+    CAPTURE     SHA1 digest of the body, then the page kind and the capture
+                path as UTF-8, separated by a NUL byte
+
+    A body is written once per digest, and each capture refers to it.
+"""
+import os
+import glob
+import time
+import struct
+from itertools import count
+from threading import Lock
+from contextlib import ExitStack
+
+from config.constants import *
+
+BODY=b'B'
+CAPTURE=b'C'
+HEADER=struct.Struct('<cI')
+DIGEST_SIZE=20
+
+def segments(directory):
+    """ Return the segment files of the store, oldest first
+    """
+    return sorted(glob.glob(os.path.join(directory, '*.pack')))
+
+def records(f):
+    """ Iterate over the (type, offset, length) of the payloads of a segment
+
+        A record truncated by an interrupted write ends the segment.
+    """
+    size = os.fstat(f.fileno()).st_size
+    offset = 0
+    while offset + HEADER.size <= size:
+        f.seek(offset)
+        type, length = HEADER.unpack(f.read(HEADER.size))
+        offset += HEADER.size
+        if offset + length > size:
+            break
+
+        yield (type, offset, length)
+        offset += length
+
+def index(directory):
+    """ Return the {digest: (segment file, offset, length)} of the bodies in
+        the store
+    """
+    bodies = {}
+    for filepath in segments(directory):
+        with open(filepath, 'rb') as f:
+            for type, offset, length in records(f):
+                if type == BODY:
+                    f.seek(offset)
+                    bodies[f.read(DIGEST_SIZE)] = (filepath, offset+DIGEST_SIZE, length-DIGEST_SIZE)
+
+    return bodies
+
+class PackWriter:
+    """ Append pages to a new segment of the store
+
+        Thread-safe. `digests` maps the digest of each body in the store,
+        or being written, to the writer that claimed it: only the writer
+        whose claim is inserted writes the body. By default, it holds the
+        bodies already in the store. Writers in several processes share
+        a `multiprocessing.Manager` dict built once from `index`.
+    """
+    def __init__(self, directory, size=PACK_SEGMENT_SIZE, digests=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.size = size
+        self.lock = Lock()
+        self.file = None
+        self.claims = count()
+
+        if digests is None:
+            digests = dict.fromkeys(index(directory), True)
+        self.digests = digests
+
+    def _roll(self):
+        if self.file is not None:
+            self.file.close()
+
+        filename = '{:013d}-{:d}.pack'.format(int(time.time()*1000), os.getpid())
+        self.file = open(os.path.join(self.directory, filename), 'ab')
+
+    def _write(self, type, *payload):
+        self.file.write(HEADER.pack(type, sum(len(part) for part in payload)))
+        for part in payload:
+            self.file.write(part)
+
+    def add(self, path, kind, data, digest):
+        """ Store the compressed page `data` of the capture at `path`, whose
+            raw content has the SHA1 `digest`
+
+            Return False if the body was already in the store.
+        """
+        with self.lock:
+            if self.file is None or self.file.tell() >= self.size:
+                self._roll()
+
+            # Atomic on a shared dict: one claim wins
+            claim = (os.getpid(), next(self.claims))
+            new = self.digests.setdefault(digest, claim) == claim
+            if new:
+                self._write(BODY, digest, data)
+
+            self._write(CAPTURE, digest, (kind or '').encode('utf-8'), b'\0', path.encode('utf-8'))
+            self.file.flush()
+
+        return new
+
+def pages(directory):
+    """ Iterate over the (path, kind, data) of all the captures in the store
+    """
+    bodies = index(directory)
+    with ExitStack() as stack:
+        files = {}
+        def _open(filepath):
+            if filepath not in files:
+                files[filepath] = stack.enter_context(open(filepath, 'rb'))
+            return files[filepath]
+
+        for filepath in segments(directory):
+            f = _open(filepath)
+            for type, offset, length in records(f):
+                if type != CAPTURE:
+                    continue
+
+                f.seek(offset)
+                digest = f.read(DIGEST_SIZE)
+                kind, path = f.read(length-DIGEST_SIZE).decode('utf-8').split('\0', 1)
+                if digest not in bodies:
+                    continue
+
+                body, offset, length = bodies[digest]
+                yield (path, kind or None, os.pread(_open(body).fileno(), length, offset))
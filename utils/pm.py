@@ -26,6 +26,11 @@ class ProcessManager:
             worker.start()
             self.started.append(worker)
 
+    def failed(self):
+        """ Return the workers that exited with an error
+        """
+        return [worker for worker in self.started if worker.exitcode]
+
     def __getitem__(self, index):
         return self.workers[index]
 
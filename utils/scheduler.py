@@ -0,0 +1,51 @@
+from collections import deque
+
+MIN_YIELD=0.1 # so a kind that yields nothing still gets its turn
+
+class Scheduler:
+    """ Stride scheduling of the captures waiting for a loader
+
+        There is one FIFO queue per page kind. Each kind is served in
+        proportion to its expected number of rows per request: the running
+        mean of the parse results, starting from the `priors` estimates.
+        Every non-empty queue keeps a share, so low-yield captures are
+        delayed but never starved.
+    """
+    def __init__(self, priors):
+        self.queues = {kind: deque() for kind in priors}
+        self.passes = {kind: 0.0 for kind in priors}
+        self.now = 0.0
+
+        # The prior counts as one request
+        self.requests = {kind: 1 for kind in priors}
+        self.rows = dict(priors)
+
+    def expected(self, kind):
+        return max(self.rows[kind] / self.requests[kind], MIN_YIELD)
+
+    def record(self, kind, rows):
+        """ Account for a request on a page of the given kind
+        """
+        self.requests[kind] += 1
+        self.rows[kind] += rows
+
+    def push(self, kind, item):
+        queue = self.queues[kind]
+        if not queue:
+            # Don't let an idle kind catch up on the time it was not waiting
+            self.passes[kind] = max(self.passes[kind], self.now)
+
+        queue.append(item)
+
+    def pop(self):
+        kind = min(
+            (kind for kind, queue in self.queues.items() if queue),
+            key=self.passes.__getitem__
+        )
+        self.now = self.passes[kind]
+        self.passes[kind] += 1 / self.expected(kind)
+
+        return self.queues[kind].popleft()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
@@ -2,6 +2,16 @@ import logging
 
 from utils import notify
 
+def report(err, stats):
+    """ Log an error that did not stop the worker
+    """
+    notify('ERROR', type(err))
+    notify('ERROR', err)
+    logging.error(type(err))
+    logging.error(err, exc_info=True)
+    logging.error(err.__traceback__)
+    stats['error'] += 1
+
 def worker(fct, name, stats):
     done = False
     stats['run'] = 0
@@ -18,11 +28,6 @@ def worker(fct, name, stats):
         except BrokenPipeError:
             done = True
         except Exception as err:
-            notify('ERROR', type(err))
-            notify('ERROR', err)
-            logging.error(type(err))
-            logging.error(err, exc_info=True)
-            logging.error(err.__traceback__)
-            stats['error'] += 1
+            report(err, stats)
 
     notify('EXIT', name)
@@ -6,29 +6,65 @@ import os.path
 import requests
 
 from utils import Cooldown, notify
+from utils.cdxindex import CdxIndex
 from utils.worker import worker
+from utils.batcher import push
 from config.constants import *
 from config.commands import *
 
 PATH_FMT="{timestamp}/{original}"
-WAYBACK_URL_FMT="https://web.archive.org/web/{timestamp}/{original}"
-def capturetopath(capture):
-    url = WAYBACK_URL_FMT.format_map(capture)
-    path = PATH_FMT.format_map(capture)
-
-    # Sanitize path
+WAYBACK_URL_FMT=WAYBACK_ENDPOINT+"/web/{timestamp}/{original}"
+def sanitize(path):
+    """ Normalize a "{timestamp}/{original URL}" capture path
+    """
     path = path.replace('/?', '?')
     path = re.sub(r':80/', '/', path)
 
     # Skip the protocol at the start of the URL but also in anywhere in the URL because
     # some redirections in the Wayback Machine embeds the protocol after the date
     items = [part for part in path.split('/') if part not in ('http:', 'https:')]
-    path = os.path.normpath(os.path.join(*items))
+    return os.path.normpath(os.path.join(*items))
+
+def capturetopath(capture):
+    url = WAYBACK_URL_FMT.format_map(capture)
+    path = sanitize(PATH_FMT.format_map(capture))
 
     return (path, url)
 
+# Rules tried in order on the captured URL: (name, regex, page kind), with
+# a `None` kind for the captures the parsers can't extract anything from
+URL_RULES=(
+    ('ask', re.compile(r'/questions/ask(?:[/?#]|$)'), None),
+    ('feed', re.compile(r'/feeds?/|[?&](?:type|format)=rss'), None),
+    ('tagged', re.compile(r'/questions/tagged/[^/?#]'), PAGE_TAGGED),
+    ('question', re.compile(r'/questions/[0-9]+(?:[/?#]|$)'), PAGE_QUESTION),
+    ('other', re.compile(r''), None), # listings, sorted or paged
+)
+
+def classify(original):
+    """ Return the (rule name, page kind) of a captured URL
+    """
+    for name, regex, kind in URL_RULES:
+        if regex.search(original):
+            return (name, kind)
+
 def cdx(ctrl, queue, sem, url):
     """ Query the CDX index to retrieve all captures for the `url` prefix
+
+        The queue holds (partition, resumeKey) pairs. A partition is a
+        (from, to) timestamp range; each one has its own chain of resume
+        keys, so several workers can enumerate different partitions
+        at the same time.
+
+        Every page fetched is saved in the local CDX index. When a partition
+        is (re)started, the captures already indexed are replayed from there
+        and the enumeration resumes at the last saved key, or not at all if
+        the partition is complete.
+
+        Captures are classified by URL (see `URL_RULES`) and the ones the
+        parsers can't handle are skipped. The others are pushed with their
+        page kind, and with their content digest so the controller can
+        reuse the result of an identical page instead of loading it.
     """
 
     stats = {
@@ -37,8 +73,12 @@ def cdx(ctrl, queue, sem, url):
         'push': 0,
         'timeout': 0,
         'connerr': 0,
+        'replay': 0,
+        'skip': {name: 0 for name, regex, kind in URL_RULES if kind is None},
     }
+    replayed = set()
 
+    index = CdxIndex(CDX_INDEX_URI, timeout=DB_TIMEOUT)
     cooldown = Cooldown()
     params = dict(
         url=url,
@@ -48,14 +88,55 @@ def cdx(ctrl, queue, sem, url):
         resumeKey=None
     )
 
-    fields = ('timestamp', 'original', 'statuscode')
+    fields = ('timestamp', 'original', 'statuscode', 'digest')
     params['fl'] = ",".join(fields)
 
+    def _captures(items):
+        for item in items:
+            rule, kind = classify(item['original'])
+            if kind is None:
+                stats['skip'][rule] += 1
+                continue
+
+            # notify("PUSH", item['timestamp'], item['original'])
+            stats['push'] += 1
+            yield (*capturetopath(item), kind, item.get('digest'))
+
+    def _push(items):
+        push(ctrl, sem, _captures(items))
+
+    def _replay(partition):
+        """ Push the captures already indexed for the partition
+
+            Return True if the enumeration was handed over to the next
+            key, or False if the partition must be fetched from its start.
+        """
+        resumeKey, complete = index.position(partition)
+        if not complete and resumeKey is None:
+            return False
+
+        _push(item for item in index.captures(partition) if item['statuscode'] == '200')
+        stats['replay'] += 1
+
+        if complete:
+            ctrl.put((CDX_DONE, partition))
+        else:
+            ctrl.put((CDX, partition, resumeKey))
+
+        return True
+
     def _next():
-        resumeKey = queue.get()
+        partition, resumeKey = queue.get()
+        if resumeKey is None and partition not in replayed:
+            replayed.add(partition)
+            if _replay(partition):
+                return False
+
         cooldown.wait()
 
+        fetched = False
         try:
+            params['from'], params['to'] = partition
             params['resumeKey'] = resumeKey
             r = requests.get(CDX_API_ENDPOINT,
                     timeout=REQUESTS_TIMEOUT,
@@ -71,6 +152,7 @@ def cdx(ctrl, queue, sem, url):
 
             resumeKey = None
             count = 0
+            rows = []
             items = []
             for line in r.iter_lines():
                 count += 1
@@ -94,21 +176,29 @@ def cdx(ctrl, queue, sem, url):
                 item = {
                     k: v for k,v in zip(fields, item)
                 }
+                rows.append(item)
                 if item.get("statuscode") == "200":
                     items.append(item)
-        finally:
-            ctrl.put((CDX, resumeKey))
 
-        for item in items:
-                # notify("PUSH", item['timestamp'], item['original'])
-                stats['push'] += 1
-                sem.acquire()
-                ctrl.put((CHECK,*capturetopath(item)))
+            index.add(partition, rows, resumeKey)
+            fetched = True
+        finally:
+            if not fetched:
+                # Try the same page again
+                ctrl.put((CDX, partition, params['resumeKey']))
+
+        # The next key is sent once the captures of the page were pushed:
+        # the controller saves it as the position to resume the partition from
+        _push(items)
+        if resumeKey is None:
+            ctrl.put((CDX_DONE, partition))
+        else:
+            ctrl.put((CDX, partition, resumeKey))
 
         cooldown.clear()
-        notify('DEBUG', count)
+        notify('DEBUG', partition, count)
 
-        return count == 0
+        return False
 
     def _run():
         try:
@@ -2,6 +2,8 @@ import logging
 import urllib
 import re
 import os.path
+import time
+from threading import Thread
 
 import requests
 
@@ -12,27 +14,70 @@ from config.constants import *
 from config.commands import *
 
 
+def checkpointer(stats):
+    """ Periodically checkpoint the WAL from a separate connection so the
+        writer never pays for it and the WAL file does not grow unbounded
+    """
+    db = Db(DB_URI, mode='rw', timeout=DB_TIMEOUT)
+
+    while True:
+        time.sleep(DB_CHECKPOINT_INTERVAL)
+        try:
+            busy, log, checkpointed = db.checkpoint()
+            stats['wal'] = log
+            notify('CHECKPT', log, checkpointed)
+        except Exception as err:
+            notify('ERROR', err)
+            logging.error(err, exc_info=True)
+
 def db(ctrl, queue):
     db = Db(DB_URI, mode='rwc', timeout=DB_TIMEOUT)
+    db.ingest()
     notify('DB', 'up')
-    stats = {}
+    stats = {
+        'commit': 0,
+        'rows': 0,
+        'rows/s': 0,
+        'latency': 0,
+        'wal': 0,
+    }
+    Thread(target=checkpointer, args=(stats,), daemon=True).start()
 
-    def _commit(cache):
-        db.write(cache)
+    def _commit(cache, frontier=None):
+        start = time.time()
+        rows = db.write(cache, frontier)
+        latency = time.time() - start
 
-    def _check(path, url):
+        stats['commit'] += 1
+        stats['rows'] += rows
+        stats['latency'] = round(latency, 3)
+        stats['rows/s'] = int(rows / latency) if latency else 0
+        notify('COMMIT', rows, stats['latency'], stats['rows/s'])
+
+    def _check(path, url, kind, digest=None):
         if not db.exists(path):
-            ctrl.put((LOAD, path, url))
+            ctrl.put((LOAD, path, url, kind, digest))
         else:
             ctrl.put((DISCARD, path, url))
 
+    def _check_many(items):
+        missing = set(db.missing(item[0] for item in items))
+        load = [item for item in items if item[0] in missing]
+        discard = [item[0] for item in items if item[0] not in missing]
+        ctrl.put((LOAD_MANY, load, discard))
+
+    def _eof():
+        return True
+
     commands = {
         CHECK: _check,
+        CHECK_MANY: _check_many,
         COMMIT: _commit,
+        EOF: _eof,
     }
 
     def _run():
         cmd, *args = queue.get()
-        commands[cmd](*args)
+        return commands[cmd](*args)
 
     return worker(_run, "db", stats)
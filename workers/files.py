@@ -0,0 +1,107 @@
+import re
+import os.path
+
+from utils import notify, pack
+from utils.worker import worker
+from utils.batcher import Batcher, push
+from workers.cdx import classify, sanitize
+from config.constants import *
+from config.commands import *
+
+TIMESTAMP_RE=re.compile('^[0-9]{14}')
+INDEX_SUFFIX='.index' # `download.py` saves an URL ending with '/' under this name
+
+def filetopath(filepath):
+    """ Return the (path, original URL) of a page saved by `download.py` or
+        by the `snapshots` wget mirror, or None if there is no capture
+        timestamp in the file path
+    """
+    parts = str(filepath).split(os.sep)
+    for n, part in enumerate(parts):
+        if TIMESTAMP_RE.match(part):
+            break
+    else:
+        return None
+
+    items = [part for part in parts[n+1:] if part not in ('http:', 'https:')]
+    if not items:
+        return None
+    if items[-1].endswith(INDEX_SUFFIX):
+        items[-1] = items[-1][:-len(INDEX_SUFFIX)] + '/'
+
+    path = sanitize('/'.join((part[:14], *items)))
+    original = 'http://' + '/'.join(items)
+
+    return (path, original)
+
+def lister(ctrl, sem, filepaths):
+    """ Push the local files to check to the controller, then EOF
+
+        This is the local counterpart of the CDX workers. The controller
+        waits for the answers to the checks sent before EOF. The symlinks
+        `download.py` makes for the redirections are skipped, their target
+        is listed too.
+    """
+    stats = {
+        'push': 0,
+        'skip': 0,
+        'link': 0,
+    }
+
+    def _captures():
+        for filepath in filepaths:
+            if os.path.islink(filepath):
+                stats['link'] += 1
+                continue
+
+            capture = filetopath(filepath)
+            kind = None
+            if capture is not None:
+                path, original = capture
+                rule, kind = classify(original)
+
+            if kind is None:
+                stats['skip'] += 1
+                continue
+
+            stats['push'] += 1
+            yield (path, str(filepath), kind)
+
+    push(ctrl, sem, _captures())
+
+    notify('EOF', stats)
+    ctrl.put((EOF,))
+
+def files(ctrl, queue, pages, budget):
+    """ Read a local file and push the page to the `pages` parser queue
+
+        This is the local counterpart of `workers.loader.loader`. The queue
+        holds (path, filepath, kind) captures.
+    """
+    stats = dict(
+        read=0,
+        failed=0,
+    )
+    ctrl = Batcher(ctrl)
+
+    def _run():
+        path, filepath, kind = queue.get()
+        try:
+            with open(filepath, 'rt', encoding='utf-8', errors='replace') as f:
+                data = pack(f.read())
+            stats['read'] += 1
+        except OSError as err:
+            # Nothing to retry: the capture is just not stored
+            notify('ERROR', err)
+            stats['failed'] += 1
+            ctrl.put((DONE,path,None))
+            return False
+
+        budget.acquire(len(data))
+        ctrl.put((PARSE,path,len(data)))
+        pages.put((path,kind,data))
+        ctrl.put((DONE,path,None))
+
+        return False
+
+    return worker(_run, "files", stats)
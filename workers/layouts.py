@@ -0,0 +1,118 @@
+""" Patterns and errors shared by the extraction engines, see
+    `workers.parser` (BeautifulSoup) and `workers.xpath` (lxml)
+"""
+import re
+
+from config.constants import *
+
+VIEWED_NNNN_TIMES_RE = re.compile(r'[Vv]iewed\s+[0-9]+(,[0-9]{3})*\s+times?')
+NNNN_TIMES_RE = re.compile(r'[0-9]+(,[0-9]{3})*\s+times?')
+VIEWED_RE=re.compile('[Vv]iewed')
+
+# View count of a question on a tagged page
+TAGGED_VIEWS_RE = re.compile(r'([0-9]+(,[0-9]{3})*)([k])?\s')
+
+ATOM_RE = re.compile('/(?P<date>[0-9]{14})/.*/question/(?P<id>[0-9]+)')
+CANONICAL_RE = re.compile('/(?P<date>[0-9]{14})/.*/questions/(?P<id>[0-9]+)')
+OG_URL_RE = re.compile('/(?P<date>[0-9]{14})(?:im_)?/.*/questions/(?P<id>[0-9]+)')
+
+class ParserError(Exception):
+    def __init__(self, fmt, *args, **kwargs):
+        msg = fmt.format(*args, **kwargs)
+        super().__init__(msg)
+    code = PARSER_ERROR
+
+class ImpreciseError(ParserError):
+    code = PARSER_IMPRECISE_ERROR
+
+class DataNotFoundError(ParserError):
+    code = PARSER_DATA_NOT_FOUND_ERROR
+
+def asnum(txt, path):
+    count, suffix = re.search('([0-9]+(?:,[0-9]{3})*)([k]?)', str(txt)).group(1, 2)
+
+    if suffix:
+        raise ImpreciseError("View count {}{} is imprecise for {}".format(count, suffix, path))
+
+    count = count.replace(',','')
+    return int(count)
+
+#
+# View count layouts
+#
+
+# (name, capture date from which the layout is expected), in the order they
+# are tried when the layout of the capture era does not match. The other
+# layouts are variants of the one before them.
+LAYOUTS = (
+    ('2019', '20190000000000'),
+    ('2019-alt', None),
+    ('2015', '20150000000000'),
+    ('2013', '20130000000000'),
+    ('2009', '20090000000000'),
+    ('2008', '20080915000000'),
+    ('beta', ''),
+    ('beta-alt', None),
+)
+
+# Layout expected from a capture date on, most recent first
+ERAS = tuple(sorted(
+    ((since, name) for name, since in LAYOUTS if since is not None),
+    reverse=True
+))
+
+class Finders(dict):
+    """ The view count finder of an extraction engine for each layout
+
+        A finder takes the parsed page and returns the view count text, or
+        None if the page does not have that layout.
+    """
+    def layout(self, name):
+        """ Decorator registering a finder for the layout `name`
+        """
+        if name not in dict(LAYOUTS):
+            raise KeyError(name)
+
+        def register(fct):
+            self[name] = fct
+            return fct
+
+        return register
+
+class Layouts:
+    """ Try the view count layouts, most likely first
+
+        The layout of the capture era is tried first, then the others by
+        decreasing number of hits so far, in the `LAYOUTS` order on a tie. A
+        page matching several layouts gets the view count of its era layout;
+        before the era dispatch, it got the one of the first layout in
+        `LAYOUTS`. The [hit, miss] counters are kept in the `layout` entry
+        of `stats`.
+    """
+    def __init__(self, stats=None):
+        stats = {} if stats is None else stats
+        self.counters = stats.setdefault('layout', {
+            name: [0, 0] for name, since in LAYOUTS
+        })
+
+    def order(self, date):
+        era = next(name for since, name in ERAS if since <= date)
+
+        counters = self.counters
+        return (era, *sorted(
+            (name for name, since in LAYOUTS if name != era),
+            key=lambda name: -counters[name][0]
+        ))
+
+    def find(self, finders, tree, date):
+        """ Return the view count text found by the first matching layout
+        """
+        for name in self.order(date):
+            txt = finders[name](tree)
+            if txt is not None:
+                self.counters[name][0] += 1
+                return txt
+
+            self.counters[name][1] += 1
+
+        return None
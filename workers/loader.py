@@ -1,78 +1,126 @@
 import os
+import time
+import hashlib
+from threading import Thread
 
 import requests
 
 from utils.worker import worker
+from utils.batcher import Batcher
+from utils.packstore import PackWriter
 from config.constants import *
 from config.commands import *
-from utils import Cooldown, notify
+from utils import notify, pack
 
-def loader(ctrl, queue):
-    """ Load an URL and push back links to the queue
+def session(concurrency):
+    """ Build a session whose connection pool keeps one keep-alive connection
+        per in-flight request
+    """
+    s = requests.Session()
+    s.headers['user-agent'] = REQUESTS_USER_AGENT
+
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=concurrency,
+        pool_block=True
+    )
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+
+    return s
+
+def loader(ctrl, queue, pages, budget, concurrency=LOADER_CONCURRENCY, digests=None):
+    """ Load an URL and push the page to the `pages` parser queue
+
+        Page bodies go straight to the parsers, compressed. Only their size
+        is reported to the controller. A thread blocks until its page fits
+        in the `budget` of bytes waiting for the parsers.
+
+        Each process runs `concurrency` threads sharing the same pooled
+        session, so up to `concurrency` requests are in flight at once.
+
+        Failed captures are handed back to the controller, which schedules
+        their retry: loaders never sleep. The cause of the failure, or the
+        latency of the successful requests, is reported so the controller
+        can adapt the number of requests in flight.
+
+        With PACK_STORE_DIR set, the pages are also kept in the pack store.
+        `digests` is the index of its bodies shared by the loaders, see
+        `utils.packstore.PackWriter`.
     """
     stats = dict(
-        sleep=0,
         redirect=0,
         run=0,
         download=0,
         write=0,
         error=0,
         timeout=0,
-        connerr=0
+        connerr=0,
+        blocked=0,
     )
 
-    cooldown = Cooldown()
-
-    def load(path, url):
-        if cooldown.wait():
-            stats['sleep'] += 1
+    http = session(concurrency)
+    ctrl = Batcher(ctrl)
+    store = PackWriter(PACK_STORE_DIR, digests=digests) if PACK_STORE_DIR else None
 
+    def load(path, url, kind):
         notify("DOWNLD", url)
-        retry = False
+        retry = None
+        start = time.time()
         try:
-            r = requests.get(
+            r = http.get(
                 url,
-                headers = { 'user-agent': REQUESTS_USER_AGENT, },
                 timeout=REQUESTS_TIMEOUT
             )
+            latency = time.time() - start
             stats['download'] += 1
             if r.status_code != 200:
                 notify("STATUS", r.status_code)
-                retry = True
+                retry = RETRY_STATUS
 
             if r.status_code == 429 or r.status_code >= 500:
                 # Too many requests or server error
-                cooldown.set()
-            else:
-                cooldown.clear()
-
+                retry = RETRY_THROTTLED
 
         except requests.Timeout:
             notify("TIMEOUT", url)
-            retry = True
-            cooldown.set()
+            retry = RETRY_TIMEOUT
             stats['timeout'] += 1
         except requests.exceptions.ConnectionError:
             # Connection refused?
             notify("CONNERR", url)
-            retry = True
-            cooldown.set()
+            retry = RETRY_CONNERR
             stats['connerr'] += 1
 
         if retry:
             # Retry later
-            notify("RETRY", url)
-            ctrl.put((RETRY, path, url))
+            notify("RETRY", url, retry)
+            ctrl.put((RETRY, path, url, kind, retry))
         else:
-            notify("PARSE", path)
-            ctrl.put((PARSE,path,r.text))
+            data = pack(r.text)
+            if store is not None:
+                store.add(path, kind, data, hashlib.sha1(r.content).digest())
+
+            start = time.time()
+            budget.acquire(len(data))
+            stats['blocked'] += round(time.time() - start, 3)
+
+            notify("PARSE", path, len(data))
+            ctrl.put((PARSE,path,len(data)))
+            pages.put((path,kind,data))
             notify("DONE")
-            ctrl.put((DONE,path))
+            ctrl.put((DONE,path,latency))
 
 
     def _run():
-        path,url = queue.get()
-        load(path, url)
+        path,url,kind = queue.get()
+        load(path, url, kind)
 
-    return worker(_run, "loader", stats)
+    threads = [
+        Thread(target=worker, args=(_run, "loader", stats), daemon=True)
+        for n in range(concurrency-1)
+    ]
+    for thread in threads:
+        thread.start()
 
+    return worker(_run, "loader", stats)
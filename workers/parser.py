@@ -2,33 +2,100 @@ import re
 
 from bs4 import BeautifulSoup
 
-from utils import notify
+from utils import notify, unpack
 from utils.worker import worker
+from utils.batcher import Batcher
+from workers import xpath
+from workers.layouts import (
+    asnum,
+    Layouts,
+    Finders,
+    ParserError,
+    ImpreciseError,
+    DataNotFoundError,
+    VIEWED_NNNN_TIMES_RE,
+    NNNN_TIMES_RE,
+    VIEWED_RE,
+    TAGGED_VIEWS_RE,
+    ATOM_RE,
+    CANONICAL_RE,
+    OG_URL_RE,
+)
 from config.commands import *
 from config.constants import *
 
-VIEWED_NNNN_TIMES_RE = re.compile('[Vv]iewed\s+[0-9]+(,[0-9]{3})*\s+times?')
-NNNN_TIMES_RE = re.compile('[0-9]+(,[0-9]{3})*\s+times?')
-VIEWED_RE=re.compile('[Vv]iewed')
-
-
-ATOM_RE = re.compile('/(?P<date>[0-9]{14})/.*/question/(?P<id>[0-9]+)')
-CANONICAL_RE = re.compile('/(?P<date>[0-9]{14})/.*/questions/(?P<id>[0-9]+)')
-OG_URL_RE = re.compile('/(?P<date>[0-9]{14})(?:im_)?/.*/questions/(?P<id>[0-9]+)')
-
-class ParserError(Exception):
-    def __init__(self, fmt, *args, **kwargs):
-        msg = fmt.format(*args, **kwargs)
-        super().__init__(msg)
-    code = PARSER_ERROR
-
-class ImpreciseError(ParserError):
-    code = PARSER_IMPRECISE_ERROR
-
-class DataNotFoundError(ParserError):
-    code = PARSER_DATA_NOT_FOUND_ERROR
-
-def visit(text, path):
+#
+# View count layouts, see `workers.layouts.LAYOUTS`
+#
+FINDERS = Finders()
+
+@FINDERS.layout('2019')
+def _2019(soup):
+    vc = soup.find('div', attrs={'title': VIEWED_NNNN_TIMES_RE})
+    if vc:
+        return vc['title']
+
+@FINDERS.layout('2019-alt')
+def _2019_alt(soup):
+    vc = soup.find('div', attrs={'itemprop': 'mainEntity'})
+    if vc:
+        vc = vc.find('span', string='Viewed')
+    if vc:
+        return " ".join(vc.parent.strings)
+
+@FINDERS.layout('2015')
+def _2015(soup):
+    vc = soup.find('div', attrs={'id': 'question-header'})
+    if vc:
+        vc = vc.find('div', string=VIEWED_NNNN_TIMES_RE)
+    if vc:
+        return vc.get_text()
+
+@FINDERS.layout('2013')
+def _2013(soup):
+    vc = soup.find('table', attrs={'id': 'qinfo'})
+    if vc:
+        vc = vc.find(string=NNNN_TIMES_RE)
+    if vc:
+        return str(vc)
+
+@FINDERS.layout('2009')
+def _2009(soup):
+    vc = soup.find('div', id='sidebar')
+    if vc:
+        vc = vc.find('p', attrs={'class': 'label-key'}, string=VIEWED_RE)
+    if vc:
+        vc = vc.find_next_sibling('p', string=NNNN_TIMES_RE)
+    if vc:
+        return vc.get_text()
+
+@FINDERS.layout('2008')
+def _2008(soup):
+    vc = soup.find('div', id='sidebar')
+    if vc:
+        vc = vc.find('p', string=VIEWED_RE)
+    if vc:
+        vc = vc.find_next_sibling('p', string=NNNN_TIMES_RE)
+    if vc:
+        return vc.get_text()
+
+@FINDERS.layout('beta')
+def _beta(soup):
+    vc = soup.find('div', id='viewcount')
+    if vc:
+        vc = vc.b
+    if vc:
+        return vc.get_text()
+
+@FINDERS.layout('beta-alt')
+def _beta_alt(soup):
+    vc = soup.find('div', attrs={'class':'viewcount'})
+    if vc:
+        vc = vc.b
+    if vc:
+        return vc.get_text()
+
+def visit(text, path, kind=None, engine=PARSER_ENGINE, layouts=None):
     def _visit_tagged(soup):
         result = []
 
@@ -48,7 +115,7 @@ def visit(text, path):
 
                 views = question.find('div', attrs={'class':'views'})
                 vc = views = views.get('title') or views.get_text()
-                views = re.search('([0-9]+(,[0-9]{3})*)([k])?\s', views)
+                views = TAGGED_VIEWS_RE.search(views)
                 if views is None:
                     raise ImpreciseError("tagged -- Can't understand view count '{}' in {}", vc, path)
                 elif views.group(3):
@@ -69,76 +136,6 @@ def visit(text, path):
         return result
 
     def _visit_question(soup):
-        def viewcount(soup):
-            def asnum(txt):
-                count, suffix = re.search('([0-9]+(?:,[0-9]{3})*)([k]?)', str(txt)).group(1, 2)
-
-                if suffix:
-                    raise ImpreciseError("View count {}{} is imprecise for {}".format(count, suffix, path))
-
-                count = count.replace(',','')
-                return int(count)
-
-            # 2019 version
-            vc = soup.find('div', attrs={'title': VIEWED_NNNN_TIMES_RE})
-            if vc:
-                return asnum(vc['title'])
-
-            # 2019 version (alternate)
-            vc = soup.find('div', attrs={'itemprop': 'mainEntity'})
-            if vc:
-                vc = vc.find('span', string='Viewed')
-            if vc:
-                return asnum(" ".join(vc.parent.strings))
-
-            # 2015 version
-            vc = soup.find('div', attrs={'id': 'question-header'})
-            if vc:
-                vc = vc.find('div', string=VIEWED_NNNN_TIMES_RE)
-            if vc:
-                return asnum(vc.get_text())
-
-            # 2013 version
-            vc = soup.find('table', attrs={'id': 'qinfo'})
-            if vc:
-                vc = vc.find(string=NNNN_TIMES_RE)
-            if vc:
-                return asnum(vc)
-
-            # 2009 version
-            vc = soup.find('div', id='sidebar')
-            if vc:
-                vc = vc.find('p', attrs={'class': 'label-key'}, string=VIEWED_RE)
-            if vc:
-                vc = vc.find_next_sibling('p', string=NNNN_TIMES_RE)
-            if vc:
-                return asnum(vc.get_text())
-
-            # 2008 version
-            vc = soup.find('div', id='sidebar')
-            if vc:
-                vc = vc.find('p', string=VIEWED_RE)
-            if vc:
-                vc = vc.find_next_sibling('p', string=NNNN_TIMES_RE)
-            if vc:
-                return asnum(vc.get_text())
-
-            # Beta version
-            vc = soup.find('div', id='viewcount')
-            if vc:
-                vc = vc.b
-            if vc:
-                return asnum(vc.get_text())
-
-            # Beta version
-            vc = soup.find('div', attrs={'class':'viewcount'})
-            if vc:
-                vc = vc.b
-            if vc:
-                return asnum(vc.get_text())
-
-            return None
-
         def coreinfo(soup):
             url = soup.find('link', rel='alternate',type="application/atom+xml")
             if url:
@@ -187,9 +184,10 @@ def visit(text, path):
         if ci is None:
             raise DataNotFoundError("coreinfo -- Can't find info for {}", path)
 
-        vc = viewcount(soup)
+        vc = layouts.find(FINDERS, soup, ci['date'])
         if vc is None:
             raise DataNotFoundError("viewcount -- Can't find view count for {}", path)
+        vc = asnum(vc, path)
 
         tg = tags(soup)
         if not tg:
@@ -201,11 +199,20 @@ def visit(text, path):
             **ci
         ),)
 
+    if layouts is None:
+        layouts = Layouts()
+
+    if kind is None:
+        kind = PAGE_TAGGED if '/tagged/' in path else PAGE_QUESTION
+
     try:
+        if engine == 'lxml':
+            return (PARSER_OK, xpath.visit(text, path, kind, layouts))
+
         soup = BeautifulSoup(text, 'lxml')
         return (
             PARSER_OK,
-            _visit_tagged(soup) if ('/tagged/' in path) else _visit_question(soup),
+            _visit_tagged(soup) if kind == PAGE_TAGGED else _visit_question(soup),
         )
 
     except ParserError as e:
@@ -215,11 +222,16 @@ def visit(text, path):
         return (PARSER_SYS_ERROR,)
 
 
-def parser(ctrl, queue):
+def parser(ctrl, queue, budget):
     stats = {}
+    layouts = Layouts(stats)
+    ctrl = Batcher(ctrl)
 
     def _run():
-        path, text = queue.get()
-        ctrl.put((STORE, path, *visit(text, path)))
+        path, kind, data = queue.get()
+        try:
+            ctrl.put((STORE, path, *visit(unpack(data), path, kind, layouts=layouts)))
+        finally:
+            budget.release(len(data))
 
     return worker(_run, "parser", stats)
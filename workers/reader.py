@@ -0,0 +1,34 @@
+from utils import notify
+from utils.packstore import pages
+from utils.worker import worker
+from config.constants import *
+from config.commands import *
+
+def reader(ctrl, queue, budget, directory=PACK_STORE_DIR):
+    """ Push the pages of the store to the `queue` parser queue
+
+        Like a loader, but without any network access. EOF is sent to the
+        controller once all pages were pushed.
+    """
+    stats = {
+        'pages': 0,
+        'bytes': 0,
+    }
+
+    it = pages(directory)
+
+    def _run():
+        for path, kind, data in it:
+            budget.acquire(len(data))
+            stats['pages'] += 1
+            stats['bytes'] += len(data)
+
+            ctrl.put((PARSE,path,len(data)))
+            queue.put((path,kind,data))
+            return False
+
+        notify('EOF', stats['pages'])
+        ctrl.put((EOF,))
+        return True
+
+    return worker(_run, "reader", stats)
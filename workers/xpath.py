@@ -0,0 +1,256 @@
+""" Extraction engine built on precompiled lxml XPath expressions
+
+    This mirrors the BeautifulSoup based `_visit_question` and `_visit_tagged`
+    in `workers.parser`, but without building a soup tree and without the
+    attribute by attribute regex matching of `soup.find`.
+"""
+import re
+
+from lxml import etree
+
+from workers.layouts import (
+    asnum,
+    Finders,
+    ImpreciseError,
+    DataNotFoundError,
+    VIEWED_NNNN_TIMES_RE,
+    NNNN_TIMES_RE,
+    VIEWED_RE,
+    TAGGED_VIEWS_RE,
+    ATOM_RE,
+    CANONICAL_RE,
+    OG_URL_RE,
+)
+from config.constants import PAGE_TAGGED
+
+def _class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+def _rel(name):
+    return "contains(concat(' ', normalize-space(@rel), ' '), ' {} ')".format(name)
+
+# Tagged page
+TAGGED_QUESTIONS = etree.XPath("//div[{}]".format(_class('question-summary')))
+TAGGED_H3 = etree.XPath("(.//h3)[1]")
+TAGGED_A = etree.XPath("(.//a)[1]")
+TAGGED_VIEWS = etree.XPath("(.//div[{}])[1]".format(_class('views')))
+TAGGED_TAGS = etree.XPath(".//a[{}]".format(_rel('tag')))
+
+# Question page core info
+ATOM_LINK = etree.XPath("(//link[{} and @type='application/atom+xml'])[1]".format(_rel('alternate')))
+CANONICAL_LINK = etree.XPath("(//link[{}])[1]".format(_rel('canonical')))
+OG_NAME = etree.XPath("(//meta[@name='og:url'])[1]")
+OG_PROPERTY = etree.XPath("(//meta[@property='og:url'])[1]")
+
+# Question page tags
+TAGS = etree.XPath("//a[{}]".format(_rel('tag')))
+
+# View count layouts
+DIV_WITH_TITLE = etree.XPath("//div[@title]")
+MAIN_ENTITY = etree.XPath("(//div[@itemprop='mainEntity'])[1]")
+SPANS = etree.XPath(".//span")
+QUESTION_HEADER = etree.XPath("(//div[@id='question-header'])[1]")
+DIVS = etree.XPath(".//div")
+QINFO = etree.XPath("(//table[@id='qinfo'])[1]")
+# Like the BeautifulSoup `strings`, without the content of the script, style
+# and template elements
+TEXTS = etree.XPath(".//text()[not(parent::script or parent::style or ancestor::template)]")
+# Like the strings searched by `soup.find(string=...)`: every text node
+# and comment
+ALL_STRINGS = etree.XPath(".//text() | .//comment()")
+SIDEBAR = etree.XPath("(//div[@id='sidebar'])[1]")
+PARAGRAPHS = etree.XPath(".//p")
+LABEL_KEYS = etree.XPath(".//p[{}]".format(_class('label-key')))
+VIEWCOUNT_ID = etree.XPath("(//div[@id='viewcount'])[1]")
+VIEWCOUNT_CLASS = etree.XPath("(//div[{}])[1]".format(_class('viewcount')))
+BOLD = etree.XPath("(.//b)[1]")
+
+def _first(xpath, el):
+    result = xpath(el)
+    return result[0] if result else None
+
+def _string(el):
+    """ Equivalent of the BeautifulSoup `Tag.string` property
+    """
+    if len(el) == 0:
+        return el.text
+    if len(el) == 1 and not el.text and not el[0].tail and isinstance(el[0].tag, str):
+        return _string(el[0])
+
+    return None
+
+def _text(el):
+    """ Equivalent of the BeautifulSoup `Tag.get_text()` method
+    """
+    return "".join(TEXTS(el))
+
+def _find_string(xpath, el, pattern):
+    for child in xpath(el):
+        string = _string(child)
+        if string is not None and pattern.search(string):
+            return child
+
+    return None
+
+#
+# View count layouts, see `workers.layouts.LAYOUTS`
+#
+FINDERS = Finders()
+
+@FINDERS.layout('2019')
+def _2019(root):
+    for vc in DIV_WITH_TITLE(root):
+        if VIEWED_NNNN_TIMES_RE.search(vc.get('title')):
+            return vc.get('title')
+
+@FINDERS.layout('2019-alt')
+def _2019_alt(root):
+    vc = _first(MAIN_ENTITY, root)
+    if vc is not None:
+        vc = next((span for span in SPANS(vc) if _string(span) == 'Viewed'), None)
+    if vc is not None:
+        return " ".join(TEXTS(vc.getparent()))
+
+@FINDERS.layout('2015')
+def _2015(root):
+    vc = _first(QUESTION_HEADER, root)
+    if vc is not None:
+        vc = _find_string(DIVS, vc, VIEWED_NNNN_TIMES_RE)
+    if vc is not None:
+        return _text(vc)
+
+@FINDERS.layout('2013')
+def _2013(root):
+    vc = _first(QINFO, root)
+    if vc is not None:
+        strings = (txt if isinstance(txt, str) else txt.text or '' for txt in ALL_STRINGS(vc))
+        vc = next((txt for txt in strings if NNNN_TIMES_RE.search(txt)), None)
+    if vc is not None:
+        return str(vc)
+
+@FINDERS.layout('2009')
+def _2009(root):
+    vc = _first(SIDEBAR, root)
+    if vc is not None:
+        vc = _find_string(LABEL_KEYS, vc, VIEWED_RE)
+    if vc is not None:
+        vc = _find_string(lambda el: el.itersiblings('p'), vc, NNNN_TIMES_RE)
+    if vc is not None:
+        return _text(vc)
+
+@FINDERS.layout('2008')
+def _2008(root):
+    vc = _first(SIDEBAR, root)
+    if vc is not None:
+        vc = _find_string(PARAGRAPHS, vc, VIEWED_RE)
+    if vc is not None:
+        vc = _find_string(lambda el: el.itersiblings('p'), vc, NNNN_TIMES_RE)
+    if vc is not None:
+        return _text(vc)
+
+@FINDERS.layout('beta')
+def _beta(root):
+    vc = _first(VIEWCOUNT_ID, root)
+    if vc is not None:
+        vc = _first(BOLD, vc)
+    if vc is not None:
+        return _text(vc)
+
+@FINDERS.layout('beta-alt')
+def _beta_alt(root):
+    vc = _first(VIEWCOUNT_CLASS, root)
+    if vc is not None:
+        vc = _first(BOLD, vc)
+    if vc is not None:
+        return _text(vc)
+
+def parse(text):
+    try:
+        return etree.HTML(text)
+    except ValueError:
+        # Unicode strings with an encoding declaration
+        return etree.HTML(text.encode('utf-8'), etree.HTMLParser(encoding='utf-8'))
+
+def visit_tagged(root, path):
+    result = []
+
+    for question in TAGGED_QUESTIONS(root):
+        href = _first(TAGGED_A, _first(TAGGED_H3, question)).attrib['href']
+        date = re.search('/web/([0-9]{14})/', href).group(1)
+
+        qid = question.get('id')
+        if qid:
+            qid = qid.rsplit('-')[-1]
+        else:
+            qid = re.search('/questions/([0-9]+)/', href).group(1)
+
+        qid=str(int(qid)) # raise an exception if this is not a numerical id
+
+        views = _first(TAGGED_VIEWS, question)
+        vc = views = views.get('title') or _text(views)
+        views = TAGGED_VIEWS_RE.search(views)
+        if views is None:
+            raise ImpreciseError("tagged -- Can't understand view count '{}' in {}", vc, path)
+        elif views.group(3):
+            raise ImpreciseError("tagged -- Imprecise '%s' in %s", vc, path)
+
+        views = int(views.group(1).replace(',',''))
+
+        tags = sorted(set([_text(el) for el in TAGGED_TAGS(question)]))
+
+        result.append(dict(
+            id=qid,
+            date=date,
+            viewcount=views,
+            tags=tags
+        ))
+
+    return result
+
+def visit_question(root, path, layouts):
+    def coreinfo(root):
+        for xpath, attr, regex in (
+                (ATOM_LINK, 'href', ATOM_RE),
+                (CANONICAL_LINK, 'href', CANONICAL_RE),
+                (OG_NAME, 'content', OG_URL_RE),
+                (OG_PROPERTY, 'content', OG_URL_RE), # 2019
+            ):
+            url = _first(xpath, root)
+            if url is not None:
+                m = regex.search(url.attrib[attr])
+                if m:
+                    return m.groupdict()
+
+        return None
+
+    def tags(root):
+        # Both the 2009+ and the public beta layouts use rel="tag" links
+        return sorted(set([_text(el) for el in TAGS(root)]))
+
+
+    ci = coreinfo(root)
+    if ci is None:
+        raise DataNotFoundError("coreinfo -- Can't find info for {}", path)
+
+    vc = layouts.find(FINDERS, root, ci['date'])
+    if vc is None:
+        raise DataNotFoundError("viewcount -- Can't find view count for {}", path)
+    vc = asnum(vc, path)
+
+    tg = tags(root)
+    if not tg:
+        raise DataNotFoundError("tags -- Can't find tags for {}", path)
+
+    return (dict(
+        viewcount=vc,
+        tags=tg,
+        **ci
+    ),)
+
+def visit(text, path, kind, layouts):
+    root = parse(text)
+    if root is None:
+        # Empty document
+        root = etree.Element('html')
+
+    return visit_tagged(root, path) if kind == PAGE_TAGGED else visit_question(root, path, layouts)